@@ -0,0 +1,385 @@
+"""Incremental rollups for `analytics_events`.
+
+`AnalyticsService.getStudyMetrics` and `getConversionFunnel` read the whole
+events collection, and `getEventCounts` scans a date range, so their cost
+grows with the study. Instead, each new event is folded into three rollups
+with blind increment and maximum transforms:
+
+* `analytics_rollups/{day}/shards/{n}`: total events, events that carry a
+  `userId`, per-event counts and a HyperLogLog sketch of unique users for
+  the UTC day.
+* `analytics_rollups/{day}/eventRollups/{eventName}/eventShards/{n}`: count
+  and unique-user sketch for one event on that day.
+* `analytics_user_rollups/{userId}`: per-user counts and first/last seen.
+
+Every event of a day lands on the same counters, and a single document
+sustains about one write per second. Each commit therefore picks one of
+`ROLLUP_SHARDS` shards at random, and `RollupReader` adds the shards of a
+day back together, so the metrics are answered from a few documents per
+day. Every applied event also gets an `analytics_rollups_applied/{eventId}`
+marker, created in the same batch as its increments, so trigger retries and
+the backfill never count an event twice. The `users` sketch maps hold up
+to 4096 fields, so exempt them from single-field indexing on the `shards`
+and `eventShards` collection groups, and enable the collection-group index
+on `shards.date` for the day-range queries.
+
+Set a Firestore TTL policy on `expireAt` in `analytics_rollups_applied`.
+Markers outlive the trigger's retry window, but once they have expired the
+backfill would count their events again, so run it only once per event.
+
+Backfill existing events with:
+
+    python -m analytics_rollup backfill --page-size 100
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import random
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Iterable, Mapping, Optional
+
+import concurrency
+import hll
+import store
+
+logger = logging.getLogger(__name__)
+
+EVENT_ROLLUPS_SUBCOLLECTION = "eventRollups"
+DAY_SHARDS_SUBCOLLECTION = "shards"
+EVENT_SHARDS_SUBCOLLECTION = "eventShards"
+
+# Output keys of getConversionFunnel and the event each one counts.
+FUNNEL_STAGES = {
+    "onboarding_started": "onboarding_step",
+    "onboarding_completed": "onboarding_completed",
+    "intake_started": "intake_progress",
+    "intake_completed": "intake_completed",
+    "quit_date_set": "quit_date_set",
+    "quit_attempted": "quit_attempted",
+    "quit_successful": "quit_successful",
+}
+
+# Each shard takes about one write per second; the reader fetches all of them.
+ROLLUP_SHARDS = 10
+# Firestore rejects a commit with more than 500 field transforms on one document.
+_MAX_DOCUMENT_TRANSFORMS = 500
+# Event triggers are retried for up to 7 days.
+APPLIED_MARKER_TTL = timedelta(days=8)
+
+
+def _event_name(data: Mapping[str, Any]) -> str:
+    """The event's name as an `eventRollups` document id."""
+    name = data.get("eventName")
+    if not isinstance(name, str):
+        return "unknown"
+    name = name.replace("/", "_")
+    return name if store.is_valid_document_id(name) else "unknown"
+
+
+def event_user_id(data: Mapping[str, Any]) -> Optional[str]:
+    """The `parameters.userId` that `AnalyticsService` stores on each event."""
+    parameters = data.get("parameters")
+    if isinstance(parameters, Mapping):
+        user_id = parameters.get("userId")
+        if isinstance(user_id, str) and user_id:
+            return user_id
+    return None
+
+
+def _timestamp(data: Mapping[str, Any]) -> datetime:
+    value = data.get("timestamp")
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    return datetime.now(timezone.utc)
+
+
+@dataclass
+class _Bucket:
+    count: int = 0
+    user_count: int = 0
+    events: Counter = field(default_factory=Counter)
+    registers: dict[int, int] = field(default_factory=dict)
+
+    def add_user(self, user_id: str) -> None:
+        index, rank = hll.position(user_id)
+        if rank > self.registers.get(index, 0):
+            self.registers[index] = rank
+
+
+@dataclass
+class _UserBucket:
+    count: int = 0
+    events: Counter = field(default_factory=Counter)
+    first_seen: int = 0
+    last_seen: int = 0
+
+
+class _Aggregate:
+    """Rollup deltas for a set of events, merged before they are written."""
+
+    def __init__(self) -> None:
+        self.days: dict[str, _Bucket] = defaultdict(_Bucket)
+        self.day_events: dict[tuple[str, str], _Bucket] = defaultdict(_Bucket)
+        self.users: dict[str, _UserBucket] = {}
+
+    def add(self, data: Mapping[str, Any]) -> None:
+        name = _event_name(data)
+        timestamp = _timestamp(data)
+        day = timestamp.date().isoformat()
+        user_id = event_user_id(data)
+
+        bucket = self.days[day]
+        bucket.count += 1
+        bucket.events[name] += 1
+        event_bucket = self.day_events[(day, name)]
+        event_bucket.count += 1
+        if user_id is None:
+            return
+        bucket.user_count += 1
+        bucket.add_user(user_id)
+        event_bucket.add_user(user_id)
+
+        if not store.is_valid_document_id(user_id):
+            return
+        millis = int(timestamp.timestamp() * 1000)
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = _UserBucket(first_seen=millis, last_seen=millis)
+        user.count += 1
+        user.events[name] += 1
+        user.first_seen = min(user.first_seen, millis)
+        user.last_seen = max(user.last_seen, millis)
+
+    def write_count(self) -> int:
+        return len(self.days) + len(self.day_events) + len(self.users)
+
+    def max_transforms(self) -> int:
+        """The most field transforms that `writes` puts on one document."""
+        return max(
+            [2 + len(b.events) + len(b.registers) for b in self.days.values()]
+            + [1 + len(b.registers) for b in self.day_events.values()]
+            + [3 + len(u.events) for u in self.users.values()]
+        )
+
+    def writes(self, db: Any, shard: int) -> Iterable[tuple[Any, dict[str, Any]]]:
+        from google.cloud.firestore import Increment, Maximum, Minimum
+
+        def registers(bucket: _Bucket) -> dict[str, Any]:
+            return {str(i): Maximum(rank) for i, rank in bucket.registers.items()}
+
+        rollups = db.collection(store.ROLLUPS_COLLECTION)
+        for day, bucket in self.days.items():
+            ref = rollups.document(day).collection(DAY_SHARDS_SUBCOLLECTION).document(str(shard))
+            yield ref, {
+                "date": day,
+                "total": Increment(bucket.count),
+                "userEvents": Increment(bucket.user_count),
+                "events": {n: Increment(c) for n, c in bucket.events.items()},
+                "users": registers(bucket),
+            }
+        for (day, name), bucket in self.day_events.items():
+            ref = _event_shard(db, day, name, shard)
+            yield ref, {
+                "date": day,
+                "name": name,
+                "count": Increment(bucket.count),
+                "users": registers(bucket),
+            }
+        users = db.collection(store.USER_ROLLUPS_COLLECTION)
+        for user_id, user in self.users.items():
+            yield users.document(user_id), {
+                "total": Increment(user.count),
+                "events": {n: Increment(c) for n, c in user.events.items()},
+                "firstSeen": Minimum(user.first_seen),
+                "lastSeen": Maximum(user.last_seen),
+            }
+
+
+def _event_shard(db: Any, day: str, name: str, shard: int) -> Any:
+    return (
+        db.collection(store.ROLLUPS_COLLECTION)
+        .document(day)
+        .collection(EVENT_ROLLUPS_SUBCOLLECTION)
+        .document(name)
+        .collection(EVENT_SHARDS_SUBCOLLECTION)
+        .document(str(shard))
+    )
+
+
+def _commit(db: Any, events: list[tuple[str, Mapping[str, Any]]]) -> int:
+    """Applies `events` in one batch; returns how many were new.
+
+    If another writer already applied some of them, the marker create fails
+    the whole batch. The applied ids are then looked up and the remainder is
+    retried.
+    """
+    while events:
+        aggregate = _Aggregate()
+        for _, data in events:
+            aggregate.add(data)
+        if len(events) > 1 and (
+            len(events) + aggregate.write_count() > store.MAX_BATCH_WRITES
+            or aggregate.max_transforms() > _MAX_DOCUMENT_TRANSFORMS
+        ):
+            middle = len(events) // 2
+            return _commit(db, events[:middle]) + _commit(db, events[middle:])
+
+        applied_at = datetime.now(timezone.utc)
+        marker = {"appliedAt": applied_at, "expireAt": applied_at + APPLIED_MARKER_TTL}
+        markers = db.collection(store.APPLIED_COLLECTION)
+        batch = db.batch()
+        for event_id, _ in events:
+            batch.create(markers.document(event_id), marker)
+        for ref, data in aggregate.writes(db, random.randrange(ROLLUP_SHARDS)):
+            batch.set(ref, data, merge=True)
+        try:
+            batch.commit()
+            return len(events)
+        except Exception as exc:
+            if not store.is_already_exists(exc):
+                raise
+        if len(events) == 1:
+            return 0
+        refs = [markers.document(event_id) for event_id, _ in events]
+        applied = {snapshot.id for snapshot in db.get_all(refs) if snapshot.exists}
+        events = [(event_id, data) for event_id, data in events if event_id not in applied]
+    return 0
+
+
+def apply_event(db: Any, event_id: str, data: Mapping[str, Any]) -> bool:
+    """Folds one newly created event into the rollups (trigger entry point)."""
+    return _commit(db, [(event_id, data)]) == 1
+
+
+def backfill(db: Any, page_size: int = 100, start_after: Optional[str] = None) -> dict[str, int]:
+    """Streams every existing event in id order and applies it once.
+
+    Safe to rerun or resume from `start_after`; events that the trigger has
+    already applied are skipped.
+    """
+    query = db.collection(store.EVENTS_COLLECTION).order_by("__name__")
+    after = None if start_after is None else {"__name__": start_after}
+    scanned = applied = 0
+    for snapshots in concurrency.iter_pages(query, page_size, after):
+        page = [(snapshot.id, snapshot.to_dict() or {}) for snapshot in snapshots]
+        scanned += len(page)
+        applied += _commit(db, page)
+        cursor = page[-1][0]
+        logger.info("Backfilled through %s (%d scanned, %d applied)", cursor, scanned, applied)
+    return {"scanned": scanned, "applied": applied}
+
+
+class RollupReader:
+    """Answers the AnalyticsService queries from rollup documents."""
+
+    def __init__(self, db: Any) -> None:
+        self._db = db
+
+    def _days(self, start: Optional[date] = None, end: Optional[date] = None) -> list[dict]:
+        """One rollup per day, with the day's shards added together."""
+        query = self._db.collection_group(DAY_SHARDS_SUBCOLLECTION)
+        if start is not None:
+            query = query.where("date", ">=", start.isoformat())
+        if end is not None:
+            query = query.where("date", "<=", end.isoformat())
+        days: dict[str, dict[str, Any]] = {}
+        for snapshot in query.stream():
+            shard = snapshot.to_dict() or {}
+            day = days.get(shard["date"])
+            if day is None:
+                day = days[shard["date"]] = {
+                    "date": shard["date"],
+                    "total": 0,
+                    "userEvents": 0,
+                    "events": Counter(),
+                    "users": {},
+                }
+            day["total"] += shard.get("total", 0)
+            day["userEvents"] += shard.get("userEvents", 0)
+            day["events"].update(shard.get("events") or {})
+            users = day["users"]
+            for index, rank in (shard.get("users") or {}).items():
+                if rank > users.get(index, 0):
+                    users[index] = rank
+        return [days[key] for key in sorted(days)]
+
+    @staticmethod
+    def _unique(docs: Iterable[Mapping[str, Any]]) -> int:
+        sketch = hll.HyperLogLog()
+        for doc in docs:
+            sketch.merge_map(doc.get("users") or {})
+        return sketch.count()
+
+    def event_counts(self, start: date, end: date) -> dict[str, Any]:
+        """`getEventCounts` at day granularity, inclusive of both ends."""
+        days = self._days(start, end)
+        counts: Counter = Counter()
+        for day in days:
+            counts.update(day.get("events") or {})
+        return {
+            "total_events": sum(day.get("total", 0) for day in days),
+            "event_counts": dict(counts),
+            "unique_users": self._unique(days),
+        }
+
+    def study_metrics(self) -> dict[str, Any]:
+        """`getStudyMetrics`, whose rates the client leaves at 0.0, defined here.
+
+        `total_participants` counts distinct `parameters.userId`s.
+        `completion_rate` is the share of participants with an
+        `intake_completed` event. `average_engagement` is events per
+        participant, counting only events that carry a `userId`. Both are
+        ratios of HyperLogLog estimates.
+        """
+        days = self._days()
+        participants = self._unique(days)
+        user_events = sum(day["userEvents"] for day in days)
+        completed_event = FUNNEL_STAGES["intake_completed"]
+        completed_refs = [
+            _event_shard(self._db, day["date"], completed_event, shard)
+            for day in days
+            if day["events"].get(completed_event)
+            for shard in range(ROLLUP_SHARDS)
+        ]
+        completed = self._unique(
+            snapshot.to_dict() or {}
+            for snapshot in self._db.get_all(completed_refs)
+            if snapshot.exists
+        )
+        return {
+            "total_participants": participants,
+            "completion_rate": completed / participants if participants else 0.0,
+            "average_engagement": user_events / participants if participants else 0.0,
+            # The client has no definition of retention yet either.
+            "retention_rate": 0.0,
+        }
+
+    def conversion_funnel(self) -> dict[str, int]:
+        counts: Counter = Counter()
+        for day in self._days():
+            counts.update(day.get("events") or {})
+        return {stage: counts.get(event, 0) for stage, event in FUNNEL_STAGES.items()}
+
+    def user_summary(self, user_id: str) -> dict[str, Any]:
+        snapshot = self._db.collection(store.USER_ROLLUPS_COLLECTION).document(user_id).get()
+        return snapshot.to_dict() or {}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Analytics rollup maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = commands.add_parser("backfill", help="apply existing events")
+    backfill_parser.add_argument("--page-size", type=int, default=100)
+    backfill_parser.add_argument("--start-after", default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    result = backfill(store.get_firestore(), args.page_size, args.start_after)
+    print(f"scanned {result['scanned']:,} events, applied {result['applied']:,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Local load and throughput harnesses for the Python functions."""
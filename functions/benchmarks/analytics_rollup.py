@@ -0,0 +1,145 @@
+"""Rollup reads versus the AnalyticsService full-scan path.
+
+Seeds synthetic `analytics_events`, backfills the rollups, then answers
+`getEventCounts`, `getStudyMetrics` and `getConversionFunnel` both ways and
+reports document reads, wall time and the HyperLogLog error. The study
+metrics' rates must agree with the full scan to within 5%:
+
+    python -m benchmarks.analytics_rollup --events 50000 --users 2000 --days 60
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import time
+from collections import Counter
+from datetime import date, datetime, time as day_time, timedelta, timezone
+
+import analytics_rollup
+from analytics_rollup import FUNNEL_STAGES, RollupReader, event_user_id
+from store import EVENTS_COLLECTION, MAX_BATCH_WRITES
+from benchmarks.common import make_client
+
+EVENT_NAMES = list(FUNNEL_STAGES.values()) + [
+    "message_interaction",
+    "quick_reply_used",
+    "screen_view",
+    "notification_interaction",
+]
+
+
+def seed(db, events: int, users: int, days: int, start: date) -> None:
+    rng = random.Random(7)
+    origin = datetime.combine(start, day_time(), timezone.utc)
+    collection = db.collection(EVENTS_COLLECTION)
+    batch = db.batch()
+    for index in range(events):
+        parameters = {"userId": f"user-{rng.randrange(users)}"}
+        if rng.random() < 0.1:
+            parameters = {}
+        batch.set(
+            collection.document(f"event-{index:08d}"),
+            {
+                "eventName": rng.choice(EVENT_NAMES),
+                "parameters": parameters,
+                "timestamp": origin + timedelta(seconds=rng.randrange(days * 86_400)),
+            },
+        )
+        if len(batch) == MAX_BATCH_WRITES:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+
+
+def full_scan_counts(db, start: date, end: date) -> dict:
+    """The `getEventCounts` query, widened to whole days."""
+    low = datetime.combine(start, day_time(), timezone.utc)
+    high = datetime.combine(end + timedelta(days=1), day_time(), timezone.utc)
+    docs = [
+        s.to_dict()
+        for s in db.collection(EVENTS_COLLECTION)
+        .where("timestamp", ">=", low)
+        .where("timestamp", "<", high)
+        .stream()
+    ]
+    users = {(d.get("parameters") or {}).get("userId") for d in docs} - {None}
+    return {
+        "total_events": len(docs),
+        "event_counts": dict(Counter(d["eventName"] for d in docs)),
+        "unique_users": len(users),
+    }
+
+
+def full_scan_study(db) -> dict:
+    """`getStudyMetrics` with the rates `RollupReader.study_metrics` defines."""
+    docs = [s.to_dict() for s in db.collection(EVENTS_COLLECTION).stream()]
+    user_events = [(d, event_user_id(d)) for d in docs if event_user_id(d)]
+    users = {user_id for _, user_id in user_events}
+    completed = {u for d, u in user_events if d["eventName"] == FUNNEL_STAGES["intake_completed"]}
+    counts = Counter(d["eventName"] for d in docs)
+    return {
+        "total_participants": len(users),
+        "completion_rate": len(completed) / len(users) if users else 0.0,
+        "average_engagement": len(user_events) / len(users) if users else 0.0,
+        "funnel": {stage: counts.get(event, 0) for stage, event in FUNNEL_STAGES.items()},
+    }
+
+
+def _timed(db, fn, *args):
+    db.reset_counters()
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, db.reads, (time.perf_counter() - started) * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=50_000)
+    parser.add_argument("--users", type=int, default=2_000)
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--page-size", type=int, default=100)
+    args = parser.parse_args()
+
+    db = make_client(use_emulator=False)
+    start = date(2025, 1, 1)
+    end = start + timedelta(days=args.days - 1)
+    seed(db, args.events, args.users, args.days, start)
+
+    started = time.perf_counter()
+    result = analytics_rollup.backfill(db, args.page_size)
+    print(f"backfill: {result['applied']:,} events in {time.perf_counter() - started:.1f}s")
+
+    reader = RollupReader(db)
+    window_end = start + timedelta(days=6)
+    rows = [
+        ("event counts (7 days)", (full_scan_counts, db, start, window_end), (reader.event_counts, start, window_end)),
+        ("event counts (all)", (full_scan_counts, db, start, end), (reader.event_counts, start, end)),
+        ("study metrics", (full_scan_study, db), (reader.study_metrics,)),
+        ("conversion funnel", (full_scan_study, db), (reader.conversion_funnel,)),
+    ]
+    print(f"{'query':<24}{'scan reads':>12}{'rollup reads':>14}{'scan ms':>10}{'rollup ms':>11}  check")
+    for label, scan_call, rollup_call in rows:
+        scan, scan_reads, scan_ms = _timed(db, *scan_call)
+        rollup, rollup_reads, rollup_ms = _timed(db, *rollup_call)
+        if "event_counts" in rollup:
+            assert rollup["event_counts"] == scan["event_counts"]
+            assert rollup["total_events"] == scan["total_events"]
+            exact, estimate = scan["unique_users"], rollup["unique_users"]
+        elif "total_participants" in rollup:
+            exact, estimate = scan["total_participants"], rollup["total_participants"]
+            # Both rates divide by the estimated participants.
+            for rate in ("completion_rate", "average_engagement"):
+                assert abs(rollup[rate] - scan[rate]) <= 0.05 * scan[rate], rate
+        else:
+            assert rollup == scan["funnel"]
+            exact = estimate = 1
+        error = abs(estimate - exact) / exact * 100 if exact else 0.0
+        print(
+            f"{label:<24}{scan_reads:>12,}{rollup_reads:>14,}{scan_ms:>10.1f}{rollup_ms:>11.1f}"
+            f"  uniques off by {error:.2f}%"
+        )
+
+
+if __name__ == "__main__":
+    main()
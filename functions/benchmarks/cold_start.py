@@ -0,0 +1,108 @@
+"""Cold-start import cost of `main` for each deployed function.
+
+Imports `main` in a fresh interpreter under `-X importtime`, once per
+function, with `FUNCTION_TARGET` set the way the runtime sets it. It reports
+the best of `--repeat` runs and the heaviest direct imports. It fails (exit 1)
+if a function's import goes over `--budget-ms`, or if an HTTP or scheduled
+function loads the gRPC Firestore stack at import time:
+
+    python -m benchmarks.cold_start --budget-ms 700 --repeat 5
+
+Most of the floor is `firebase_functions.https_fn` itself, which pulls in
+Flask and the Admin SDK's auth module (about 400ms on a laptop). Loading
+google-cloud-firestore and grpc on top of that added about 300ms.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import subprocess
+import sys
+from typing import Optional
+
+FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = (
+    "mobile",
+    "health_check",
+    "history_page",
+    "preview_link",
+    "deliver_scheduled_messages",
+    "keep_warm",
+    "rollup_analytics_event",
+)
+# Only the Firestore trigger may pay for these before its first event.
+HEAVY_MODULES = ("grpc", "google.cloud.firestore_v1", "google.protobuf", "aiohttp")
+ALLOWED_HEAVY = {"rollup_analytics_event"}
+
+
+def import_profile(target: Optional[str]) -> list[tuple[int, int, int, str]]:
+    """Returns `(depth, self_us, cumulative_us, module)` rows for `import main`."""
+    env = dict(os.environ)
+    env.pop("FUNCTION_TARGET", None)
+    if target:
+        env["FUNCTION_TARGET"] = target
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=FUNCTIONS_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((depth, int(self_us), int(cumulative_us), name.strip()))
+    return rows
+
+
+Measurement = tuple[float, list[tuple[int, str]], set[str]]
+
+
+def measure(target: Optional[str], repeat: int) -> Measurement:
+    """Best-of-`repeat` import time in ms, top direct imports and heavy modules."""
+    best: Optional[Measurement] = None
+    for _ in range(repeat):
+        rows = import_profile(target)
+        total = next(cum for depth, _, cum, name in rows if depth == 0 and name == "main")
+        # Children are printed before their parent, so main's direct imports
+        # are the depth-1 rows.
+        children = sorted(
+            ((cum, name) for depth, _, cum, name in rows if depth == 1), reverse=True
+        )
+        loaded = {name for _, _, _, name in rows}
+        heavy = {m for m in HEAVY_MODULES if m in loaded}
+        if best is None or total / 1000 < best[0]:
+            best = (total / 1000, children[:3], heavy)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=700.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--targets", nargs="+", default=list(TARGETS))
+    args = parser.parse_args()
+
+    failures = []
+    print(f"{'function':<28}{'import ms':>10}  heaviest direct imports")
+    for target in args.targets:
+        total_ms, children, heavy = measure(target, args.repeat)
+        top = ", ".join(f"{name} {cum / 1000:.0f}ms" for cum, name in children)
+        print(f"{target:<28}{total_ms:>10.1f}  {top}")
+        if total_ms > args.budget_ms:
+            failures.append(f"{target}: {total_ms:.0f}ms is over {args.budget_ms:.0f}ms")
+        if heavy and target not in ALLOWED_HEAVY:
+            failures.append(f"{target}: loads {', '.join(sorted(heavy))} at import time")
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Helpers shared by the benchmark harnesses."""
+
+from __future__ import annotations
+
+import os
+import sys
+from typing import Any, Sequence
+
+import tracing
+
+
+def percentile(samples: Sequence[float], pct: float) -> float:
+    """Nearest-rank percentile of `samples` (0 for an empty sequence)."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def quiet_traces() -> None:
+    """Keeps stdout for the report: no sampled traces, slow ones to stderr."""
+    tracing.SAMPLE_RATE = 0.0
+    tracing.set_sink(lambda line: print(line, file=sys.stderr))
+
+
+def make_client(use_emulator: bool, commit_latency: float = 0.0) -> Any:
+    """Returns an emulator-backed client or an in-memory fake."""
+    if use_emulator:
+        if "FIRESTORE_EMULATOR_HOST" not in os.environ:
+            raise SystemExit("FIRESTORE_EMULATOR_HOST is not set")
+        from google.cloud import firestore
+
+        return firestore.Client(project=os.environ.get("GCLOUD_PROJECT", "demo-quitxt"))
+    from testing.fake_firestore import FakeFirestore
+
+    return FakeFirestore(commit_latency=commit_latency)
+
+
+def rss_mb() -> float:
+    """Current resident set size in MiB (peak RSS where /proc is missing)."""
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
@@ -0,0 +1,50 @@
+"""Memory and per-check cost of the local dedup set at millions of ids.
+
+Feeds unique uuid-shaped ids through `RecentIds` and samples resident memory
+along the way. Once the bound is reached, RSS should stay flat:
+
+    python -m benchmarks.dedup_memory --ids 5000000 --max-entries 200000
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+import uuid
+
+from benchmarks.common import rss_mb
+from dedup import RecentIds
+
+
+def run(args: argparse.Namespace) -> list[tuple[int, float, float]]:
+    recent = RecentIds(max_entries=args.max_entries, ttl=args.ttl)
+    samples = []
+    step = max(1, args.ids // args.samples)
+    started = time.perf_counter()
+    for index in range(1, args.ids + 1):
+        key = str(uuid.UUID(int=index))
+        recent.add(key)
+        if key not in recent:
+            raise AssertionError("fresh id was evicted immediately")
+        if index % step == 0:
+            elapsed = time.perf_counter() - started
+            samples.append((index, rss_mb(), elapsed / index * 1e9))
+    if recent.add(str(uuid.UUID(int=args.ids))):
+        raise AssertionError("most recent id was not detected as a duplicate")
+    return samples
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ids", type=int, default=3_000_000)
+    parser.add_argument("--max-entries", type=int, default=200_000)
+    parser.add_argument("--ttl", type=float, default=600.0)
+    parser.add_argument("--samples", type=int, default=10)
+    args = parser.parse_args()
+    print(f"{'ids':>12} {'rss_mb':>8} {'ns/add+check':>13}")
+    for count, rss, per_op in run(args):
+        print(f"{count:>12,} {rss:>8.1f} {per_op:>13.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Campaign fan-out throughput against the local FCM stub.
+
+Registers a synthetic cohort, then pushes one campaign at several in-flight
+limits and reports sends/sec. Each stubbed multicast sleeps for
+`--latency-ms` to stand in for the FCM round trip:
+
+    python -m benchmarks.fcm_fanout --users 50000 --latency-ms 150
+"""
+
+from __future__ import annotations
+
+import argparse
+import warnings
+
+import fcm_fanout
+import store
+from benchmarks.common import make_client
+from testing.fake_fcm import FakeFcm
+
+
+def seed(db, users: int) -> None:
+    tokens = db.collection(store.TOKENS_COLLECTION)
+    batch = db.batch()
+    for index in range(users):
+        batch.set(tokens.document(f"user-{index:07d}"), {"token": f"token-{index}"})
+        if len(batch) == store.MAX_BATCH_WRITES:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--latency-ms", type=float, default=150.0)
+    parser.add_argument("--invalid-pct", type=float, default=2.0)
+    parser.add_argument("--in-flight", type=int, nargs="+", default=[1, 4, 16])
+    args = parser.parse_args()
+    warnings.simplefilter("ignore", DeprecationWarning)
+
+    step = int(100 / args.invalid_pct) if args.invalid_pct else 0
+    notification = fcm_fanout.Notification.create("QuitTXT", "Campaign message")
+    print(f"{'in-flight':>9}{'sent':>10}{'pruned':>8}{'multicasts':>12}{'seconds':>9}{'sends/sec':>11}")
+    for in_flight in args.in_flight:
+        db = make_client(use_emulator=False)
+        seed(db, args.users)
+        invalid = {f"token-{i}" for i in range(0, args.users, step)} if step else set()
+        fcm = FakeFcm(latency=args.latency_ms / 1000, unregistered=invalid)
+        service = fcm_fanout.FanoutService(lambda: db, fcm, max_in_flight=in_flight)
+        stats = service.push_campaign(notification)
+        print(
+            f"{in_flight:>9}{stats.sent:>10,}{stats.pruned:>8,}{stats.multicasts:>12,}"
+            f"{stats.elapsed:>9.2f}{stats.sends_per_sec:>11,.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Load test for the `/api/mobile` ingest path.
+
+Fires `sendMessage`-shaped payloads from concurrent sender threads, timing
+each ack, then waits for the pipeline to drain and reports ack latency and
+end-to-end write throughput:
+
+    python -m benchmarks.ingest_load --messages 20000 --commit-latency-ms 20
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python -m benchmarks.ingest_load --emulator
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import ingest
+from benchmarks.common import make_client, percentile, quiet_traces
+
+
+def _payload(index: int, users: int) -> dict:
+    return {
+        "messageId": str(uuid.uuid4()),
+        "userId": f"user-{index % users}",
+        "messageText": f"load test message {index}",
+        "fcmToken": f"token-{index % users}",
+        "messageTime": int(time.time()),
+        "eventTypeCode": 1,
+    }
+
+
+def run(args: argparse.Namespace) -> dict:
+    client = make_client(args.emulator, args.commit_latency_ms / 1000)
+    pipeline = ingest.IngestPipeline(
+        lambda: client,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        max_pending=args.messages,
+    )
+    pipeline.start()
+    payloads = [_payload(i, args.users) for i in range(args.messages)]
+
+    def send(chunk: list[dict]) -> list[float]:
+        latencies = []
+        for payload in chunk:
+            started = time.perf_counter()
+            _, status = ingest.handle_ingest(payload, pipeline)
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                raise RuntimeError(f"ingest returned {status}")
+        return latencies
+
+    chunks = [payloads[i :: args.senders] for i in range(args.senders)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.senders) as senders:
+        latencies = [lat for result in senders.map(send, chunks) for lat in result]
+    acked = time.perf_counter() - started
+    pipeline.flush()
+    drained = time.perf_counter() - started
+    pipeline.stop()
+
+    return {
+        "messages": args.messages,
+        "ack_p50_ms": percentile(latencies, 50) * 1000,
+        "ack_p99_ms": percentile(latencies, 99) * 1000,
+        "acks_per_sec": args.messages / acked,
+        "written_per_sec": pipeline.stats.written / drained,
+        "batches": pipeline.stats.batches,
+        "failed": pipeline.stats.failed,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--senders", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--commit-latency-ms", type=float, default=20.0)
+    parser.add_argument("--emulator", action="store_true")
+    args = parser.parse_args()
+    quiet_traces()
+    report = run(args)
+    for key, value in report.items():
+        print(f"{key:>16}: {value:,.2f}" if isinstance(value, float) else f"{key:>16}: {value:,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Link preview latency and bytes against a local fixture site.
+
+Serves a set of article pages with a large body, then requests previews the
+way a chat cohort would: each URL is opened by `--readers` users at once.
+A second pass repeats every lookup against the warm cache. Reports fetches,
+bytes read versus full page size, and p50/p95 latency for both passes:
+
+    python -m benchmarks.link_preview --urls 50 --readers 20 --delay-ms 150
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import link_preview
+from benchmarks.common import make_client, percentile
+from testing.fixture_http import FixturePage, FixtureServer
+
+
+def page(index: int, body_kb: int) -> bytes:
+    head = (
+        f"<html><head><title>Article {index}</title>"
+        f'<meta property="og:title" content="Coaching tip {index}">'
+        f'<meta property="og:description" content="How to get through day {index}">'
+        f'<meta property="og:image" content="/img/{index}.png"></head>'
+    ).encode()
+    return head + b"<body><p>" + b"x" * (body_kb * 1024) + b"</p></body></html>"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--urls", type=int, default=50)
+    parser.add_argument("--readers", type=int, default=20)
+    parser.add_argument("--delay-ms", type=float, default=150.0)
+    parser.add_argument("--body-kb", type=int, default=512)
+    args = parser.parse_args()
+
+    db = make_client(use_emulator=False)
+    service = link_preview.PreviewService(lambda: db, allow_private=True)
+    with FixtureServer() as server, ThreadPoolExecutor(args.readers) as pool:
+        for index in range(args.urls):
+            server.pages[f"/a/{index}"] = FixturePage(
+                page(index, args.body_kb), delay=args.delay_ms / 1000
+            )
+
+        def open_link(url: str) -> float:
+            started = time.perf_counter()
+            service.preview(url)
+            return (time.perf_counter() - started) * 1000
+
+        latencies: dict[str, list[float]] = {}
+        started = time.perf_counter()
+        for label in ("cold", "warm"):
+            latencies[label] = []
+            for index in range(args.urls):
+                url = server.url(f"/a/{index}")
+                latencies[label].extend(pool.map(open_link, [url] * args.readers))
+        elapsed = time.perf_counter() - started
+        service.stop()
+
+    stats = service.stats
+    full_bytes = args.urls * len(page(0, args.body_kb))
+    print(f"previews     {2 * args.urls * args.readers:,} in {elapsed:.2f}s")
+    print(f"fetches      {stats.fetches:,} (coalesced {stats.coalesced:,}, hits {stats.memory_hits:,})")
+    print(f"bytes read   {stats.bytes_fetched / 1024:,.0f} KiB of {full_bytes / 1024:,.0f} KiB served")
+    for kind, samples in latencies.items():
+        print(
+            f"{kind:<12} p50 {percentile(samples, 50):8.2f} ms"
+            f"   p95 {percentile(samples, 95):8.2f} ms   n={len(samples):,}"
+        )
+
+
+if __name__ == "__main__":
+    main()
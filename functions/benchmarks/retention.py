@@ -0,0 +1,147 @@
+"""Export and compaction throughput on a synthetic message history.
+
+Seeds `--messages` chat messages spread over `--users` users and `--days`
+days, plus `--events` analytics events. It then runs the retention
+compaction and a full export to a temporary directory, and reports docs/sec
+and the peak RSS growth of each phase:
+
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python -m benchmarks.retention --emulator
+    python -m benchmarks.retention --messages 1000000 --users 10000
+
+Without `--emulator` the in-memory fake stands in. The fake keeps a sorted
+index per query, so the export queries are primed before its RSS baseline
+is taken; otherwise the index would be charged to the pipeline. The
+compaction's growth includes the archive documents the fake itself holds.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import retention
+import store
+from benchmarks.common import make_client, rss_mb
+
+
+class PeakRss:
+    """Samples RSS on a thread and keeps the largest growth over the baseline."""
+
+    def __init__(self, interval: float = 0.05) -> None:
+        self._interval = interval
+        self._stop = threading.Event()
+        self.baseline = rss_mb()
+        self.peak = self.baseline
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self._interval):
+            self.peak = max(self.peak, rss_mb())
+
+    def __enter__(self) -> "PeakRss":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_mb())
+
+    @property
+    def growth(self) -> float:
+        return self.peak - self.baseline
+
+
+def seed(db, messages: int, users: int, events: int, days: int, now: datetime) -> None:
+    rng = random.Random(11)
+    span = timedelta(days=days).total_seconds()
+    batch = db.batch()
+    for index in range(messages):
+        user_id = f"bench-user-{index % users:06d}"
+        created = now - timedelta(seconds=rng.random() * span)
+        batch.set(
+            store.chat_collection(db, user_id).document(f"m-{index:08d}"),
+            {
+                "messageBody": f"Synthetic message {index} about cravings and triggers",
+                "source": "client" if index % 2 else "server",
+                "senderId": user_id if index % 2 else "server",
+                "serverMessageId": f"m-{index:08d}",
+                "eventTypeCode": 1,
+                "createdAt": created,
+            },
+        )
+        if len(batch) == store.MAX_BATCH_WRITES:
+            batch.commit()
+            batch = db.batch()
+    events_collection = db.collection(store.EVENTS_COLLECTION)
+    for index in range(events):
+        batch.set(
+            events_collection.document(f"event-{index:08d}"),
+            {
+                "eventName": "message_interaction",
+                "parameters": {"userId": f"bench-user-{rng.randrange(users):06d}"},
+                "timestamp": now - timedelta(seconds=rng.random() * span),
+            },
+        )
+        if len(batch) == store.MAX_BATCH_WRITES:
+            batch.commit()
+            batch = db.batch()
+    if len(batch):
+        batch.commit()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--events", type=int, default=100_000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--retention-days", type=int, default=90)
+    parser.add_argument("--page-size", type=int, default=retention.DEFAULT_PAGE_SIZE)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--emulator", action="store_true")
+    parser.add_argument("--commit-latency-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    db = make_client(args.emulator, args.commit_latency_ms / 1000)
+    now = datetime.now(timezone.utc)
+    started = time.perf_counter()
+    seed(db, args.messages, args.users, args.events, args.days, now)
+    print(f"seeded       {args.messages:,} messages, {args.events:,} events "
+          f"in {time.perf_counter() - started:.1f}s")
+
+    with PeakRss() as memory:
+        compacted = retention.compact(
+            db,
+            retention=timedelta(days=args.retention_days),
+            now=now,
+            page_size=args.page_size,
+            workers=args.workers,
+        )
+    print(f"compact      {compacted.archived:,} messages into {compacted.chunks:,} chunks "
+          f"in {compacted.elapsed:.1f}s")
+    print(f"             {compacted.docs_per_sec:,.0f} docs/sec, "
+          f"peak RSS {memory.peak:,.0f} MiB (+{memory.growth:.0f})")
+
+    for group in (store.CHAT_SUBCOLLECTION, store.CHAT_ARCHIVE_SUBCOLLECTION):
+        list(db.collection_group(group).order_by("__name__").limit(1).stream())
+    list(db.collection(store.EVENTS_COLLECTION).order_by("__name__").limit(1).stream())
+    with tempfile.TemporaryDirectory() as out:
+        with PeakRss() as memory:
+            exported = retention.export(db, out, page_size=args.page_size)
+        size = sum(os.path.getsize(os.path.join(out, name)) for name in os.listdir(out))
+    print(f"export       {exported.chat:,} messages ({exported.archived:,} archived) and "
+          f"{exported.events:,} events in {exported.elapsed:.1f}s")
+    print(f"             {exported.docs_per_sec:,.0f} docs/sec, "
+          f"peak RSS {memory.peak:,.0f} MiB (+{memory.growth:.0f})")
+    print(f"             {exported.shards} shards, {exported.bytes / 2**20:,.0f} MiB NDJSON "
+          f"-> {size / 2**20:,.0f} MiB gzip")
+
+
+if __name__ == "__main__":
+    main()
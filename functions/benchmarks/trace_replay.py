@@ -0,0 +1,221 @@
+"""Replays a recorded message workload and reports latency per stage.
+
+Each message is posted to `ingest.handle_ingest` at its recorded offset.
+A collection-group listener on `chat` stands in for the app's listener and
+times when each `serverMessageId` arrives. The report gives p50/p95/p99 for
+the client-side stages (`client.ack`, `client.delivery`) and for every
+server stage that `tracing` records:
+
+    python -m retention export --out /tmp/export
+    python -m benchmarks.trace_replay --workload '/tmp/export/chat-*.ndjson.gz' --speedup 60
+    python -m benchmarks.trace_replay --messages 5000 --rate 200 --commit-latency-ms 20
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python -m benchmarks.trace_replay --emulator
+
+A workload is the `chat` shards of a retention export. Only the users'
+own messages are replayed, at their recorded gaps divided by `--speedup`.
+Without `--workload`, Poisson arrivals at `--rate` per second are
+generated. The run fails (exit 1) if the p95 of `client.delivery` is over
+`--budget-ms`. The in-memory fake delivers listener events as soon as the
+commit applies, so only the emulator gives a real `client.delivery`.
+"""
+
+from __future__ import annotations
+
+import argparse
+import glob
+import gzip
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import dedup
+import fcm_fanout
+import ingest
+import store
+import tracing
+from benchmarks.common import make_client, quiet_traces
+
+CLIENT_STAGES = ("client.ack", "client.delivery")
+
+
+def _seconds(data: dict) -> float | None:
+    created_at = data.get("createdAt")
+    if isinstance(created_at, str):
+        return datetime.fromisoformat(created_at.replace("Z", "+00:00")).timestamp()
+    client_timestamp = data.get("clientTimestamp")
+    if isinstance(client_timestamp, (int, float)):
+        return client_timestamp / 1000
+    return None
+
+
+def load_workload(pattern: str, limit: int, speedup: float) -> list[tuple[float, dict]]:
+    """`(offset seconds, payload)` for the users' own messages in export shards."""
+    recorded = []
+    for path in sorted(glob.glob(pattern)):
+        with gzip.open(path, "rt") as lines:
+            for line in lines:
+                record = json.loads(line)
+                data = record.get("data") or {}
+                at = _seconds(data)
+                if data.get("source") != "client" or at is None or not data.get("messageBody"):
+                    continue
+                recorded.append((at, record["userId"], data))
+    recorded.sort(key=lambda row: row[0])
+    recorded = recorded[:limit]
+    if not recorded:
+        raise SystemExit(f"no client messages in {pattern}")
+    origin = recorded[0][0]
+    return [
+        (
+            (at - origin) / speedup,
+            {
+                # Fresh ids, so a replay never collides with the recorded documents.
+                "messageId": str(uuid.uuid4()),
+                "userId": user_id,
+                "messageText": str(data["messageBody"]),
+                "fcmToken": f"replay-{user_id}",
+                "messageTime": int(at),
+                "eventTypeCode": data.get("eventTypeCode") or 1,
+            },
+        )
+        for at, user_id, data in recorded
+    ]
+
+
+def synthetic_workload(messages: int, users: int, rate: float) -> list[tuple[float, dict]]:
+    rng = random.Random(3)
+    offset, workload = 0.0, []
+    for index in range(messages):
+        offset += rng.expovariate(rate)
+        user_id = f"replay-user-{rng.randrange(users):05d}"
+        workload.append(
+            (
+                offset,
+                {
+                    "messageId": str(uuid.uuid4()),
+                    "userId": user_id,
+                    "messageText": f"replayed message {index}",
+                    "fcmToken": f"replay-{user_id}",
+                    "messageTime": int(time.time()),
+                    "eventTypeCode": 1,
+                },
+            )
+        )
+    return workload
+
+
+def replay(db, workload: list[tuple[float, dict]], senders: int, drain_timeout: float) -> int:
+    """Plays `workload` in real time; returns how many deliveries were seen."""
+    sent_at: dict[str, float] = {}
+    sent_lock = threading.Lock()
+    delivered = threading.Semaphore(0)
+
+    def on_snapshot(docs, changes, read_time) -> None:
+        now = time.perf_counter()
+        for change in changes:
+            if change.type.name == "REMOVED":
+                continue
+            message_id = (change.document.to_dict() or {}).get("serverMessageId")
+            with sent_lock:
+                started = sent_at.pop(message_id, None)
+            if started is not None:
+                tracing.observe("client.delivery", now - started)
+                delivered.release()
+
+    pipeline = ingest.IngestPipeline(
+        lambda: db,
+        deduper=dedup.MessageDeduper(),
+        token_registry=fcm_fanout.TokenRegistry(),
+        max_pending=len(workload),
+    )
+    pipeline.start()
+    watch = db.collection_group(store.CHAT_SUBCOLLECTION).on_snapshot(on_snapshot)
+
+    def send(payload: dict) -> None:
+        started = time.perf_counter()
+        with sent_lock:
+            sent_at[payload["messageId"]] = started
+        # As from an app build that sends its ID token.
+        _, status = ingest.handle_ingest(payload, pipeline, uid=payload["userId"])
+        tracing.observe("client.ack", time.perf_counter() - started)
+        if status != 200:
+            raise RuntimeError(f"ingest returned {status}")
+
+    try:
+        origin = time.perf_counter()
+        with ThreadPoolExecutor(senders, thread_name_prefix="replay") as pool:
+            futures = []
+            for offset, payload in workload:
+                wait = origin + offset - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                futures.append(pool.submit(send, payload))
+            for future in futures:
+                future.result()
+        pipeline.flush(drain_timeout)
+        deadline = time.monotonic() + drain_timeout
+        seen = 0
+        while seen < len(workload):
+            if not delivered.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                break
+            seen += 1
+        return seen
+    finally:
+        watch.unsubscribe()
+        pipeline.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workload", help="glob of chat export shards to replay")
+    parser.add_argument("--speedup", type=float, default=1.0)
+    parser.add_argument("--messages", type=int, default=5_000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=200.0, help="synthetic messages/sec")
+    parser.add_argument("--senders", type=int, default=16)
+    parser.add_argument("--commit-latency-ms", type=float, default=20.0)
+    parser.add_argument("--drain-timeout", type=float, default=30.0)
+    parser.add_argument("--budget-ms", type=float, default=1_000.0)
+    parser.add_argument("--emulator", action="store_true")
+    args = parser.parse_args()
+
+    if args.workload:
+        workload = load_workload(args.workload, args.messages, args.speedup)
+    else:
+        workload = synthetic_workload(args.messages, args.users, args.rate)
+    db = make_client(args.emulator, args.commit_latency_ms / 1000)
+    tracing.REGISTRY.clear()
+    quiet_traces()
+    started = time.perf_counter()
+    delivered = replay(db, workload, args.senders, args.drain_timeout)
+    elapsed = time.perf_counter() - started
+    print(f"replayed {len(workload):,} messages in {elapsed:.1f}s, {delivered:,} delivered")
+
+    print(f"{'stage':<24}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    stages = tracing.REGISTRY.stages()
+    order = ["client.ack", *(s for s in stages if s not in CLIENT_STAGES), "client.delivery"]
+    for name in order:
+        histogram = stages.get(name)
+        if histogram is None or not histogram.count:
+            continue
+        p50, p95, p99 = (histogram.quantile(q) * 1000 for q in (0.5, 0.95, 0.99))
+        print(f"{name:<24}{histogram.count:>8,}{p50:>10.2f}{p95:>10.2f}{p99:>10.2f}")
+
+    failures = []
+    if delivered < len(workload):
+        failures.append(f"{len(workload) - delivered:,} messages were never delivered")
+    delivery = stages.get("client.delivery")
+    if delivery is not None and delivery.quantile(0.95) * 1000 > args.budget_ms:
+        failures.append(f"client.delivery p95 is over {args.budget_ms:.0f}ms")
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
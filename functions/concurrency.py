@@ -0,0 +1,97 @@
+"""Paging, bounded submission and retries shared by the batch pipelines.
+
+Export, compaction, the rollup backfill, campaign fan-out and scheduled
+delivery all read Firestore a page at a time and hand the work to a thread
+pool. `iter_pages` reads the next page while the caller works on the
+current one. `BoundedExecutor.submit` blocks once enough tasks are
+unfinished, so a producer only reads as fast as the pool keeps up and
+memory stays flat. `retry` and `backoff` space out the attempts of a
+failed commit or send.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterator, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def iter_pages(query: Any, page_size: int, start_after: Any = None) -> Iterator[list]:
+    """Yields the results of an ordered `query` in pages, reading one page ahead.
+
+    Pages are chained with `start_after` on the last snapshot, so at most two
+    pages are held at once. `start_after` resumes after a snapshot or a
+    `{"__name__": id}` cursor.
+    """
+
+    def read(after: Any) -> list:
+        page_query = query if after is None else query.start_after(after)
+        return list(page_query.limit(page_size).stream())
+
+    with ThreadPoolExecutor(1, thread_name_prefix="read-ahead") as pool:
+        pending: Optional[Future] = pool.submit(read, start_after)
+        while pending is not None:
+            page = pending.result()
+            pending = pool.submit(read, page[-1]) if len(page) == page_size else None
+            if page:
+                yield page
+
+
+class BoundedExecutor:
+    """Thread pool whose `submit` blocks while `max_pending` tasks are unfinished."""
+
+    def __init__(
+        self, workers: int, max_pending: Optional[int] = None, thread_name_prefix: str = ""
+    ) -> None:
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix=thread_name_prefix)
+        self._slots = threading.BoundedSemaphore(max_pending or workers)
+
+    def submit(self, fn: Callable[..., T], *args: Any) -> "Future[T]":
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._pool.shutdown(wait=wait)
+
+    def __enter__(self) -> "BoundedExecutor":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.shutdown()
+
+
+def backoff(attempt: int, base: float) -> None:
+    """Sleeps `base * 2**attempt` seconds after failed attempt `attempt`."""
+    time.sleep(base * 2**attempt)
+
+
+def retry(
+    fn: Callable[[], T],
+    *,
+    attempts: int,
+    base: float,
+    retryable: Callable[[BaseException], bool] = lambda exc: True,
+    what: str = "Call",
+) -> T:
+    """Calls `fn` up to `attempts` times, backing off between retryable failures."""
+    for attempt in range(1, attempts + 1):
+        try:
+            return fn()
+        except Exception as exc:
+            if attempt == attempts or not retryable(exc):
+                raise
+            logger.warning("%s failed (attempt %d/%d), retrying", what, attempt, attempts)
+            backoff(attempt, base)
+    raise ValueError("attempts must be at least 1")
@@ -0,0 +1,22 @@
+"""Thread-safe counters for the pipelines' `*Stats` dataclasses."""
+
+from __future__ import annotations
+
+import threading
+
+
+class Counters:
+    """Base for a stats dataclass whose fields several threads increment.
+
+    `add(written=3, batches=1)` applies every increment under one lock, so
+    a reader never sees half of an update. The lock is not a dataclass
+    field, so it stays out of `repr`, comparisons and `asdict`.
+    """
+
+    def __post_init__(self) -> None:
+        self._lock = threading.Lock()
+
+    def add(self, **counts: int) -> None:
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
@@ -0,0 +1,120 @@
+"""Idempotency for `messageId` across client retries and double-writes.
+
+The app stores the user message itself, retries the POST on timeout and can
+resend after the http->https fallback in `_testConnectionInBackground`, so
+the same `messageId` reaches the backend more than once. Each instance keeps
+a bounded, TTL-evicting set of recently seen ids for an O(1) check on the
+request path. Ids that pass it get a `processedMessages/{messageId}`
+marker created in the same batch as their chat write, so a marker exists
+exactly when its message was written. A duplicate that landed on a
+different instance fails that batch with ALREADY_EXISTS, and the caller
+drops the claimed ids and commits the rest.
+
+Configure a Firestore TTL policy on `processedMessages.expireAt` so markers
+are cleaned up server-side.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Iterable, Optional
+
+import store
+
+
+class RecentIds:
+    """Bounded set of ids that forgets entries after `ttl` seconds.
+
+    Every entry shares the same TTL, so insertion order is expiry order: a
+    deque records that order and eviction only ever pops from its left end.
+    Expired entries are purged before each insert. An id that is discarded
+    and re-added can be forgotten early when its older deque slot is popped,
+    which only costs a marker lookup.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 200_000,
+        ttl: float = 600.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._clock = clock
+        self._expiry: dict[str, float] = {}
+        self._order: deque[str] = deque()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._expiry)
+
+    def __contains__(self, key: str) -> bool:
+        expires = self._expiry.get(key)
+        return expires is not None and expires > self._clock()
+
+    def add(self, key: str) -> bool:
+        """Records `key`; returns False if it was already present and live."""
+        now = self._clock()
+        with self._lock:
+            self._evict(now)
+            if key in self._expiry:
+                return False
+            self._expiry[key] = now + self._ttl
+            self._order.append(key)
+            return True
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            self._expiry.pop(key, None)
+
+    def _evict(self, now: float) -> None:
+        expiry, order = self._expiry, self._order
+        while order:
+            expires = expiry.get(order[0])
+            if expires is not None and expires > now and len(order) < self._max_entries:
+                break
+            expiry.pop(order.popleft(), None)
+
+
+class MessageDeduper:
+    """Two-level duplicate filter: local `RecentIds`, then a Firestore marker."""
+
+    def __init__(
+        self,
+        *,
+        recent: Optional[RecentIds] = None,
+        marker_ttl: timedelta = timedelta(days=2),
+    ) -> None:
+        self.recent = recent if recent is not None else RecentIds()
+        self._marker_ttl = marker_ttl
+
+    def seen_locally(self, message_id: str) -> bool:
+        """Marks `message_id` on this instance; True if it was already there."""
+        return not self.recent.add(message_id)
+
+    def stage(self, db: Any, batch: Any, messages: Iterable[tuple[str, str]]) -> None:
+        """Adds a marker create for each `(message_id, user_id)` to `batch`."""
+        now = datetime.now(timezone.utc)
+        markers = db.collection(store.MARKERS_COLLECTION)
+        for message_id, user_id in messages:
+            batch.create(
+                markers.document(message_id),
+                {"userId": user_id, "claimedAt": now, "expireAt": now + self._marker_ttl},
+            )
+
+    def claimed(self, db: Any, message_ids: Iterable[str]) -> set[str]:
+        """The ids among `message_ids` that already have a marker."""
+        markers = db.collection(store.MARKERS_COLLECTION)
+        refs = [markers.document(message_id) for message_id in message_ids]
+        return {snapshot.id for snapshot in db.get_all(refs) if snapshot.exists}
+
+    def release(self, message_ids: Iterable[str]) -> None:
+        """Forgets ids whose write failed so a retry is not dropped.
+
+        Their markers were in the failed batch, so only the local set holds them.
+        """
+        for message_id in message_ids:
+            self.recent.discard(message_id)
@@ -0,0 +1,319 @@
+"""FCM token registry and batched notification fan-out.
+
+Every `sendMessage` POST carries the device's `fcmToken`. The ingest
+pipeline records it in `fcmTokens/{userId}`, but only when it changes, and
+the write rides in the same batch as the chat messages. A token from a
+POST without a verified ID token only registers a user who has none. Fan-out groups
+recipients that share a payload into multicast sends of up to 500 tokens,
+keeps a bounded number of sends in flight and prunes tokens that FCM
+reports as unregistered.
+
+A campaign goes to every registered token:
+
+    python -m fcm_fanout campaign --title "Daily tip" --body "Drink water" --data kind=tip
+
+The send callable defaults to `firebase_admin.messaging.send_each_for_multicast`.
+Tests and benchmarks pass a local stub with the same signature.
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable, Iterable, Iterator, Mapping, Optional
+
+import concurrency
+import counters
+import store
+
+logger = logging.getLogger(__name__)
+
+# FCM rejects multicast messages with more than 500 tokens.
+MAX_MULTICAST_TOKENS = 500
+
+SendMulticast = Callable[[Any], Any]
+
+
+class TokenRegistry:
+    """Remembers each user's latest token and persists only changes.
+
+    The in-memory map is an LRU bounded to `max_users`, so a user who has
+    been evicted just costs one redundant merge write.
+    """
+
+    def __init__(self, max_users: int = 100_000) -> None:
+        self._max_users = max_users
+        self._tokens: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def changed(self, pairs: Iterable[tuple[str, Optional[str]]]) -> dict[str, str]:
+        """Returns the `{user_id: token}` entries that differ from what is known."""
+        updates: dict[str, str] = {}
+        with self._lock:
+            for user_id, token in pairs:
+                if token and self._tokens.get(user_id) != token:
+                    updates[user_id] = token
+        return updates
+
+    def unregistered(self, db: Any, updates: Mapping[str, str]) -> dict[str, str]:
+        """The entries of `updates` for users who have no token registered."""
+        with self._lock:
+            unknown = [user_id for user_id in updates if user_id not in self._tokens]
+        if not unknown:
+            return {}
+        tokens = db.collection(store.TOKENS_COLLECTION)
+        snapshots = db.get_all([tokens.document(user_id) for user_id in unknown])
+        registered = {s.id: s.get("token") for s in snapshots if s.exists and s.get("token")}
+        self.remember(registered)
+        return {user_id: updates[user_id] for user_id in unknown if user_id not in registered}
+
+    def stage(self, db: Any, batch: Any, updates: Mapping[str, str]) -> None:
+        now = datetime.now(timezone.utc)
+        tokens = db.collection(store.TOKENS_COLLECTION)
+        for user_id, token in updates.items():
+            batch.set(tokens.document(user_id), {"token": token, "updatedAt": now}, merge=True)
+
+    def remember(self, updates: Mapping[str, str]) -> None:
+        """Records tokens once the batch that persisted them has committed."""
+        with self._lock:
+            for user_id, token in updates.items():
+                self._tokens[user_id] = token
+                self._tokens.move_to_end(user_id)
+            while len(self._tokens) > self._max_users:
+                self._tokens.popitem(last=False)
+
+    def forget(self, user_ids: Iterable[str]) -> None:
+        with self._lock:
+            for user_id in user_ids:
+                self._tokens.pop(user_id, None)
+
+
+@dataclass(frozen=True)
+class Notification:
+    """Payload shared by every recipient of one multicast group."""
+
+    title: str
+    body: str
+    data: tuple[tuple[str, str], ...] = ()
+
+    @classmethod
+    def create(
+        cls, title: str, body: str, data: Optional[Mapping[str, Any]] = None
+    ) -> "Notification":
+        items = tuple(sorted((str(k), str(v)) for k, v in (data or {}).items()))
+        return cls(title=title, body=body, data=items)
+
+
+@dataclass
+class FanoutStats(counters.Counters):
+    sent: int = 0
+    failed: int = 0
+    pruned: int = 0
+    multicasts: int = 0
+    # Batches whose send raised; their recipients are not counted above.
+    errors: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def sends_per_sec(self) -> float:
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+
+def _default_sender() -> SendMulticast:
+    from firebase_admin import messaging
+
+    app = store.get_app()
+    return lambda message: messaging.send_each_for_multicast(message, app=app)
+
+
+def _is_unregistered(exc: BaseException) -> bool:
+    from firebase_admin import messaging
+
+    return isinstance(exc, (messaging.UnregisteredError, messaging.SenderIdMismatchError))
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    from firebase_admin import exceptions, messaging
+
+    return isinstance(
+        exc,
+        (exceptions.UnavailableError, exceptions.InternalError, messaging.QuotaExceededError),
+    )
+
+
+def _chunks(items: list, size: int) -> Iterator[list]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+class FanoutService:
+    """Sends notifications to many users with bounded multicast concurrency."""
+
+    def __init__(
+        self,
+        client_factory: store.ClientFactory = store.get_firestore,
+        send_multicast: Optional[SendMulticast] = None,
+        *,
+        max_in_flight: int = 8,
+        max_attempts: int = 3,
+        registry: Optional[TokenRegistry] = None,
+    ) -> None:
+        self._client_factory = client_factory
+        self._send_multicast = send_multicast
+        self._max_in_flight = max_in_flight
+        self._max_attempts = max_attempts
+        self.registry = registry
+
+    def notify(self, notifications: Mapping[str, Notification]) -> FanoutStats:
+        """Sends each user their notification; users sharing one are grouped."""
+        db = self._client_factory()
+        tokens = db.collection(store.TOKENS_COLLECTION)
+        groups: dict[Notification, list[tuple[str, str]]] = defaultdict(list)
+        user_ids = list(notifications)
+        for chunk in _chunks(user_ids, MAX_MULTICAST_TOKENS):
+            for snapshot in db.get_all([tokens.document(u) for u in chunk]):
+                token = snapshot.get("token") if snapshot.exists else None
+                if token:
+                    groups[notifications[snapshot.id]].append((snapshot.id, token))
+        return self._fan_out(
+            (notification, batch)
+            for notification, recipients in groups.items()
+            for batch in _chunks(recipients, MAX_MULTICAST_TOKENS)
+        )
+
+    def push_campaign(self, notification: Notification, page_size: int = MAX_MULTICAST_TOKENS) -> FanoutStats:
+        """Sends `notification` to every registered token, page by page."""
+        return self._fan_out((notification, page) for page in self._token_pages(page_size))
+
+    def _token_pages(self, page_size: int) -> Iterator[list[tuple[str, str]]]:
+        db = self._client_factory()
+        query = db.collection(store.TOKENS_COLLECTION).order_by("__name__")
+        for snapshots in concurrency.iter_pages(query, page_size):
+            page = [(s.id, s.get("token")) for s in snapshots if s.get("token")]
+            if page:
+                yield page
+
+    def _fan_out(self, batches: Iterable[tuple[Notification, list[tuple[str, str]]]]) -> FanoutStats:
+        stats = FanoutStats()
+        started = time.perf_counter()
+
+        # One broken batch must not cost the stats of all the others.
+        def settle(future: Future) -> None:
+            error = future.exception()
+            if error is not None:
+                logger.error("Multicast batch failed", exc_info=error)
+                stats.add(errors=1)
+
+        pool = concurrency.BoundedExecutor(self._max_in_flight, thread_name_prefix="fcm-send")
+        with pool:
+            for notification, recipients in batches:
+                future = pool.submit(self._send_batch, notification, recipients, stats)
+                future.add_done_callback(settle)
+        stats.elapsed = time.perf_counter() - started
+        return stats
+
+    def _send_batch(
+        self, notification: Notification, recipients: list[tuple[str, str]], stats: FanoutStats
+    ) -> None:
+        from firebase_admin import messaging
+
+        send = self._send_multicast or _default_sender()
+        stale: list[tuple[str, str]] = []
+        for attempt in range(1, self._max_attempts + 1):
+            message = messaging.MulticastMessage(
+                tokens=[token for _, token in recipients],
+                notification=messaging.Notification(title=notification.title, body=notification.body),
+                data=dict(notification.data) or None,
+            )
+            try:
+                response = send(message)
+            except Exception as exc:
+                if attempt == self._max_attempts or not _is_retryable(exc):
+                    logger.warning("Multicast of %d tokens failed: %s", len(recipients), exc)
+                    stats.add(failed=len(recipients), multicasts=1)
+                    break
+                concurrency.backoff(attempt, 0.2)
+                continue
+            retry = []
+            sent = 0
+            for recipient, result in zip(recipients, response.responses):
+                if result.success:
+                    sent += 1
+                elif _is_unregistered(result.exception):
+                    stale.append(recipient)
+                elif _is_retryable(result.exception) and attempt < self._max_attempts:
+                    retry.append(recipient)
+                else:
+                    stats.add(failed=1)
+            stats.add(sent=sent, multicasts=1)
+            if not retry:
+                break
+            recipients = retry
+            concurrency.backoff(attempt, 0.2)
+        if stale:
+            stats.add(pruned=self._prune(stale), failed=len(stale))
+
+    def _prune(self, stale: list[tuple[str, str]]) -> int:
+        """Deletes registrations still holding a rejected token.
+
+        Failures are logged and leave the tokens for the next send to reject.
+        """
+        rejected = dict(stale)
+        if self.registry is not None:
+            self.registry.forget(rejected)
+        try:
+            db = self._client_factory()
+            tokens = db.collection(store.TOKENS_COLLECTION)
+            snapshots = db.get_all([tokens.document(user_id) for user_id in rejected])
+            # A user may have re-registered with a new token since the send.
+            user_ids = [s.id for s in snapshots if s.exists and s.get("token") == rejected[s.id]]
+            if user_ids:
+                batch = db.batch()
+                for user_id in user_ids:
+                    batch.delete(tokens.document(user_id))
+                batch.commit()
+        except Exception:
+            logger.exception("Could not prune %d stale tokens", len(rejected))
+            return 0
+        return len(user_ids)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="FCM notification fan-out")
+    commands = parser.add_subparsers(dest="command", required=True)
+    campaign_parser = commands.add_parser("campaign", help="notify every registered token")
+    campaign_parser.add_argument("--title", required=True)
+    campaign_parser.add_argument("--body", required=True)
+    campaign_parser.add_argument(
+        "--data", action="append", default=[], metavar="KEY=VALUE", help="data payload entry"
+    )
+    campaign_parser.add_argument("--max-in-flight", type=int, default=8)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    data = {}
+    for item in args.data:
+        key, separator, value = item.partition("=")
+        if not separator:
+            parser.error(f"--data {item!r} is not KEY=VALUE")
+        data[key] = value
+    service = FanoutService(max_in_flight=args.max_in_flight)
+    stats = service.push_campaign(Notification.create(args.title, args.body, data))
+    print(
+        f"sent {stats.sent:,} in {stats.multicasts:,} multicasts, {stats.failed:,} failed, "
+        f"{stats.pruned:,} stale tokens pruned, {stats.errors:,} batches errored "
+        f"in {stats.elapsed:.1f}s"
+    )
+    if stats.errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Health probe and keep-alive for the HTTP functions.
+
+`DashMessagingService.testConnection` and `_testConnectionInBackground` GET
+the message API only to learn whether it is reachable. Those probes are
+answered here without touching Firestore, so a probe after an idle period
+pays only for the instance start and not for a client handshake.
+
+A probe with `warm=1` also builds the shared Firestore client on a
+background thread, so the first real request on that instance finds it
+ready. The `keep_warm` job sends such a probe to each latency-sensitive
+function on a schedule to keep one instance of each alive.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterable, Mapping, Optional
+
+import store
+
+logger = logging.getLogger(__name__)
+
+# Functions that serve the app directly and so are worth keeping warm.
+WARM_FUNCTIONS = ("mobile", "history_page", "preview_link")
+
+INSTANCE_ID = uuid.uuid4().hex[:12]
+_started = time.monotonic()
+_requests = 0
+_requests_lock = threading.Lock()
+_warming: Optional[threading.Thread] = None
+
+
+def _warm_client() -> None:
+    try:
+        store.get_firestore()
+    except Exception:
+        logger.exception("Could not build the Firestore client")
+
+
+def warm() -> None:
+    """Builds the shared Firestore client in the background, once."""
+    global _warming
+    with _requests_lock:
+        if _warming is None:
+            _warming = threading.Thread(target=_warm_client, name="warm-client", daemon=True)
+            _warming.start()
+
+
+def handle_health(params: Mapping[str, Any]) -> tuple[dict[str, Any], int]:
+    """Serves one probe, returning `(body, status)`."""
+    global _requests
+    with _requests_lock:
+        _requests += 1
+        served = _requests
+    if params.get("warm") in ("1", "true"):
+        warm()
+    return {
+        "status": "ok",
+        "instance": INSTANCE_ID,
+        "coldStart": served == 1,
+        "uptimeSec": round(time.monotonic() - _started, 1),
+        "requests": served,
+    }, 200
+
+
+def base_url() -> Optional[str]:
+    """Where this project's HTTP functions are served, if it can be told."""
+    configured = os.environ.get("KEEP_WARM_BASE_URL")
+    if configured:
+        return configured.rstrip("/")
+    project = os.environ.get("GCLOUD_PROJECT") or os.environ.get("GOOGLE_CLOUD_PROJECT")
+    if not project:
+        return None
+    region = os.environ.get("FUNCTION_REGION", "us-central1")
+    return f"https://{region}-{project}.cloudfunctions.net"
+
+
+def _probe(url: str, timeout: float) -> Optional[int]:
+    from urllib import request
+
+    try:
+        with request.urlopen(url, timeout=timeout) as response:
+            return response.status
+    except OSError as exc:
+        logger.warning("Keep-alive probe to %s failed: %s", url, exc)
+        return None
+
+
+def keep_warm(
+    base: Optional[str] = None, names: Iterable[str] = WARM_FUNCTIONS, timeout: float = 10.0
+) -> dict[str, Optional[int]]:
+    """Probes each function with `warm=1`; returns the status per function."""
+    base = base or base_url()
+    if base is None:
+        logger.warning("No project or KEEP_WARM_BASE_URL; skipping keep-alive")
+        return {}
+    names = list(names)
+    with ThreadPoolExecutor(max(1, len(names)), thread_name_prefix="keep-warm") as pool:
+        statuses = pool.map(lambda name: _probe(f"{base}/{name}?warm=1", timeout), names)
+        return dict(zip(names, statuses))
@@ -0,0 +1,393 @@
+"""Paginated conversation history for `messages/{userId}/chat`.
+
+The app issues the same ordered chat query from `loadExistingMessages`,
+`loadOlderMessages`, `loadMoreMessages`, `_loadAdditionalMessagesInBackground`,
+`getConversationHistory` and `verifyMessageOrdering`, each with its own
+limit. This module serves those reads as fixed-size pages addressed by an
+opaque cursor. Messages come back already in the `ChatMessage.toJson` shape,
+so the client does not have to re-derive `isMe` or quick replies.
+
+Pages are cached per user in an LRU. An older page (one reached through a
+cursor) is served with no reads at all. The head page is revalidated with a
+single-document probe for the newest message, so a message written by any
+instance, or by the app itself, is picked up on the next head request.
+
+Messages compacted by `retention` live in `chatArchive` chunks that are all
+older than the live chat. A page that runs out of live messages is filled
+from the newest chunks at or before its position. Only this endpoint reads
+the archive; the app's own chat queries see just the live messages.
+"""
+
+from __future__ import annotations
+
+import base64
+import binascii
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Mapping, Optional
+
+import store
+import tracing
+
+DEFAULT_PAGE_SIZE = 30
+MAX_PAGE_SIZE = 100
+MAX_QUICK_REPLIES = 4
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class InvalidCursor(ValueError):
+    """The cursor was not produced by this endpoint."""
+
+
+def _is_poll(value: Any) -> bool:
+    """Mirrors `isMessagePoll` in lib/models/chat_message.dart."""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        return value.lower() in ("y", "yes", "true")
+    if isinstance(value, int):
+        return value > 0
+    return False
+
+
+def _reply(text: Any, value: Any = None) -> dict[str, str]:
+    text = str(text)
+    return {"text": text, "value": text if value is None else str(value)}
+
+
+def extract_quick_replies(data: Mapping[str, Any]) -> list[dict[str, str]]:
+    """Builds one quick-reply list from whichever reply field is populated.
+
+    Follows `_extractAllQuickReplies` in DashMessagingService: the first
+    non-empty source among `questionsAnswers`, `answers`, `buttons`,
+    `suggestedReplies` and the legacy `options`/`choices`/`replies` wins, and
+    list sources are capped at four replies.
+    """
+    questions_answers = data.get("questionsAnswers")
+    if isinstance(questions_answers, Mapping) and questions_answers:
+        return [_reply(text, value) for text, value in questions_answers.items()]
+
+    answers = data.get("answers")
+    if isinstance(answers, list) and answers:
+        return [_reply(a) for a in answers[:MAX_QUICK_REPLIES]]
+    if isinstance(answers, str) and answers and answers != "None":
+        parts = [a.strip() for a in answers.split(",") if a.strip()]
+        return [_reply(a) for a in parts[:MAX_QUICK_REPLIES]]
+
+    buttons = data.get("buttons")
+    if isinstance(buttons, list) and buttons:
+        replies = []
+        for button in buttons[:MAX_QUICK_REPLIES]:
+            title = button.get("title") if isinstance(button, Mapping) else None
+            title = str(title if title is not None else button)
+            if title:
+                replies.append(_reply(title))
+        return replies
+
+    suggested = data.get("suggestedReplies")
+    if isinstance(suggested, list) and suggested:
+        replies = []
+        for reply in suggested[:MAX_QUICK_REPLIES]:
+            text, value = str(reply), None
+            if isinstance(reply, Mapping) and reply.get("text") is not None:
+                text, value = str(reply["text"]), reply.get("value")
+            if text:
+                replies.append(_reply(text, value))
+        return replies
+
+    options = next(
+        (data[key] for key in ("options", "choices", "replies") if data.get(key) is not None),
+        None,
+    )
+    if isinstance(options, list):
+        return [_reply(o) for o in options[:MAX_QUICK_REPLIES]]
+    return []
+
+
+def _timestamp(data: Mapping[str, Any]) -> Optional[datetime]:
+    """Mirrors `_extractTimestampFast`: createdAt, then clientTimestamp."""
+    created_at = data.get("createdAt")
+    if isinstance(created_at, datetime):
+        return created_at if created_at.tzinfo else created_at.replace(tzinfo=timezone.utc)
+    if isinstance(created_at, int):
+        seconds = created_at / 1000 if created_at > 9_999_999_999 else created_at
+        return datetime.fromtimestamp(seconds, timezone.utc)
+    client_timestamp = data.get("clientTimestamp")
+    if isinstance(client_timestamp, int):
+        return datetime.fromtimestamp(client_timestamp / 1000, timezone.utc)
+    return None
+
+
+def _iso(value: datetime) -> str:
+    text = value.astimezone(timezone.utc).isoformat(timespec="milliseconds")
+    return text.replace("+00:00", "Z")
+
+
+def normalize_message(
+    doc_id: str, data: Mapping[str, Any], user_id: str
+) -> Optional[dict[str, Any]]:
+    """Converts a chat document to `ChatMessage.toJson`, or None if empty."""
+    content = data.get("messageBody")
+    content = "" if content is None else str(content)
+    if not content:
+        return None
+    source = str(data.get("source") or "")
+    sender = data.get("senderId") or data.get("userId") or ""
+    is_me = source == "client" or (not source and sender == user_id)
+
+    replies: list[dict[str, str]] = []
+    if (
+        _is_poll(data.get("isPoll"))
+        or any(
+            data.get(key) is not None
+            for key in ("questionsAnswers", "answers", "buttons", "suggestedReplies")
+        )
+    ):
+        replies = extract_quick_replies(data)
+
+    timestamp = _timestamp(data) or datetime.now(timezone.utc)
+    event_type_code = data.get("eventTypeCode")
+    return {
+        "id": str(data.get("serverMessageId") or doc_id),
+        "content": content,
+        "timestamp": _iso(timestamp),
+        "isMe": is_me,
+        "type": "MessageType.quickReply" if replies else "MessageType.text",
+        "status": "MessageStatus.sent",
+        "mediaUrl": None,
+        "linkPreview": None,
+        "suggestedReplies": replies or None,
+        "eventTypeCode": event_type_code if isinstance(event_type_code, int) else 1,
+    }
+
+
+def encode_cursor(created_at: Any, doc_id: str) -> str:
+    if isinstance(created_at, datetime):
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        micros = (created_at - _EPOCH) // timedelta(microseconds=1)
+        position = {"k": "ts", "v": micros}
+    else:
+        position = {"k": "raw", "v": created_at}
+    position["id"] = doc_id
+    raw = json.dumps(position, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[Any, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        doc_id = position["id"]
+        if position["k"] == "ts":
+            created_at: Any = _EPOCH + timedelta(microseconds=position["v"])
+        else:
+            created_at = position["v"]
+    except (binascii.Error, ValueError, KeyError, TypeError) as exc:
+        raise InvalidCursor("malformed cursor") from exc
+    if not isinstance(doc_id, str):
+        raise InvalidCursor("malformed cursor")
+    return created_at, doc_id
+
+
+@dataclass(frozen=True)
+class Page:
+    """One page of history, oldest message first."""
+
+    messages: list[dict[str, Any]]
+    next_cursor: Optional[str]
+    head_id: Optional[str]
+    reads: int
+    fetched_at: float
+
+
+class PageCache:
+    """Per-user LRU of pages, itself bounded to `max_users` users."""
+
+    def __init__(
+        self, max_users: int = 1_000, max_pages: int = 8, ttl: float = 300.0
+    ) -> None:
+        self._max_users = max_users
+        self._max_pages = max_pages
+        self._ttl = ttl
+        self._users: OrderedDict[str, OrderedDict[tuple, Page]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str, key: tuple) -> Optional[Page]:
+        with self._lock:
+            pages = self._users.get(user_id)
+            page = pages.get(key) if pages else None
+            if page is None:
+                return None
+            if time.monotonic() - page.fetched_at > self._ttl:
+                del pages[key]
+                return None
+            self._users.move_to_end(user_id)
+            pages.move_to_end(key)
+            return page
+
+    def put(self, user_id: str, key: tuple, page: Page) -> None:
+        with self._lock:
+            pages = self._users.get(user_id)
+            if pages is None:
+                pages = self._users[user_id] = OrderedDict()
+            self._users.move_to_end(user_id)
+            pages[key] = page
+            pages.move_to_end(key)
+            while len(pages) > self._max_pages:
+                pages.popitem(last=False)
+            while len(self._users) > self._max_users:
+                self._users.popitem(last=False)
+
+
+class HistoryService:
+    """Serves history pages from Firestore through a `PageCache`."""
+
+    def __init__(
+        self,
+        client_factory: store.ClientFactory = store.get_firestore,
+        cache: Optional[PageCache] = None,
+    ) -> None:
+        self._client_factory = client_factory
+        self.cache = cache if cache is not None else PageCache()
+
+    def _ordered(self, user_id: str) -> Any:
+        db = self._client_factory()
+        return (
+            store.chat_collection(db, user_id)
+            .order_by("createdAt", direction="DESCENDING")
+            .order_by("__name__", direction="DESCENDING")
+        )
+
+    @tracing.timed("history.page")
+    def page(
+        self, user_id: str, cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE
+    ) -> dict[str, Any]:
+        """Returns one page plus read accounting for the response body."""
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        key = (cursor, limit)
+        cached = self.cache.get(user_id, key)
+        reads = 0
+        if cached is not None and cursor is None:
+            reads = 1
+            if self._head_id(user_id) != cached.head_id:
+                cached = None
+        if cached is None:
+            cached = self._fetch(user_id, cursor, limit)
+            self.cache.put(user_id, key, cached)
+            reads = cached.reads
+        return {
+            "messages": cached.messages,
+            "nextCursor": cached.next_cursor,
+            "reads": reads,
+            "readsSaved": cached.reads - reads,
+        }
+
+    def _head_id(self, user_id: str) -> Optional[str]:
+        for snapshot in self._ordered(user_id).limit(1).stream():
+            return snapshot.id
+        return None
+
+    def _fetch(self, user_id: str, cursor: Optional[str], limit: int) -> Page:
+        query = self._ordered(user_id)
+        position = None
+        if cursor is not None:
+            position = decode_cursor(cursor)
+            created_at, doc_id = position
+            query = query.start_after({"createdAt": created_at, "__name__": doc_id})
+        snapshots = list(query.limit(limit).stream())
+        reads = max(1, len(snapshots))
+        rows = [(s.get("createdAt"), s.id, s.to_dict() or {}) for s in snapshots]
+        if len(rows) < limit:
+            if rows:
+                position = rows[-1][:2]
+            archived, archive_reads = self._archived(user_id, position, limit - len(rows))
+            rows.extend(archived)
+            reads += archive_reads
+        messages = []
+        for _, doc_id, data in rows:
+            message = normalize_message(doc_id, data, user_id)
+            if message is not None:
+                messages.append(message)
+        messages.reverse()
+        next_cursor = None
+        if len(rows) == limit:
+            next_cursor = encode_cursor(rows[-1][0], rows[-1][1])
+        return Page(
+            messages=messages,
+            next_cursor=next_cursor,
+            head_id=snapshots[0].id if snapshots else None,
+            reads=reads,
+            fetched_at=time.monotonic(),
+        )
+
+    def _archived(
+        self, user_id: str, position: Optional[tuple[Any, str]], count: int
+    ) -> tuple[list[tuple[Any, str, dict[str, Any]]], int]:
+        """Up to `count` archived messages older than `position`, newest first.
+
+        Returns the `(createdAt, id, data)` rows and the reads spent. Chunks
+        do not overlap, so the one holding `position` is the newest chunk
+        that starts at or before it.
+        """
+        if position is not None and not isinstance(position[0], datetime):
+            return [], 0
+        query = store.chat_archive_collection(self._client_factory(), user_id).order_by(
+            "firstCreatedAt", direction="DESCENDING"
+        )
+        if position is not None:
+            query = query.start_at({"firstCreatedAt": position[0]})
+        rows: list[tuple[Any, str, dict[str, Any]]] = []
+        reads = 0
+        while len(rows) < count:
+            chunks = list(query.limit(2).stream())
+            reads += max(1, len(chunks))
+            for chunk in chunks:
+                for entry in reversed((chunk.to_dict() or {}).get("messages") or []):
+                    data = entry.get("data") or {}
+                    key = (data.get("createdAt"), entry.get("id"))
+                    if position is None or key < position:
+                        rows.append((key[0], key[1], data))
+            if len(chunks) < 2:
+                break
+            query = query.start_after(chunks[-1])
+        return rows[:count], reads
+
+
+_service: Optional[HistoryService] = None
+_service_lock = threading.Lock()
+
+
+def get_service() -> HistoryService:
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = HistoryService()
+    return _service
+
+
+def handle_history(
+    params: Mapping[str, Any], user_id: str, service: Optional[HistoryService] = None
+) -> tuple[dict[str, Any], int]:
+    """Serves one GET for `user_id`, returning `(body, status)`.
+
+    `user_id` must come from the caller's verified ID token; a `userId`
+    parameter is ignored.
+    """
+    if not isinstance(user_id, str) or not user_id or "/" in user_id:
+        return {"status": "error", "error": "a user id is required"}, 400
+    try:
+        limit = int(params.get("limit") or DEFAULT_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return {"status": "error", "error": "limit must be an integer"}, 400
+    try:
+        body = (service or get_service()).page(user_id, params.get("cursor") or None, limit)
+    except InvalidCursor as exc:
+        return {"status": "error", "error": str(exc)}, 400
+    return {"status": "ok", **body}, 200
@@ -0,0 +1,69 @@
+"""HyperLogLog sketch for unique-user counts in analytics rollups.
+
+Registers are stored in Firestore as a sparse `{index: rank}` map. Adding a
+value only ever raises a register, so a rollup write can use a blind
+`Maximum` transform per register instead of a read-modify-write, and
+sketches for several days merge by taking the per-register maximum.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import math
+from typing import Iterable, Mapping
+
+DEFAULT_PRECISION = 12
+
+
+def _hash64(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+def position(value: str, precision: int = DEFAULT_PRECISION) -> tuple[int, int]:
+    """Returns the `(register, rank)` pair that `value` updates."""
+    hashed = _hash64(value)
+    index = hashed >> (64 - precision)
+    remainder = hashed & ((1 << (64 - precision)) - 1)
+    rank = (64 - precision) - remainder.bit_length() + 1
+    return index, rank
+
+
+class HyperLogLog:
+    def __init__(self, precision: int = DEFAULT_PRECISION) -> None:
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be between 4 and 16")
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value: str) -> None:
+        index, rank = position(value, self.precision)
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values: Iterable[str]) -> None:
+        for value in values:
+            self.add(value)
+
+    def merge(self, other: "HyperLogLog") -> None:
+        if other.precision != self.precision:
+            raise ValueError("cannot merge sketches of different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def merge_map(self, registers: Mapping[str, int]) -> None:
+        """Folds in a sparse register map as stored on a rollup document."""
+        for index, rank in registers.items():
+            index = int(index)
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+
+    def to_map(self) -> dict[str, int]:
+        return {str(i): rank for i, rank in enumerate(self.registers) if rank}
+
+    def count(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0**-rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
@@ -0,0 +1,45 @@
+"""Firebase ID token checks for the HTTP functions.
+
+The functions read Firestore with Admin SDK credentials, so security rules
+never apply to them. Anything that returns a user's data, or instance
+internals, must take the caller's uid from a verified ID token sent as
+`Authorization: Bearer <token>`, never from the request parameters.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Callable, Mapping, Optional
+
+import store
+
+Verifier = Callable[[str], Mapping[str, Any]]
+
+
+class Unauthorized(Exception):
+    """The request carries no valid Firebase ID token."""
+
+
+def bearer_token(header: Optional[str]) -> str:
+    scheme, _, token = (header or "").partition(" ")
+    token = token.strip()
+    if scheme.lower() != "bearer" or not token:
+        raise Unauthorized("a Firebase ID token is required")
+    return token
+
+
+def _verify(token: str) -> Mapping[str, Any]:
+    from firebase_admin import auth
+
+    try:
+        return auth.verify_id_token(token, app=store.get_app())
+    except (ValueError, auth.InvalidIdTokenError, auth.UserDisabledError) as exc:
+        raise Unauthorized("invalid Firebase ID token") from exc
+
+
+def verified_uid(header: Optional[str], verify: Optional[Verifier] = None) -> str:
+    """Returns the uid of the `Authorization` header's token, or raises."""
+    claims = (verify or _verify)(bearer_token(header))
+    uid = claims.get("uid")
+    if not isinstance(uid, str) or not uid:
+        raise Unauthorized("the ID token has no uid")
+    return uid
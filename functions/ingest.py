@@ -0,0 +1,467 @@
+"""High-throughput ingest for the `/api/mobile` message POST.
+
+`DashMessagingService.sendMessage` posts
+`{messageId, userId, messageText, fcmToken, messageTime, eventTypeCode}` and
+gives up after 8s. The handler only validates the payload and enqueues it, so
+the ack does not wait on Firestore. A small asyncio worker pool running on a
+background thread drains the queue and commits batched writes to
+`messages/{userId}/chat/{messageId}` over the shared client.
+
+The pipeline keeps working after the response is sent. `mobile` keeps a
+minimum instance so there is always one to drain the queue, and `main`
+calls `shutdown` on SIGTERM, so messages acked on an instance that is
+scaled in are written within the runtime's grace period.
+
+`main` passes the uid of the caller's Firebase ID token, and a payload
+whose `userId` is someone else's is refused. Until every app build sends
+the token, a POST without one is still accepted unless
+`INGEST_REQUIRE_ID_TOKEN=1`, but its `fcmToken` may only register a user
+who has none: it never replaces a token, so it cannot redirect another
+user's notifications.
+
+Each message is timed through the handler, the queue and the commit (see
+`tracing`), and the ack carries its trace id.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Mapping, Optional
+
+import concurrency
+import counters
+import dedup
+import fcm_fanout
+import store
+import tracing
+
+logger = logging.getLogger(__name__)
+
+REQUIRE_ID_TOKEN = os.environ.get("INGEST_REQUIRE_ID_TOKEN") == "1"
+
+
+class InvalidPayload(ValueError):
+    """The request body does not match the sendMessage contract."""
+
+
+@dataclass(frozen=True)
+class IngestMessage:
+    """One validated `sendMessage` payload."""
+
+    message_id: str
+    user_id: str
+    message_text: str
+    message_time: int
+    event_type_code: int = 1
+    fcm_token: Optional[str] = None
+    # Whether `user_id` is the uid of the caller's verified ID token.
+    verified: bool = False
+    received_at: float = field(default_factory=time.perf_counter, compare=False, repr=False)
+
+    @property
+    def trace_id(self) -> str:
+        return tracing.trace_id(self.message_id)
+
+    @classmethod
+    def from_payload(cls, payload: Any) -> "IngestMessage":
+        if not isinstance(payload, Mapping):
+            raise InvalidPayload("body must be a JSON object")
+        message_id = payload.get("messageId")
+        user_id = payload.get("userId")
+        message_text = payload.get("messageText")
+        for name, value in (
+            ("messageId", message_id),
+            ("userId", user_id),
+            ("messageText", message_text),
+        ):
+            if not isinstance(value, str) or not value:
+                raise InvalidPayload(f"{name} must be a non-empty string")
+        # A bad id would fail the whole batch it is committed in.
+        for name, value in (("messageId", message_id), ("userId", user_id)):
+            if not store.is_valid_document_id(value):
+                raise InvalidPayload(f"{name} is not a valid Firestore document id")
+        try:
+            message_time = int(payload.get("messageTime") or 0)
+            event_type_code = int(payload.get("eventTypeCode") or 1)
+        except (TypeError, ValueError) as exc:
+            raise InvalidPayload(
+                "messageTime and eventTypeCode must be integers"
+            ) from exc
+        fcm_token = payload.get("fcmToken")
+        return cls(
+            message_id=message_id,
+            user_id=user_id,
+            message_text=message_text,
+            message_time=message_time,
+            event_type_code=event_type_code,
+            fcm_token=fcm_token if isinstance(fcm_token, str) and fcm_token else None,
+        )
+
+    def to_document(self) -> dict[str, Any]:
+        """Fields merged into the chat document.
+
+        The client writes the same document id with a server `createdAt`
+        and its own millisecond `clientTimestamp` before posting. Both are
+        left to that write: `createdAt` keeps the user message ordered
+        ahead of the reply, and `messageTime` only has second precision.
+        """
+        return {
+            "messageBody": self.message_text,
+            "source": "client",
+            "senderId": self.user_id,
+            "serverMessageId": self.message_id,
+            "eventTypeCode": self.event_type_code,
+            "isPoll": "n",
+            "messageOrder": "user",
+            "ingestedAt": datetime.now(timezone.utc),
+        }
+
+
+@dataclass
+class IngestStats(counters.Counters):
+    accepted: int = 0
+    rejected: int = 0
+    written: int = 0
+    failed: int = 0
+    duplicates: int = 0
+    batches: int = 0
+
+
+class IngestPipeline:
+    """Asyncio queue plus worker pool that batches messages into Firestore.
+
+    `submit` is safe to call from any request thread. The event loop lives on
+    its own daemon thread and blocking commits run on a thread pool sized to
+    the worker count, so every worker can keep one commit in flight.
+
+    With a `deduper`, repeated `messageId`s are dropped at `submit` when this
+    instance has seen them, and at commit time when another instance has:
+    each message's marker is created in the batch that writes it.
+    With a `token_registry`, changed `fcmToken`s are written in the same batch;
+    see `_token_updates` for the ones from unverified payloads.
+    """
+
+    def __init__(
+        self,
+        client_factory: store.ClientFactory = store.get_firestore,
+        *,
+        workers: int = 4,
+        batch_size: int = 200,
+        linger: float = 0.005,
+        max_pending: int = 10_000,
+        max_attempts: int = 3,
+        deduper: Optional[dedup.MessageDeduper] = None,
+        token_registry: Optional[fcm_fanout.TokenRegistry] = None,
+    ) -> None:
+        # Batches over the write limit (with markers and token updates) are
+        # split at commit time.
+        if not 1 <= batch_size <= store.MAX_BATCH_WRITES // 2:
+            raise ValueError(f"batch_size must be between 1 and {store.MAX_BATCH_WRITES // 2}")
+        self._client_factory = client_factory
+        self._workers = workers
+        self._batch_size = batch_size
+        self._linger = linger
+        self._max_pending = max_pending
+        self._max_attempts = max_attempts
+        self.deduper = deduper
+        self.token_registry = token_registry
+        self.stats = IngestStats()
+
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue[IngestMessage]] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def start(self) -> None:
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            ready = threading.Event()
+            self._executor = ThreadPoolExecutor(
+                max_workers=self._workers, thread_name_prefix="ingest-commit"
+            )
+            self._thread = threading.Thread(
+                target=self._run, args=(ready,), name="ingest-loop", daemon=True
+            )
+            self._thread.start()
+            ready.wait()
+
+    def submit(self, message: IngestMessage) -> str:
+        """Enqueues `message`.
+
+        Returns "accepted", "duplicate" if the id was already seen here, or
+        "busy" when the queue is saturated.
+        """
+        if self._thread is None:
+            self.start()
+        if self.deduper is not None and self.deduper.seen_locally(message.message_id):
+            self.stats.add(duplicates=1)
+            return "duplicate"
+        with self._pending_lock:
+            accepted = self._pending < self._max_pending
+            if accepted:
+                self._pending += 1
+        if not accepted:
+            if self.deduper is not None:
+                self.deduper.recent.discard(message.message_id)
+            self.stats.add(rejected=1)
+            return "busy"
+        self.stats.add(accepted=1)
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, message)
+        return "accepted"
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """Blocks until every accepted message has been written or dropped."""
+        if self._thread is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._queue.join(), self._loop)
+        future.result(timeout)
+
+    def stop(self, timeout: Optional[float] = 10.0) -> None:
+        """Writes what is queued, then stops the workers, within `timeout`."""
+        if self._thread is None:
+            return
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            self.flush(timeout)
+        except FutureTimeout:
+            logger.error("Stopping with %d messages not yet written", self._pending)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        self._executor.shutdown(wait=deadline is None or time.monotonic() < deadline)
+        self._thread = None
+
+    def _run(self, ready: threading.Event) -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        tasks = [
+            loop.create_task(self._worker(), name=f"ingest-worker-{index}")
+            for index in range(self._workers)
+        ]
+        loop.call_soon(ready.set)
+        try:
+            loop.run_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+
+    async def _worker(self) -> None:
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            self._drain(batch)
+            if len(batch) < self._batch_size and self._linger > 0:
+                await asyncio.sleep(self._linger)
+                self._drain(batch)
+            try:
+                written = await self._loop.run_in_executor(
+                    self._executor, self._commit, batch
+                )
+            except Exception:
+                logger.exception("Dropping %d messages after retries", len(batch))
+                self.stats.add(failed=len(batch))
+            else:
+                self.stats.add(
+                    written=written,
+                    duplicates=len(batch) - written,
+                    batches=1 if written else 0,
+                )
+            finally:
+                with self._pending_lock:
+                    self._pending -= len(batch)
+                for _ in batch:
+                    queue.task_done()
+
+    def _drain(self, batch: list[IngestMessage]) -> None:
+        queue = self._queue
+        while len(batch) < self._batch_size and not queue.empty():
+            batch.append(queue.get_nowait())
+
+    def _commit(self, batch: list[IngestMessage]) -> int:
+        started = time.perf_counter()
+        tracing.REGISTRY.histogram("ingest.queue_wait").observe_many(
+            started - m.received_at for m in batch
+        )
+        db = self._client_factory()
+        tokens: dict[str, str] = {}
+        if self.token_registry is not None:
+            tokens = self._token_updates(db, batch)
+        try:
+            written = self._write(db, batch, tokens)
+        except Exception:
+            if self.deduper is not None:
+                self.deduper.release(m.message_id for m in batch)
+            raise
+        if written:
+            self._trace(written, started)
+        return len(written)
+
+    def _token_updates(self, db: Any, batch: list[IngestMessage]) -> dict[str, str]:
+        """The changed tokens to write with `batch`.
+
+        A token from an unverified payload only registers a user who has
+        none yet. If that cannot be looked up, it is left for a later POST.
+        """
+        registry = self.token_registry
+        verified = registry.changed((m.user_id, m.fcm_token) for m in batch if m.verified)
+        unverified = registry.changed(
+            (m.user_id, m.fcm_token)
+            for m in batch
+            if not m.verified and m.user_id not in verified
+        )
+        if unverified:
+            try:
+                unverified = registry.unregistered(db, unverified)
+            except Exception:
+                logger.warning(
+                    "Could not look up %d token registrations", len(unverified), exc_info=True
+                )
+                unverified = {}
+        return {**unverified, **verified}
+
+    def _write(
+        self, db: Any, messages: list[IngestMessage], tokens: Mapping[str, str]
+    ) -> list[IngestMessage]:
+        """Commits `messages` with their dedup markers; returns the ones written.
+
+        A marker that already exists fails the whole batch with
+        ALREADY_EXISTS. The claimed ids are then looked up and the rest is
+        committed again, as `analytics_rollup._commit` does.
+        """
+        per_message = 1 if self.deduper is None else 2
+        while messages:
+            staged = {m.user_id: tokens[m.user_id] for m in messages if m.user_id in tokens}
+            writes = per_message * len(messages) + len(staged)
+            if len(messages) > 1 and writes > store.MAX_BATCH_WRITES:
+                middle = len(messages) // 2
+                return self._write(db, messages[:middle], tokens) + self._write(
+                    db, messages[middle:], tokens
+                )
+            try:
+                self._commit_batch(db, messages, staged)
+            except Exception as exc:
+                if self.deduper is None or not store.is_already_exists(exc):
+                    raise
+                if len(messages) == 1:
+                    return []
+                claimed = self.deduper.claimed(db, [m.message_id for m in messages])
+                if not claimed:
+                    raise
+                messages = [m for m in messages if m.message_id not in claimed]
+            else:
+                if staged:
+                    self.token_registry.remember(staged)
+                return messages
+        return []
+
+    def _commit_batch(
+        self, db: Any, messages: list[IngestMessage], tokens: Mapping[str, str]
+    ) -> None:
+        def commit() -> None:
+            write = db.batch()
+            for message in messages:
+                ref = store.chat_collection(db, message.user_id).document(
+                    message.message_id
+                )
+                write.set(ref, message.to_document(), merge=True)
+            if self.deduper is not None:
+                self.deduper.stage(db, write, ((m.message_id, m.user_id) for m in messages))
+            if tokens:
+                self.token_registry.stage(db, write, tokens)
+            with tracing.stage("ingest.firestore_write"):
+                write.commit()
+
+        concurrency.retry(
+            commit,
+            attempts=self._max_attempts,
+            base=0.05,
+            # A claimed marker fails every attempt; `_write` splits it out.
+            retryable=lambda exc: not store.is_already_exists(exc),
+            what="Batch commit",
+        )
+
+    def _trace(self, batch: list[IngestMessage], started: float) -> None:
+        written = time.perf_counter()
+        tracing.REGISTRY.histogram("ingest.end_to_end").observe_many(
+            written - m.received_at for m in batch
+        )
+        for message in batch:
+            tracing.log_trace(
+                message.trace_id,
+                message.message_id,
+                {
+                    "queue": (started - message.received_at) * 1000,
+                    "commit": (written - started) * 1000,
+                    "total": (written - message.received_at) * 1000,
+                },
+            )
+
+
+_pipeline: Optional[IngestPipeline] = None
+_pipeline_lock = threading.Lock()
+
+
+def get_pipeline() -> IngestPipeline:
+    """Returns the per-instance pipeline, starting it on first use."""
+    global _pipeline
+    if _pipeline is None:
+        with _pipeline_lock:
+            if _pipeline is None:
+                pipeline = IngestPipeline(
+                    deduper=dedup.MessageDeduper(),
+                    token_registry=fcm_fanout.TokenRegistry(),
+                )
+                pipeline.start()
+                _pipeline = pipeline
+    return _pipeline
+
+
+def shutdown(timeout: float) -> None:
+    """Drains this instance's pipeline, if one was started, within `timeout`."""
+    global _pipeline
+    with _pipeline_lock:
+        pipeline, _pipeline = _pipeline, None
+    if pipeline is not None:
+        pipeline.stop(timeout)
+
+
+@tracing.timed("ingest.handler")
+def handle_ingest(
+    payload: Any, pipeline: Optional[IngestPipeline] = None, uid: Optional[str] = None
+) -> tuple[dict[str, Any], int]:
+    """Validates and enqueues one POST body, returning `(body, status)`.
+
+    `uid` is the caller's verified uid, or None when it sent no ID token.
+    """
+    try:
+        message = IngestMessage.from_payload(payload)
+    except InvalidPayload as exc:
+        return {"status": "error", "error": str(exc)}, 400
+    if uid is not None:
+        if uid != message.user_id:
+            return {"status": "error", "error": "userId does not match the ID token"}, 403
+        message = dataclasses.replace(message, verified=True)
+    outcome = (pipeline or get_pipeline()).submit(message)
+    body = {"status": outcome, "messageId": message.message_id, "traceId": message.trace_id}
+    # Duplicates are acked with 200 so the client stops retrying.
+    return body, 503 if outcome == "busy" else 200
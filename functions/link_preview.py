@@ -0,0 +1,486 @@
+"""Shared link previews for URLs posted in chat.
+
+`LinkPreviewService.fetchLinkPreview` downloads and parses the whole page on
+every device and caches the result only in an unbounded per-process map. This
+module builds the same `LinkPreview.toJson` shape once and shares it:
+
+* An in-memory LRU with a TTL answers repeat lookups on this instance.
+* `linkPreviews/{sha256(url)}` shares the result across instances. Enable a
+  Firestore TTL policy on its `expiresAt` field to purge stale entries.
+* Misses go to a pooled aiohttp session. Only the `<head>` is parsed, and the
+  download stops at `</head>`, at `<body>`, or once `og:title`,
+  `og:description` and `og:image` have all been seen.
+* Concurrent lookups of one URL share a single fetch.
+
+Because the body is never read, the client's fallbacks to the first `<p>`
+and `<img>` do not apply here. Pages without head metadata get an empty
+description and no image.
+
+Hosts that resolve to private, loopback or link-local addresses are refused,
+so the endpoint cannot be used to reach internal services.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import codecs
+import hashlib
+import ipaddress
+import logging
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from html.parser import HTMLParser
+from typing import Any, Mapping, Optional
+from urllib.parse import urljoin, urlsplit
+
+import counters
+import store
+import tracing
+
+logger = logging.getLogger(__name__)
+
+MAX_URL_LENGTH = 2048
+# Hard cap on bytes read per page, in case `</head>` never arrives.
+MAX_HEAD_BYTES = 256 * 1024
+
+_CHUNK_SIZE = 8 * 1024
+_MAX_REDIRECTS = 5
+_REDIRECTS = (301, 302, 303, 307, 308)
+_OG_REQUIRED = ("og:title", "og:description", "og:image")
+_USER_AGENT = "Mozilla/5.0 (compatible; QuitxtLinkPreview/1.0)"
+
+
+class InvalidUrl(ValueError):
+    """The URL is not an absolute http(s) URL."""
+
+
+def validate_url(url: Any) -> str:
+    if not isinstance(url, str) or not url or len(url) > MAX_URL_LENGTH:
+        raise InvalidUrl("url must be a non-empty string")
+    parts = urlsplit(url.strip())
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise InvalidUrl("url must be an absolute http(s) URL")
+    return parts.geturl()
+
+
+def basic_preview(url: str) -> dict[str, Any]:
+    """Mirrors `_createBasicPreview`: the host stands in for everything."""
+    host = urlsplit(url).hostname or url
+    return {
+        "url": url,
+        "title": host,
+        "description": "Tap to open link",
+        "imageUrl": None,
+        "siteName": host,
+    }
+
+
+class HeadParser(HTMLParser):
+    """Collects `<meta>` tags and `<title>` until the head is complete."""
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.meta: dict[str, str] = {}
+        self.title = ""
+        self.done = False
+        self._title_parts: Optional[list[str]] = None
+
+    @property
+    def complete(self) -> bool:
+        return self.done or all(key in self.meta for key in _OG_REQUIRED)
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, Optional[str]]]) -> None:
+        if tag == "meta":
+            values = dict(attrs)
+            key = (values.get("property") or values.get("name") or "").strip().lower()
+            content = (values.get("content") or "").strip()
+            if key and content:
+                self.meta.setdefault(key, content)
+        elif tag == "title" and not self.title:
+            self._title_parts = []
+        elif tag == "body":
+            self.done = True
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == "title" and self._title_parts is not None:
+            self.title = "".join(self._title_parts).strip()
+            self._title_parts = None
+        elif tag == "head":
+            self.done = True
+
+    def handle_data(self, data: str) -> None:
+        if self._title_parts is not None:
+            self._title_parts.append(data)
+
+    def preview(self, url: str, final_url: Optional[str] = None) -> dict[str, Any]:
+        """Applies the client's og: → twitter: → HTML fallback order.
+
+        Relative images resolve against `final_url`, the page after redirects.
+        """
+        meta = self.meta
+        host = urlsplit(url).hostname or url
+        image = meta.get("og:image") or meta.get("twitter:image")
+        twitter_site = meta.get("twitter:site", "").lstrip("@")
+        return {
+            "url": url,
+            "title": meta.get("og:title") or meta.get("twitter:title") or self.title or host,
+            "description": meta.get("og:description")
+            or meta.get("twitter:description")
+            or meta.get("description")
+            or "",
+            "imageUrl": urljoin(final_url or url, image) if image else None,
+            "siteName": meta.get("og:site_name") or twitter_site or host,
+        }
+
+
+def _is_ip(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+def _is_public(address: str) -> bool:
+    return ipaddress.ip_address(address.split("%", 1)[0]).is_global
+
+
+def _public_resolver(allow_private: bool) -> Any:
+    from aiohttp.abc import AbstractResolver
+    from aiohttp.resolver import DefaultResolver
+
+    class PublicResolver(AbstractResolver):
+        """Drops non-public addresses, including on redirects."""
+
+        def __init__(self) -> None:
+            self._resolver = DefaultResolver()
+
+        async def resolve(
+            self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET
+        ) -> list:
+            hosts = await self._resolver.resolve(host, port, family)
+            if not allow_private:
+                hosts = [h for h in hosts if _is_public(h["host"])]
+            if not hosts:
+                raise OSError(f"{host} does not resolve to a public address")
+            return hosts
+
+        async def close(self) -> None:
+            await self._resolver.close()
+
+    return PublicResolver()
+
+
+@dataclass
+class PreviewStats(counters.Counters):
+    memory_hits: int = 0
+    store_hits: int = 0
+    fetches: int = 0
+    failures: int = 0
+    coalesced: int = 0
+    bytes_fetched: int = 0
+    store_errors: int = 0
+    timeouts: int = 0
+
+
+class PreviewCache:
+    """LRU of previews keyed by URL, each expiring after its own TTL."""
+
+    def __init__(self, max_entries: int = 10_000) -> None:
+        self._max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, dict[str, Any]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, url: str) -> Optional[dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            if time.monotonic() >= entry[0]:
+                del self._entries[url]
+                return None
+            self._entries.move_to_end(url)
+            return entry[1]
+
+    def put(self, url: str, preview: dict[str, Any], ttl: float) -> None:
+        with self._lock:
+            self._entries[url] = (time.monotonic() + ttl, preview)
+            self._entries.move_to_end(url)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+class PreviewService:
+    """Resolves previews through the memory cache, Firestore, then HTTP.
+
+    `preview` may be called from any request thread. Fetches run on an event
+    loop owned by a daemon thread, so the aiohttp connection pool and the
+    in-flight map outlive individual requests.
+    """
+
+    def __init__(
+        self,
+        client_factory: Optional[store.ClientFactory] = store.get_firestore,
+        cache: Optional[PreviewCache] = None,
+        *,
+        ttl: float = 24 * 3600.0,
+        failure_ttl: float = 600.0,
+        timeout: float = 5.0,
+        max_connections: int = 32,
+        max_head_bytes: int = MAX_HEAD_BYTES,
+        allow_private: bool = False,
+    ) -> None:
+        self._client_factory = client_factory
+        self.cache = cache if cache is not None else PreviewCache()
+        self._ttl = ttl
+        self._failure_ttl = failure_ttl
+        self._timeout = timeout
+        self._max_connections = max_connections
+        self._max_head_bytes = max_head_bytes
+        self._allow_private = allow_private
+        self.stats = PreviewStats()
+
+        self._start_lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._session: Any = None
+        self._in_flight: dict[str, asyncio.Future] = {}
+
+    def start(self) -> None:
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            ready = threading.Event()
+            self._executor = ThreadPoolExecutor(
+                max_workers=4, thread_name_prefix="preview-store"
+            )
+            thread = threading.Thread(
+                target=self._run, args=(ready,), name="preview-loop", daemon=True
+            )
+            thread.start()
+            ready.wait()
+            # Published only once the loop is running; see `preview`.
+            self._thread = thread
+
+    def stop(self, timeout: Optional[float] = 10.0) -> None:
+        if self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+        self._executor.shutdown(wait=True)
+        self._thread = None
+
+    def _run(self, ready: threading.Event) -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        self._session = loop.run_until_complete(self._open_session())
+        loop.call_soon(ready.set)
+        try:
+            loop.run_forever()
+        finally:
+            loop.run_until_complete(self._session.close())
+            loop.close()
+
+    async def _open_session(self) -> Any:
+        import aiohttp
+
+        connector = aiohttp.TCPConnector(
+            limit=self._max_connections,
+            resolver=_public_resolver(self._allow_private),
+            ttl_dns_cache=300,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            headers={"User-Agent": _USER_AGENT, "Accept": "text/html,application/xhtml+xml"},
+            timeout=aiohttp.ClientTimeout(total=self._timeout),
+        )
+
+    @tracing.timed("link_preview.preview")
+    def preview(self, url: str, timeout: Optional[float] = None) -> dict[str, Any]:
+        """Returns `{"preview": ..., "cache": "memory" | "store" | "miss" | "timeout"}`.
+
+        On a timeout the caller gets the basic preview while the lookup
+        carries on and caches its result for the next request.
+        """
+        cached = self.cache.get(url)
+        if cached is not None:
+            self.stats.add(memory_hits=1)
+            return {"preview": cached, "cache": "memory"}
+        if self._thread is None:
+            self.start()
+        future = asyncio.run_coroutine_threadsafe(self._resolve(url), self._loop)
+        try:
+            return future.result(timeout if timeout is not None else self._timeout + 5)
+        except FutureTimeout:
+            logger.warning("Preview lookup for %s timed out", url)
+            self.stats.add(timeouts=1)
+            return {"preview": basic_preview(url), "cache": "timeout"}
+
+    async def _resolve(self, url: str) -> dict[str, Any]:
+        pending = self._in_flight.get(url)
+        if pending is not None:
+            self.stats.add(coalesced=1)
+            return await asyncio.shield(pending)
+        pending = self._loop.create_future()
+        self._in_flight[url] = pending
+        try:
+            result = await self._load(url)
+        except BaseException as exc:
+            pending.set_exception(exc)
+            # Mark the exception retrieved when nobody else was waiting.
+            pending.exception()
+            raise
+        else:
+            pending.set_result(result)
+            return result
+        finally:
+            del self._in_flight[url]
+
+    async def _load(self, url: str) -> dict[str, Any]:
+        cached = self.cache.get(url)
+        if cached is not None:
+            self.stats.add(memory_hits=1)
+            return {"preview": cached, "cache": "memory"}
+        if self._client_factory is not None:
+            try:
+                stored = await self._loop.run_in_executor(self._executor, self._read_store, url)
+            except Exception:
+                # Fall through to the fetch rather than fail the request.
+                logger.exception("Could not read stored preview for %s", url)
+                self.stats.add(store_errors=1)
+                stored = None
+            if stored is not None:
+                preview, remaining = stored
+                self.cache.put(url, preview, remaining)
+                self.stats.add(store_hits=1)
+                return {"preview": preview, "cache": "store"}
+
+        preview = await self._fetch(url)
+        ttl = self._ttl if preview is not None else self._failure_ttl
+        if preview is None:
+            preview = basic_preview(url)
+        self.cache.put(url, preview, ttl)
+        if self._client_factory is not None:
+            # The caller does not wait for the shared copy to be written.
+            self._loop.run_in_executor(self._executor, self._write_store, url, preview, ttl)
+        return {"preview": preview, "cache": "miss"}
+
+    async def _fetch(self, url: str) -> Optional[dict[str, Any]]:
+        """Streams the head of `url`; None if it cannot be previewed.
+
+        Redirects are followed by hand so every hop gets the same address
+        check. aiohttp skips the resolver for IP literals, so those are
+        checked here before connecting.
+        """
+        import aiohttp
+
+        read = 0
+        target = url
+        try:
+            for _ in range(_MAX_REDIRECTS + 1):
+                host = urlsplit(target).hostname or ""
+                if not self._allow_private and _is_ip(host) and not _is_public(host):
+                    raise OSError(f"{host} is not a public address")
+                async with self._session.get(target, allow_redirects=False) as response:
+                    location = response.headers.get("Location")
+                    if response.status in _REDIRECTS and location:
+                        target = urljoin(target, location)
+                        continue
+                    content_type = response.headers.get("Content-Type", "")
+                    if response.status != 200 or "html" not in content_type.lower():
+                        return None
+                    decoder = codecs.getincrementaldecoder(_charset(response.charset))("replace")
+                    parser = HeadParser()
+                    async for chunk in response.content.iter_chunked(_CHUNK_SIZE):
+                        read += len(chunk)
+                        parser.feed(decoder.decode(chunk))
+                        if parser.complete or read >= self._max_head_bytes:
+                            break
+                    # Leaving the block early closes the connection instead
+                    # of draining the rest of the body.
+                    return parser.preview(url, target)
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError) as exc:
+            logger.info("Preview fetch for %s failed: %s", url, exc)
+            self.stats.add(failures=1)
+            return None
+        finally:
+            self.stats.add(fetches=1, bytes_fetched=read)
+
+    def _document(self, url: str) -> Any:
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return self._client_factory().collection(store.PREVIEWS_COLLECTION).document(key)
+
+    def _read_store(self, url: str) -> Optional[tuple[dict[str, Any], float]]:
+        snapshot = self._document(url).get()
+        if not snapshot.exists:
+            return None
+        data = snapshot.to_dict() or {}
+        expires_at = data.get("expiresAt")
+        preview = data.get("preview")
+        if not isinstance(expires_at, datetime) or not isinstance(preview, Mapping):
+            return None
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        remaining = (expires_at - datetime.now(timezone.utc)).total_seconds()
+        if remaining <= 0 or data.get("url") != url:
+            return None
+        return dict(preview), remaining
+
+    def _write_store(self, url: str, preview: dict[str, Any], ttl: float) -> None:
+        now = datetime.now(timezone.utc)
+        try:
+            self._document(url).set(
+                {
+                    "url": url,
+                    "preview": preview,
+                    "fetchedAt": now,
+                    "expiresAt": now + timedelta(seconds=ttl),
+                }
+            )
+        except Exception:
+            logger.exception("Could not store preview for %s", url)
+            self.stats.add(store_errors=1)
+
+
+def _charset(name: Optional[str]) -> str:
+    try:
+        return codecs.lookup(name or "utf-8").name
+    except LookupError:
+        return "utf-8"
+
+
+_service: Optional[PreviewService] = None
+_service_lock = threading.Lock()
+
+
+def get_service() -> PreviewService:
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = PreviewService()
+    return _service
+
+
+def handle_preview(
+    params: Mapping[str, Any], service: Optional[PreviewService] = None
+) -> tuple[dict[str, Any], int]:
+    """Serves one GET, returning `(body, status)`."""
+    try:
+        url = validate_url(params.get("url"))
+    except InvalidUrl as exc:
+        return {"status": "error", "error": str(exc)}, 400
+    result = (service or get_service()).preview(url)
+    return {"status": "ok", **result}, 200
@@ -1,13 +1,213 @@
-# Welcome to Cloud Functions for Firebase for Python!
-# To get started, simply uncomment the below code or create your own.
-# Deploy with `firebase deploy`
+# Cloud Functions for Firebase entry points for the Quitxt backend.
+# Deploy with `firebase deploy --only functions`.
+#
+# Each function runs on its own instances, and every cold start imports this
+# whole file. Keep it light: feature modules are imported inside the handler
+# that uses them and the Admin SDK is initialized on first use
+# (store.get_app). Triggers whose decorators need more than that are only
+# defined on the instance that serves them; firestore_fn alone loads
+# google-cloud-firestore, grpc and protobuf. Deploy-time discovery and the
+# emulator leave FUNCTION_TARGET unset and see every function.
+# `python -m benchmarks.cold_start` checks the import cost of each function
+# against a budget.
 
-from firebase_functions import https_fn
-from firebase_admin import initialize_app
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from typing import Optional
 
-# initialize_app()
-#
-#
-# @https_fn.on_request()
-# def on_request_example(req: https_fn.Request) -> https_fn.Response:
-#     return https_fn.Response("Hello world!")
\ No newline at end of file
+from firebase_functions import https_fn, scheduler_fn
+
+import health
+
+_TARGET = os.environ.get("FUNCTION_TARGET")
+
+
+def _serves(name: str) -> bool:
+    return _TARGET is None or _TARGET == name
+
+
+def _json_response(body: dict, status: int) -> https_fn.Response:
+    return https_fn.Response(
+        json.dumps(body), status=status, mimetype="application/json"
+    )
+
+
+def _health_response(req: https_fn.Request) -> https_fn.Response:
+    body, status = health.handle_health(req.args)
+    return _json_response(body, status)
+
+
+def _is_keep_alive(req: https_fn.Request) -> bool:
+    return req.method == "GET" and "warm" in req.args
+
+
+def _is_metrics(req: https_fn.Request) -> bool:
+    return req.method == "GET" and "metrics" in req.args
+
+
+def _verified_uid(req: https_fn.Request) -> Optional[str]:
+    """The caller's uid from its Firebase ID token, or None."""
+    import identity
+
+    try:
+        return identity.verified_uid(req.headers.get("Authorization"))
+    except identity.Unauthorized:
+        return None
+
+
+def _unauthorized() -> https_fn.Response:
+    return https_fn.Response(
+        json.dumps({"status": "error", "error": "a valid Firebase ID token is required"}),
+        status=401,
+        mimetype="application/json",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+
+def _metrics_response(req: https_fn.Request) -> https_fn.Response:
+    """This instance's stage histograms in the Prometheus text format."""
+    if _verified_uid(req) is None:
+        return _unauthorized()
+    import tracing
+
+    return https_fn.Response(
+        tracing.render(), status=200, content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+# Cloud Run sends SIGKILL 10s after SIGTERM; leave time to exit cleanly.
+_DRAIN_TIMEOUT_SEC = 8
+
+
+def _drain_ingest(signum: int, frame) -> None:
+    """Writes the messages `mobile` has acked before the instance goes away."""
+    ingest = sys.modules.get("ingest")
+    if ingest is not None:
+        ingest.shutdown(_DRAIN_TIMEOUT_SEC)
+    previous = _previous_sigterm
+    if callable(previous):
+        previous(signum, frame)
+    elif previous != signal.SIG_IGN:
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+
+_previous_sigterm = None
+if _serves("mobile") and threading.current_thread() is threading.main_thread():
+    _previous_sigterm = signal.signal(signal.SIGTERM, _drain_ingest)
+
+
+# Acked messages are written after the response, so one instance is always
+# kept to drain the ingest queue, and requests share its pipeline. More
+# than one concurrent request per instance needs at least one vCPU.
+@https_fn.on_request(min_instances=1, concurrency=80, cpu=1)
+def mobile(req: https_fn.Request) -> https_fn.Response:
+    """`/api/mobile` endpoint that DashMessagingService.sendMessage posts to.
+
+    A GET is the client's connection probe and is answered as a health check.
+    """
+    if _is_metrics(req):
+        return _metrics_response(req)
+    if req.method == "GET":
+        return _health_response(req)
+    if req.method != "POST":
+        return https_fn.Response(status=405, headers={"Allow": "GET, POST"})
+    import ingest
+
+    uid = None
+    if ingest.REQUIRE_ID_TOKEN or "Authorization" in req.headers:
+        uid = _verified_uid(req)
+        if uid is None:
+            return _unauthorized()
+    body, status = ingest.handle_ingest(req.get_json(silent=True), uid=uid)
+    return _json_response(body, status)
+
+
+@https_fn.on_request()
+def health_check(req: https_fn.Request) -> https_fn.Response:
+    """Liveness probe that never touches Firestore."""
+    return _health_response(req)
+
+
+@https_fn.on_request()
+def history_page(req: https_fn.Request) -> https_fn.Response:
+    """Cursor-paginated, pre-normalized chat history of the signed-in user."""
+    if _is_metrics(req):
+        return _metrics_response(req)
+    if _is_keep_alive(req):
+        return _health_response(req)
+    if req.method != "GET":
+        return https_fn.Response(status=405, headers={"Allow": "GET"})
+    user_id = _verified_uid(req)
+    if user_id is None:
+        return _unauthorized()
+    import history
+
+    body, status = history.handle_history(req.args, user_id)
+    return _json_response(body, status)
+
+
+@https_fn.on_request()
+def preview_link(req: https_fn.Request) -> https_fn.Response:
+    """Shared `LinkPreview` for a URL, fetched once across all devices."""
+    if _is_metrics(req):
+        return _metrics_response(req)
+    if _is_keep_alive(req):
+        return _health_response(req)
+    if req.method != "GET":
+        return https_fn.Response(status=405, headers={"Allow": "GET"})
+    import link_preview
+
+    body, status = link_preview.handle_preview(req.args)
+    return _json_response(body, status)
+
+
+if _serves("rollup_analytics_event"):
+    from firebase_functions import firestore_fn
+
+    import analytics_rollup
+    import store
+
+    @firestore_fn.on_document_created(document=f"{store.EVENTS_COLLECTION}/{{eventId}}")
+    def rollup_analytics_event(
+        event: firestore_fn.Event[firestore_fn.DocumentSnapshot | None],
+    ) -> None:
+        """Folds each new analytics event into the daily and per-user rollups."""
+        if event.data is None:
+            return
+        analytics_rollup.apply_event(
+            store.get_firestore(), event.params["eventId"], event.data.to_dict() or {}
+        )
+
+    # Redelivered events are skipped by their applied marker, so a failed
+    # rollup is safe to retry. FirestoreOptions has no `retry` option and
+    # always deploys retry=False, so it is set on the deploy manifest here.
+    rollup_analytics_event.__firebase_endpoint__.eventTrigger["retry"] = True
+
+
+# Leave a minute of the 9-minute timeout to checkpoint and return.
+_JOB_TIMEOUT_SEC = 540
+_JOB_BUDGET_SEC = _JOB_TIMEOUT_SEC - 60
+
+if _serves("deliver_scheduled_messages"):
+    import scheduled_delivery
+
+    @scheduler_fn.on_schedule(
+        schedule=f"every {scheduled_delivery.BUCKET_MINUTES} minutes",
+        timeout_sec=_JOB_TIMEOUT_SEC,
+    )
+    def deliver_scheduled_messages(event: scheduler_fn.ScheduledEvent) -> None:
+        """Writes every due coaching message and poll into the users' chats."""
+        scheduled_delivery.DeliveryScheduler().run(
+            deadline=time.monotonic() + _JOB_BUDGET_SEC
+        )
+
+
+@scheduler_fn.on_schedule(schedule="every 5 minutes")
+def keep_warm(event: scheduler_fn.ScheduledEvent) -> None:
+    """Keeps one instance of each app-facing function warm."""
+    health.keep_warm()
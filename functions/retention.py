@@ -0,0 +1,448 @@
+"""Streaming export and retention compaction for chat and analytics data.
+
+`getUserJourney` and study exports read whole collections into memory, and
+the per-user `messages/{uid}/chat` collections only ever grow. This module
+handles both with one generator pipeline:
+
+* `export` streams every chat message, archived chat message and analytics
+  event in `__name__` order, one page at a time with the next page read
+  ahead. Records go to gzip NDJSON shards of at most `shard_records` lines
+  each, plus a `manifest.json`, in a local directory or under a
+  `gs://bucket/prefix`. Memory stays at about two pages and one compressor
+  whatever the size of the study.
+* `compact` moves each user's chat messages older than the retention window
+  into `messages/{uid}/chatArchive/{chunkId}` documents of up to
+  `MAX_ARCHIVE_MESSAGES` messages. Each chunk is written in the same batch
+  that deletes its source messages, so a run that is cut off leaves every
+  message in exactly one place, and the next run carries on. Live chat
+  queries and listeners then touch only recent messages; `history` reads
+  the chunks once a user pages past the live messages.
+
+Exempt the `messages` field of the `chatArchive` collection group from
+indexing; it holds hundreds of maps per document. The app still reads its
+chat straight from `messages/{uid}/chat`, so archived messages are only
+visible through `history_page`. Do not schedule the compaction until the
+app pages its history through that endpoint. Until then every job is run
+by hand; `clear` deletes a user's live and archived chat together, as
+`clearAllMessagesInFirebase` does in the app:
+
+    python -m retention export --out gs://quitxt-exports/2026-10-17
+    python -m retention compact --older-than-days 90
+    python -m retention clear USER_ID
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import gzip
+import json
+import logging
+import os
+import posixpath
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, BinaryIO, Callable, Iterator, Optional
+
+import analytics_rollup
+import concurrency
+import counters
+import store
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 500
+DEFAULT_SHARD_RECORDS = 250_000
+DEFAULT_RETENTION = timedelta(days=90)
+# One archive write plus one delete per message must fit in one batch.
+MAX_ARCHIVE_MESSAGES = 450
+# Firestore documents are capped at 1 MiB; leave room for the chunk's own fields.
+MAX_ARCHIVE_BYTES = 900_000
+
+# Archive chunks are up to MAX_ARCHIVE_BYTES each, so they are read a few at a time.
+_ARCHIVE_PAGE_SIZE = 8
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _json_default(value: Any) -> Any:
+    """Encodes the Firestore value types that `json` does not know."""
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    if hasattr(value, "latitude") and hasattr(value, "longitude"):
+        return {"latitude": value.latitude, "longitude": value.longitude}
+    if hasattr(value, "path"):
+        return value.path
+    return str(value)
+
+
+def encode_record(record: Any) -> bytes:
+    """One NDJSON line for `record`."""
+    text = json.dumps(record, default=_json_default, separators=(",", ":"), ensure_ascii=False)
+    return text.encode() + b"\n"
+
+
+def chat_records(db: Any, page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[dict[str, Any]]:
+    """Every chat message, live ones first and then the archived ones."""
+    live = db.collection_group(store.CHAT_SUBCOLLECTION).order_by("__name__")
+    for page in concurrency.iter_pages(live, page_size):
+        for snapshot in page:
+            yield {
+                "userId": snapshot.reference.parent.parent.id,
+                "id": snapshot.id,
+                "archived": False,
+                "data": snapshot.to_dict() or {},
+            }
+    archived = db.collection_group(store.CHAT_ARCHIVE_SUBCOLLECTION).order_by("__name__")
+    for page in concurrency.iter_pages(archived, _ARCHIVE_PAGE_SIZE):
+        for snapshot in page:
+            user_id = snapshot.reference.parent.parent.id
+            for entry in (snapshot.to_dict() or {}).get("messages") or []:
+                yield {
+                    "userId": user_id,
+                    "id": entry.get("id"),
+                    "archived": True,
+                    "data": entry.get("data") or {},
+                }
+
+
+def event_records(db: Any, page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[dict[str, Any]]:
+    """Every analytics event in id order."""
+    query = db.collection(store.EVENTS_COLLECTION).order_by("__name__")
+    for page in concurrency.iter_pages(query, page_size):
+        for snapshot in page:
+            data = snapshot.to_dict() or {}
+            yield {"id": snapshot.id, "userId": analytics_rollup.event_user_id(data), "data": data}
+
+
+Opener = Callable[[str], BinaryIO]
+
+
+def opener(destination: str) -> Opener:
+    """Opens files by name in a local directory or under `gs://bucket/prefix`."""
+    if destination.startswith("gs://"):
+        from google.cloud import storage
+
+        bucket_name, _, prefix = destination[len("gs://"):].partition("/")
+        bucket = storage.Client().bucket(bucket_name)
+        return lambda name: bucket.blob(posixpath.join(prefix, name)).open(
+            "wb", ignore_flush=True
+        )
+    os.makedirs(destination, exist_ok=True)
+    return lambda name: open(os.path.join(destination, name), "wb")
+
+
+class ShardWriter:
+    """Writes records to `{name}-00000.ndjson.gz`, `{name}-00001...` shards."""
+
+    def __init__(
+        self,
+        open_file: Opener,
+        name: str,
+        max_records: int = DEFAULT_SHARD_RECORDS,
+        compresslevel: int = 6,
+    ) -> None:
+        self._open_file = open_file
+        self._name = name
+        self._max_records = max_records
+        self._compresslevel = compresslevel
+        self._raw: Optional[BinaryIO] = None
+        self._gzip: Optional[gzip.GzipFile] = None
+        self.files: list[dict[str, Any]] = []
+
+    def write(self, record: Any) -> None:
+        line = encode_record(record)
+        if self._gzip is None or self.files[-1]["records"] >= self._max_records:
+            self._rotate()
+        self._gzip.write(line)
+        self.files[-1]["records"] += 1
+        self.files[-1]["bytes"] += len(line)
+
+    def _rotate(self) -> None:
+        self._finish()
+        name = f"{self._name}-{len(self.files):05d}.ndjson.gz"
+        self._raw = self._open_file(name)
+        self._gzip = gzip.GzipFile(
+            filename="", mode="wb", fileobj=self._raw, compresslevel=self._compresslevel
+        )
+        self.files.append({"name": name, "records": 0, "bytes": 0})
+
+    def _finish(self) -> None:
+        if self._gzip is not None:
+            self._gzip.close()
+            self._raw.close()
+            self._gzip = self._raw = None
+
+    def close(self) -> list[dict[str, Any]]:
+        """Closes the open shard; returns `name`, `records` and raw `bytes` per shard."""
+        self._finish()
+        return self.files
+
+
+@dataclass
+class ExportStats:
+    chat: int = 0
+    archived: int = 0
+    events: int = 0
+    shards: int = 0
+    bytes: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def docs_per_sec(self) -> float:
+        return (self.chat + self.events) / self.elapsed if self.elapsed else 0.0
+
+
+def export(
+    db: Any,
+    destination: str,
+    *,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    shard_records: int = DEFAULT_SHARD_RECORDS,
+    events: bool = True,
+) -> ExportStats:
+    """Streams chat messages (and analytics events) into shards at `destination`."""
+    stats = ExportStats()
+    started = time.perf_counter()
+    open_file = opener(destination)
+    sources = [("chat", chat_records(db, page_size))]
+    if events:
+        sources.append(("events", event_records(db, page_size)))
+    files: list[dict[str, Any]] = []
+    for name, records in sources:
+        writer = ShardWriter(open_file, name, shard_records)
+        try:
+            for record in records:
+                writer.write(record)
+                if name == "events":
+                    stats.events += 1
+                else:
+                    stats.chat += 1
+                    stats.archived += record["archived"]
+        finally:
+            files.extend(writer.close())
+    stats.shards = len(files)
+    stats.bytes = sum(f["bytes"] for f in files)
+    manifest = {
+        "exportedAt": datetime.now(timezone.utc),
+        "chat": stats.chat,
+        "archived": stats.archived,
+        "events": stats.events,
+        "files": files,
+    }
+    with open_file("manifest.json") as out:
+        out.write(encode_record(manifest))
+    stats.elapsed = time.perf_counter() - started
+    logger.info(
+        "Exported %d chat messages and %d events to %d shards (%.0f docs/s)",
+        stats.chat,
+        stats.events,
+        stats.shards,
+        stats.docs_per_sec,
+    )
+    return stats
+
+
+@dataclass
+class CompactionStats(counters.Counters):
+    users: int = 0
+    archived: int = 0
+    chunks: int = 0
+    failed: int = 0
+    completed: bool = True
+    elapsed: float = 0.0
+
+    @property
+    def docs_per_sec(self) -> float:
+        return self.archived / self.elapsed if self.elapsed else 0.0
+
+
+def _chunk_id(created_at: datetime, doc_id: str) -> str:
+    """Sorts chunks by their first message: `{micros since epoch}~{docId}`."""
+    micros = (created_at - _EPOCH) // timedelta(microseconds=1)
+    return f"{micros:017d}~{doc_id}"
+
+
+def _write_chunk(db: Any, user_id: str, chunk: list[tuple[Any, dict[str, Any]]]) -> None:
+    from google.cloud.firestore import SERVER_TIMESTAMP
+
+    (first, first_data), (last, last_data) = chunk[0], chunk[-1]
+    ref = store.chat_archive_collection(db, user_id).document(
+        _chunk_id(first_data["createdAt"], first.id)
+    )
+    batch = db.batch()
+    batch.set(
+        ref,
+        {
+            "userId": user_id,
+            "count": len(chunk),
+            "firstCreatedAt": first_data["createdAt"],
+            "lastCreatedAt": last_data["createdAt"],
+            "firstId": first.id,
+            "lastId": last.id,
+            "messages": [{"id": snapshot.id, "data": data} for snapshot, data in chunk],
+            "archivedAt": SERVER_TIMESTAMP,
+        },
+    )
+    for snapshot, _ in chunk:
+        batch.delete(snapshot.reference)
+    batch.commit()
+
+
+def compact_user(
+    db: Any,
+    user_id: str,
+    cutoff: datetime,
+    *,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    max_messages: int = MAX_ARCHIVE_MESSAGES,
+) -> tuple[int, int]:
+    """Archives `user_id`'s messages created before `cutoff`.
+
+    Returns `(messages archived, chunks written)`. Messages too large to
+    share a chunk with anything else stay live.
+    """
+    if not 1 <= max_messages < store.MAX_BATCH_WRITES:
+        raise ValueError(f"max_messages must be between 1 and {store.MAX_BATCH_WRITES - 1}")
+    query = (
+        store.chat_collection(db, user_id)
+        .where("createdAt", "<", cutoff)
+        .order_by("createdAt")
+        .order_by("__name__")
+    )
+    chunk: list[tuple[Any, dict[str, Any]]] = []
+    size = archived = chunks = 0
+    for page in concurrency.iter_pages(query, page_size):
+        for snapshot in page:
+            data = snapshot.to_dict() or {}
+            entry_size = len(encode_record(data)) + len(snapshot.id)
+            if entry_size > MAX_ARCHIVE_BYTES:
+                continue
+            if chunk and (len(chunk) >= max_messages or size + entry_size > MAX_ARCHIVE_BYTES):
+                _write_chunk(db, user_id, chunk)
+                archived, chunks = archived + len(chunk), chunks + 1
+                chunk, size = [], 0
+            chunk.append((snapshot, data))
+            size += entry_size
+    if chunk:
+        _write_chunk(db, user_id, chunk)
+        archived, chunks = archived + len(chunk), chunks + 1
+    return archived, chunks
+
+
+def clear_user(db: Any, user_id: str, *, page_size: int = DEFAULT_PAGE_SIZE) -> int:
+    """Deletes all of `user_id`'s chat, live and archived; returns the doc count."""
+    deleted = 0
+    for collection in (
+        store.chat_collection(db, user_id),
+        store.chat_archive_collection(db, user_id),
+    ):
+        query = collection.order_by("__name__")
+        for page in concurrency.iter_pages(query, min(page_size, store.MAX_BATCH_WRITES)):
+            batch = db.batch()
+            for snapshot in page:
+                batch.delete(snapshot.reference)
+            batch.commit()
+            deleted += len(page)
+    return deleted
+
+
+def compact(
+    db: Any,
+    *,
+    retention: timedelta = DEFAULT_RETENTION,
+    now: Optional[datetime] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    max_messages: int = MAX_ARCHIVE_MESSAGES,
+    workers: int = 8,
+    deadline: Optional[float] = None,
+) -> CompactionStats:
+    """Archives every user's chat older than `retention`, `workers` users at a time.
+
+    `deadline` is a `time.monotonic()` value; once it passes no new users
+    are started and `completed` is False. A failed user is logged and
+    counted, and left for the next run.
+    """
+    cutoff = (now or datetime.now(timezone.utc)) - retention
+    stats = CompactionStats()
+    started = time.perf_counter()
+
+    def run(user_id: str) -> None:
+        archived, chunks = compact_user(
+            db, user_id, cutoff, page_size=page_size, max_messages=max_messages
+        )
+        stats.add(users=1, archived=archived, chunks=chunks)
+
+    def settle(future: Future) -> None:
+        error = future.exception()
+        if error is not None:
+            logger.error("Compaction of one user failed", exc_info=error)
+            stats.add(failed=1)
+
+    users = db.collection(store.MESSAGES_COLLECTION).list_documents(page_size=page_size)
+    with concurrency.BoundedExecutor(workers, 2 * workers, "compact") as pool:
+        for ref in users:
+            if deadline is not None and time.monotonic() >= deadline:
+                stats.completed = False
+                break
+            pool.submit(run, ref.id).add_done_callback(settle)
+    stats.elapsed = time.perf_counter() - started
+    logger.info(
+        "Archived %d messages into %d chunks for %d users (%.0f docs/s, completed=%s)",
+        stats.archived,
+        stats.chunks,
+        stats.users,
+        stats.docs_per_sec,
+        stats.completed,
+    )
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Chat export and retention compaction")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write NDJSON export shards")
+    export_parser.add_argument("--out", required=True, help="directory or gs://bucket/prefix")
+    export_parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE)
+    export_parser.add_argument("--shard-records", type=int, default=DEFAULT_SHARD_RECORDS)
+    export_parser.add_argument("--no-events", action="store_true")
+    compact_parser = commands.add_parser("compact", help="archive old chat messages")
+    compact_parser.add_argument(
+        "--older-than-days", type=int, default=DEFAULT_RETENTION.days
+    )
+    compact_parser.add_argument("--workers", type=int, default=8)
+    clear_parser = commands.add_parser("clear", help="delete a user's live and archived chat")
+    clear_parser.add_argument("user_id")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db = store.get_firestore()
+    if args.command == "export":
+        stats = export(
+            db,
+            args.out,
+            page_size=args.page_size,
+            shard_records=args.shard_records,
+            events=not args.no_events,
+        )
+        print(
+            f"exported {stats.chat:,} chat messages ({stats.archived:,} archived) and "
+            f"{stats.events:,} events to {stats.shards} shards"
+        )
+    elif args.command == "compact":
+        stats = compact(
+            db, retention=timedelta(days=args.older_than_days), workers=args.workers
+        )
+        print(f"archived {stats.archived:,} messages for {stats.users:,} users")
+    else:
+        deleted = clear_user(db, args.user_id)
+        print(f"deleted {deleted:,} chat documents for {args.user_id}")
+
+
+if __name__ == "__main__":
+    main()
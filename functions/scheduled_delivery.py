@@ -0,0 +1,504 @@
+"""Scheduled delivery of coaching texts and polls into `messages/{uid}/chat`.
+
+Messages the program sends on a timetable are indexed by the UTC window they
+fall due in, so a run reads only what is due instead of scanning every user:
+
+* `messageTemplates/{templateId}`: `eventTypeCode`, `isPoll` and
+  `content.{language}` holding `messageBody` and optional `questionsAnswers`.
+* `deliveryBuckets/{bucket}/due/{templateId}~{userId}`: one entry per
+  recipient with `userId`, `templateId` and `language`. Buckets are
+  `BUCKET_MINUTES` wide and named by their start, e.g. `20240501T0815`.
+* `deliveryRuns/{bucket}`: the checkpoint of each bucket. It holds the last
+  delivered entry id, a count of written documents, a lease and the status.
+  A run takes a bucket's lease in a transaction before sending it.
+
+A run only sends buckets that have ended, and marks them done even when they
+are empty. `schedule` therefore files any `send_at` that is past, or too
+close to the end of its bucket, under the bucket that is still open.
+
+Each template is rendered once per language and the result is shared by
+every recipient. Chat writes go through `BulkWriter`, which keeps several
+batches in flight behind a throttle that ramps up by the 500/50/5 rule
+(500 ops/s, +50% every 5 minutes). The checkpoint only moves past a page
+once all of that page's writes have committed. Chat documents use
+deterministic ids. A run that resumes a bucket skips the documents that
+already exist on its first page, which a run that was cut off may have
+written, so a delivered message keeps its `createdAt` and its place in the
+chat.
+
+Set a Firestore TTL policy on `expireAt` in the `due` collection group to
+drop delivered entries.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Iterable, Mapping, Optional
+
+import concurrency
+import counters
+import store
+
+logger = logging.getLogger(__name__)
+
+DUE_SUBCOLLECTION = "due"
+BUCKET_MINUTES = 15
+DEFAULT_LANGUAGE = "en"
+
+_BUCKET_FORMAT = "%Y%m%dT%H%M"
+_ENTRY_RETENTION = timedelta(days=7)
+# Entries due sooner than this go to the bucket open at that time, so a run
+# that starts as the write lands cannot have closed their bucket already.
+_SCHEDULE_MARGIN = timedelta(minutes=1)
+
+
+def bucket_for(when: datetime) -> str:
+    """Names the delivery window that `when` falls in."""
+    when = when.astimezone(timezone.utc) if when.tzinfo else when.replace(tzinfo=timezone.utc)
+    start = when.replace(minute=when.minute - when.minute % BUCKET_MINUTES, second=0, microsecond=0)
+    return start.strftime(_BUCKET_FORMAT)
+
+
+def _bucket_start(bucket: str) -> datetime:
+    return datetime.strptime(bucket, _BUCKET_FORMAT).replace(tzinfo=timezone.utc)
+
+
+@dataclass(frozen=True)
+class Delivery:
+    """One template due for one user at `send_at`."""
+
+    user_id: str
+    template_id: str
+    send_at: datetime
+    language: str = DEFAULT_LANGUAGE
+
+    @property
+    def entry_id(self) -> str:
+        return f"{self.template_id}~{self.user_id}"
+
+
+def render(
+    template_id: str, template: Mapping[str, Any], language: str
+) -> Optional[dict[str, Any]]:
+    """Chat fields shared by every `language` recipient of a template.
+
+    Falls back to `DEFAULT_LANGUAGE`, then to any language the template has.
+    Returns None when the template has no usable content.
+    """
+    content = template.get("content")
+    if not isinstance(content, Mapping) or not content:
+        return None
+    localized = (
+        content.get(language) or content.get(DEFAULT_LANGUAGE) or next(iter(content.values()))
+    )
+    if not isinstance(localized, Mapping) or not localized.get("messageBody"):
+        return None
+    fields: dict[str, Any] = {
+        "messageBody": str(localized["messageBody"]),
+        "source": "server",
+        "senderId": "server",
+        "eventTypeCode": template.get("eventTypeCode", 1),
+        "isPoll": "y" if template.get("isPoll") else "n",
+        "messageOrder": "server",
+        "templateId": template_id,
+    }
+    questions_answers = localized.get("questionsAnswers")
+    if isinstance(questions_answers, Mapping) and questions_answers:
+        fields["questionsAnswers"] = dict(questions_answers)
+    return fields
+
+
+class RampingThrottle:
+    """Token bucket whose rate follows Firestore's 500/50/5 ramp-up rule."""
+
+    def __init__(
+        self,
+        initial_rate: float = 500.0,
+        max_rate: float = 10_000.0,
+        ramp_every: float = 300.0,
+        ramp_factor: float = 1.5,
+    ) -> None:
+        self._initial_rate = initial_rate
+        self._max_rate = max_rate
+        self._ramp_every = ramp_every
+        self._ramp_factor = ramp_factor
+        self._started = time.monotonic()
+        self._tokens = 0.0
+        self._updated = self._started
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self) -> float:
+        steps = int((time.monotonic() - self._started) // self._ramp_every)
+        return min(self._max_rate, self._initial_rate * self._ramp_factor**steps)
+
+    def acquire(self, count: int) -> None:
+        """Blocks until `count` operations may be sent."""
+        with self._lock:
+            now = time.monotonic()
+            rate = self.rate
+            # Allow up to one second of burst so a full batch is never starved.
+            burst = max(rate, count)
+            self._tokens = min(burst, self._tokens + (now - self._updated) * rate)
+            self._updated = now
+            self._tokens -= count
+            wait = -self._tokens / rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+
+class BulkWriter:
+    """Batches `set` writes and commits several batches concurrently.
+
+    Modeled on the Firestore `BulkWriter`: writes are grouped into batches of
+    `batch_size`, each batch waits on the throttle, at most `max_in_flight`
+    commits run at once and failed commits are retried with backoff. `flush`
+    waits for everything added so far and re-raises the first failure.
+    """
+
+    def __init__(
+        self,
+        db: Any,
+        throttle: Optional[RampingThrottle] = None,
+        *,
+        batch_size: int = store.MAX_BATCH_WRITES,
+        max_in_flight: int = 8,
+        max_attempts: int = 5,
+    ) -> None:
+        if not 1 <= batch_size <= store.MAX_BATCH_WRITES:
+            raise ValueError(f"batch_size must be between 1 and {store.MAX_BATCH_WRITES}")
+        self._db = db
+        self._throttle = throttle
+        self._batch_size = batch_size
+        self._max_attempts = max_attempts
+        self._pool = concurrency.BoundedExecutor(max_in_flight, thread_name_prefix="bulk-writer")
+        self._pending: list[tuple[Any, dict[str, Any]]] = []
+        self._futures: list[Future] = []
+        self.written = 0
+        self.commits = 0
+        self._count_lock = threading.Lock()
+
+    def set(self, ref: Any, data: dict[str, Any]) -> None:
+        self._pending.append((ref, data))
+        if len(self._pending) >= self._batch_size:
+            self._send()
+
+    def _send(self) -> None:
+        writes, self._pending = self._pending, []
+        if self._throttle is not None:
+            self._throttle.acquire(len(writes))
+        self._futures.append(self._pool.submit(self._commit, writes))
+
+    def _commit(self, writes: list[tuple[Any, dict[str, Any]]]) -> None:
+        def commit() -> None:
+            batch = self._db.batch()
+            for ref, data in writes:
+                batch.set(ref, data)
+            batch.commit()
+
+        concurrency.retry(commit, attempts=self._max_attempts, base=0.1, what="Bulk commit")
+        with self._count_lock:
+            self.written += len(writes)
+            self.commits += 1
+
+    def flush(self) -> None:
+        if self._pending:
+            self._send()
+        futures, self._futures = self._futures, []
+        errors = [f.exception() for f in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown(wait=True)
+
+
+@dataclass
+class DeliveryStats(counters.Counters):
+    written: int = 0
+    skipped: int = 0
+    pages: int = 0
+    buckets: int = 0
+    completed: bool = True
+    elapsed: float = 0.0
+
+    @property
+    def docs_per_sec(self) -> float:
+        return self.written / self.elapsed if self.elapsed else 0.0
+
+
+class DeliveryScheduler:
+    """Indexes deliveries by bucket and sends every due bucket in order."""
+
+    def __init__(
+        self,
+        client_factory: store.ClientFactory = store.get_firestore,
+        *,
+        page_size: int = 1_000,
+        batch_size: int = store.MAX_BATCH_WRITES,
+        max_in_flight: int = 8,
+        initial_rate: Optional[float] = 500.0,
+        max_attempts: int = 5,
+        lookback: timedelta = timedelta(days=1),
+        lease: timedelta = timedelta(minutes=10),
+    ) -> None:
+        self._client_factory = client_factory
+        self._page_size = page_size
+        self._batch_size = batch_size
+        self._max_in_flight = max_in_flight
+        self._initial_rate = initial_rate
+        self._max_attempts = max_attempts
+        self._lookback = lookback
+        self._lease = lease
+
+    def schedule(self, deliveries: Iterable[Delivery], now: Optional[datetime] = None) -> int:
+        """Adds index entries; rescheduling the same entry overwrites it.
+
+        Deliveries due before `now` (plus a margin) go out with the next run.
+        """
+        earliest = (now or datetime.now(timezone.utc)) + _SCHEDULE_MARGIN
+        db = self._client_factory()
+        buckets = db.collection(store.BUCKETS_COLLECTION)
+        count = 0
+        throttle = RampingThrottle(self._initial_rate) if self._initial_rate else None
+        writer = self._writer(db, throttle)
+        try:
+            for delivery in deliveries:
+                bucket = bucket_for(max(delivery.send_at, earliest))
+                due = buckets.document(bucket).collection(DUE_SUBCOLLECTION)
+                ref = due.document(delivery.entry_id)
+                writer.set(
+                    ref,
+                    {
+                        "userId": delivery.user_id,
+                        "templateId": delivery.template_id,
+                        "language": delivery.language,
+                        "sendAt": delivery.send_at,
+                        "expireAt": _bucket_start(bucket) + _ENTRY_RETENTION,
+                    },
+                )
+                count += 1
+        finally:
+            writer.close()
+        return count
+
+    def run(
+        self, now: Optional[datetime] = None, deadline: Optional[float] = None
+    ) -> DeliveryStats:
+        """Delivers every unfinished bucket up to `now`, oldest first.
+
+        `deadline` is a `time.monotonic()` value. Once it passes, the run
+        checkpoints and returns with `completed` False; the next run resumes.
+        """
+        now = now or datetime.now(timezone.utc)
+        stats = DeliveryStats()
+        started = time.perf_counter()
+        db = self._client_factory()
+        runs = db.collection(store.RUNS_COLLECTION)
+        candidates = self._buckets(now)
+        checkpoints = {
+            snapshot.id: snapshot.to_dict() or {}
+            for snapshot in db.get_all([runs.document(b) for b in candidates])
+            if snapshot.exists
+        }
+        renderer = _Renderer(db)
+        throttle = RampingThrottle(self._initial_rate) if self._initial_rate else None
+        for bucket in candidates:
+            if checkpoints.get(bucket, {}).get("status") == "done":
+                continue
+            checkpoint = self._claim(db, runs.document(bucket))
+            if checkpoint is None:
+                logger.info("Bucket %s is leased by another run, skipping", bucket)
+                continue
+            stats.add(buckets=1)
+            cursor = checkpoint.get("cursor")
+            resumed = "status" in checkpoint
+            if not self._deliver(
+                db, bucket, cursor, resumed, renderer, throttle, stats, deadline
+            ):
+                stats.completed = False
+                break
+        stats.elapsed = time.perf_counter() - started
+        logger.info(
+            "Delivered %d messages from %d buckets (%.0f docs/s, completed=%s)",
+            stats.written,
+            stats.buckets,
+            stats.docs_per_sec,
+            stats.completed,
+        )
+        return stats
+
+    def _claim(self, db: Any, run_ref: Any) -> Optional[dict[str, Any]]:
+        """Takes the bucket's lease; returns its checkpoint, or None if taken."""
+        from google.cloud import firestore
+
+        @firestore.transactional
+        def claim(transaction: Any) -> Optional[dict[str, Any]]:
+            snapshot = run_ref.get(transaction=transaction)
+            checkpoint = (snapshot.to_dict() or {}) if snapshot.exists else {}
+            now = datetime.now(timezone.utc)
+            lease_until = checkpoint.get("leaseUntil")
+            if checkpoint.get("status") == "done" or (
+                isinstance(lease_until, datetime) and lease_until > now
+            ):
+                return None
+            transaction.set(
+                run_ref,
+                {"bucket": run_ref.id, "updatedAt": now, "leaseUntil": now + self._lease},
+                merge=True,
+            )
+            return checkpoint
+
+        return claim(db.transaction())
+
+    def _writer(self, db: Any, throttle: Optional[RampingThrottle]) -> BulkWriter:
+        return BulkWriter(
+            db,
+            throttle,
+            batch_size=self._batch_size,
+            max_in_flight=self._max_in_flight,
+            max_attempts=self._max_attempts,
+        )
+
+    def _buckets(self, now: datetime) -> list[str]:
+        """Buckets within the lookback that have fully ended by `now`.
+
+        A bucket still open could gain entries after it was marked done, so
+        messages go out up to `BUCKET_MINUTES` after their `sendAt`.
+        """
+        step = timedelta(minutes=BUCKET_MINUTES)
+        last = _bucket_start(bucket_for(now)) - step
+        first = _bucket_start(bucket_for(now - self._lookback))
+        buckets = []
+        while first <= last:
+            buckets.append(first.strftime(_BUCKET_FORMAT))
+            first += step
+        return buckets
+
+    def _deliver(
+        self,
+        db: Any,
+        bucket: str,
+        cursor: Optional[str],
+        resumed: bool,
+        renderer: "_Renderer",
+        throttle: Optional[RampingThrottle],
+        stats: DeliveryStats,
+        deadline: Optional[float],
+    ) -> bool:
+        """Sends one bucket from `cursor`; False if the deadline cut it short."""
+        run_ref = db.collection(store.RUNS_COLLECTION).document(bucket)
+        query = (
+            db.collection(store.BUCKETS_COLLECTION)
+            .document(bucket)
+            .collection(DUE_SUBCOLLECTION)
+            .order_by("__name__")
+        )
+        after = None if cursor is None else {"__name__": cursor}
+        pages = concurrency.iter_pages(query, self._page_size, after)
+        writer = self._writer(db, throttle)
+        try:
+            page = next(pages, None)
+            if page:
+                self._checkpoint(run_ref, bucket, cursor, "running", 0)
+            while page:
+                before = writer.written
+                writes = []
+                for snapshot in page:
+                    entry = snapshot.to_dict() or {}
+                    fields = renderer.fields(entry.get("templateId"), entry.get("language"))
+                    user_id = entry.get("userId")
+                    if fields is None or not isinstance(user_id, str) or not user_id:
+                        stats.add(skipped=1)
+                        continue
+                    message_id = f"sched-{bucket}-{entry['templateId']}"
+                    ref = store.chat_collection(db, user_id).document(message_id)
+                    data = {**fields, "serverMessageId": message_id}
+                    data["createdAt"] = _server_timestamp()
+                    writes.append((ref, data))
+                if resumed:
+                    unwritten = _unwritten(db, writes)
+                    stats.add(skipped=len(writes) - len(unwritten))
+                    writes, resumed = unwritten, False
+                for ref, data in writes:
+                    writer.set(ref, data)
+                cursor = page[-1].id
+                # The next page is read while this page's batches commit.
+                next_page = next(pages, None)
+                writer.flush()
+                written = writer.written - before
+                stats.add(written=written, pages=1)
+                if deadline is not None and time.monotonic() >= deadline and next_page:
+                    self._checkpoint(run_ref, bucket, cursor, "paused", written)
+                    return False
+                self._checkpoint(run_ref, bucket, cursor, "running", written)
+                page = next_page
+            self._checkpoint(run_ref, bucket, cursor, "done", 0)
+            return True
+        finally:
+            pages.close()
+            writer.close()
+
+    def _checkpoint(
+        self, run_ref: Any, bucket: str, cursor: Optional[str], status: str, written: int
+    ) -> None:
+        from google.cloud.firestore import Increment
+
+        now = datetime.now(timezone.utc)
+        run_ref.set(
+            {
+                "bucket": bucket,
+                "cursor": cursor,
+                "status": status,
+                "written": Increment(written),
+                "updatedAt": now,
+                # Paused and finished buckets are free for the next run.
+                "leaseUntil": now + self._lease if status == "running" else now,
+            },
+            merge=True,
+        )
+
+
+class _Renderer:
+    """Loads each template once per run and renders each language once."""
+
+    def __init__(self, db: Any) -> None:
+        self._db = db
+        self._templates: dict[str, Optional[Mapping[str, Any]]] = {}
+        self._rendered: dict[tuple[str, str], Optional[dict[str, Any]]] = {}
+
+    def fields(self, template_id: Any, language: Any) -> Optional[dict[str, Any]]:
+        if not isinstance(template_id, str) or not template_id:
+            return None
+        language = language if isinstance(language, str) and language else DEFAULT_LANGUAGE
+        key = (template_id, language)
+        if key not in self._rendered:
+            if template_id not in self._templates:
+                templates = self._db.collection(store.TEMPLATES_COLLECTION)
+                snapshot = templates.document(template_id).get()
+                self._templates[template_id] = snapshot.to_dict() if snapshot.exists else None
+            template = self._templates[template_id]
+            self._rendered[key] = render(template_id, template, language) if template else None
+        return self._rendered[key]
+
+
+def _unwritten(db: Any, writes: list[tuple[Any, dict[str, Any]]]) -> list:
+    """The writes whose chat document does not exist yet."""
+    snapshots = db.get_all([ref for ref, _ in writes])
+    written = {snapshot.reference.path for snapshot in snapshots if snapshot.exists}
+    return [(ref, data) for ref, data in writes if ref.path not in written]
+
+
+def _server_timestamp() -> Any:
+    from google.cloud.firestore import SERVER_TIMESTAMP
+
+    return SERVER_TIMESTAMP
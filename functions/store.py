@@ -0,0 +1,107 @@
+"""Shared Firestore access for the Python functions.
+
+A single client is created lazily on first use and reused for the lifetime
+of the instance, so every handler shares one gRPC channel instead of paying
+the connection handshake per invocation.
+"""
+
+from __future__ import annotations
+
+import threading
+from typing import Any, Callable
+
+MESSAGES_COLLECTION = "messages"
+CHAT_SUBCOLLECTION = "chat"
+CHAT_ARCHIVE_SUBCOLLECTION = "chatArchive"
+# Top-level collections, by the module that owns them.
+MARKERS_COLLECTION = "processedMessages"  # dedup
+TOKENS_COLLECTION = "fcmTokens"  # fcm_fanout
+PREVIEWS_COLLECTION = "linkPreviews"  # link_preview
+EVENTS_COLLECTION = "analytics_events"  # written by the app's AnalyticsService
+ROLLUPS_COLLECTION = "analytics_rollups"  # analytics_rollup
+USER_ROLLUPS_COLLECTION = "analytics_user_rollups"
+APPLIED_COLLECTION = "analytics_rollups_applied"
+TEMPLATES_COLLECTION = "messageTemplates"  # scheduled_delivery
+BUCKETS_COLLECTION = "deliveryBuckets"
+RUNS_COLLECTION = "deliveryRuns"
+
+# Firestore rejects batches with more than 500 writes.
+MAX_BATCH_WRITES = 500
+
+_client: Any = None
+_client_lock = threading.Lock()
+
+
+def get_app() -> Any:
+    """Returns the default Firebase app, initializing it on first call.
+
+    Nothing initializes the app at import time, so instances that never
+    touch Firestore or FCM never load the Admin SDK's gRPC stack.
+    """
+    import firebase_admin
+
+    with _client_lock:
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app()
+        return firebase_admin.get_app()
+
+
+def get_firestore() -> Any:
+    """Returns the process-wide Firestore client, creating it on first call."""
+    global _client
+    if _client is None:
+        app = get_app()
+        with _client_lock:
+            if _client is None:
+                from firebase_admin import firestore
+
+                _client = firestore.client(app)
+    return _client
+
+
+def set_firestore(client: Any) -> None:
+    """Overrides the shared client (emulator harnesses and in-memory fakes)."""
+    global _client
+    with _client_lock:
+        _client = client
+
+
+def chat_collection(db: Any, user_id: str) -> Any:
+    """Returns the `messages/{user_id}/chat` collection the app listens on."""
+    return (
+        db.collection(MESSAGES_COLLECTION)
+        .document(user_id)
+        .collection(CHAT_SUBCOLLECTION)
+    )
+
+
+def chat_archive_collection(db: Any, user_id: str) -> Any:
+    """Returns `messages/{user_id}/chatArchive`, where compacted chat lives."""
+    return (
+        db.collection(MESSAGES_COLLECTION)
+        .document(user_id)
+        .collection(CHAT_ARCHIVE_SUBCOLLECTION)
+    )
+
+
+def is_already_exists(exc: BaseException) -> bool:
+    """True if `exc` is Firestore's ALREADY_EXISTS (HTTP 409) error."""
+    return getattr(exc, "code", None) == 409
+
+
+# Firestore's limit on the UTF-8 size of one document id.
+MAX_DOCUMENT_ID_BYTES = 1500
+
+
+def is_valid_document_id(value: str) -> bool:
+    """True if Firestore accepts `value` as a document id."""
+    return (
+        bool(value)
+        and "/" not in value
+        and value not in (".", "..")
+        and not (len(value) >= 4 and value.startswith("__") and value.endswith("__"))
+        and len(value.encode("utf-8")) <= MAX_DOCUMENT_ID_BYTES
+    )
+
+
+ClientFactory = Callable[[], Any]
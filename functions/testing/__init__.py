@@ -0,0 +1 @@
+"""Local stand-ins used by the tests and benchmark harnesses."""
@@ -0,0 +1,52 @@
+"""Local stub of `firebase_admin.messaging.send_each_for_multicast`.
+
+Returns real `BatchResponse` objects, so callers exercise the same result
+handling as in production. Tokens listed in `unregistered` fail with
+`UnregisteredError`, and each call can sleep to mimic the FCM round trip.
+"""
+
+from __future__ import annotations
+
+import itertools
+import threading
+import time
+from typing import Iterable
+
+from firebase_admin import messaging
+
+
+class FakeFcm:
+    def __init__(self, latency: float = 0.0, unregistered: Iterable[str] = ()) -> None:
+        self.latency = latency
+        self.unregistered = set(unregistered)
+        self.calls: list[messaging.MulticastMessage] = []
+        self.delivered: list[str] = []
+        self.max_in_flight = 0
+        self._in_flight = 0
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def __call__(self, message: messaging.MulticastMessage, dry_run: bool = False):
+        if len(message.tokens) > 500:
+            raise ValueError("tokens must not contain more than 500 elements")
+        with self._lock:
+            self.calls.append(message)
+            self._in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self._in_flight)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            responses = []
+            for token in message.tokens:
+                if token in self.unregistered:
+                    error = messaging.UnregisteredError("Requested entity was not found.")
+                    responses.append(messaging.SendResponse(None, error))
+                else:
+                    name = f"projects/demo/messages/{next(self._ids)}"
+                    responses.append(messaging.SendResponse({"name": name}, None))
+            with self._lock:
+                self.delivered.extend(t for t in message.tokens if t not in self.unregistered)
+            return messaging.BatchResponse(responses)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
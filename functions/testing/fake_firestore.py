@@ -0,0 +1,582 @@
+"""In-memory stand-in for the subset of `google.cloud.firestore.Client` we use.
+
+Backs the unit tests and local load harnesses when the Firestore emulator is
+not running. Documents live in a flat dict keyed by path; reads, writes and
+commits are counted so benchmarks can report Firestore cost, and an optional
+per-commit latency approximates a network round trip.
+"""
+
+from __future__ import annotations
+
+import bisect
+import enum
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.cloud.firestore_v1 import transforms
+
+
+def _clone(value: Any) -> Any:
+    """Deep copy of nested maps and arrays; leaf values are immutable."""
+    if isinstance(value, dict):
+        return {k: _clone(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_clone(v) for v in value]
+    return value
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _get_field(data: dict[str, Any], field_path: str) -> Any:
+    if field_path == "__name__":
+        return data.get("__name__")
+    value: Any = data
+    for part in field_path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def _resolve(current: Any, value: Any) -> Any:
+    if value is transforms.SERVER_TIMESTAMP:
+        return _now()
+    if isinstance(value, transforms.Increment):
+        return (current if isinstance(current, (int, float)) else 0) + value.value
+    if isinstance(value, transforms.Maximum):
+        if isinstance(current, (int, float)):
+            return max(current, value.value)
+        return value.value
+    if isinstance(value, transforms.Minimum):
+        if isinstance(current, (int, float)):
+            return min(current, value.value)
+        return value.value
+    if isinstance(value, transforms.ArrayUnion):
+        items = list(current) if isinstance(current, list) else []
+        items.extend(v for v in value.values if v not in items)
+        return items
+    if isinstance(value, transforms.ArrayRemove):
+        items = list(current) if isinstance(current, list) else []
+        return [v for v in items if v not in value.values]
+    if isinstance(value, dict):
+        base = current if isinstance(current, dict) else {}
+        return {k: _resolve(base.get(k), v) for k, v in value.items()}
+    return _clone(value)
+
+
+def _set_field(data: dict[str, Any], field_path: str, value: Any) -> None:
+    parts = field_path.split(".")
+    target = data
+    for part in parts[:-1]:
+        child = target.get(part)
+        if not isinstance(child, dict):
+            child = target[part] = {}
+        target = child
+    if value is transforms.DELETE_FIELD:
+        target.pop(parts[-1], None)
+    else:
+        target[parts[-1]] = _resolve(target.get(parts[-1]), value)
+
+
+def _merge(target: dict[str, Any], updates: dict[str, Any]) -> None:
+    for key, value in updates.items():
+        if value is transforms.DELETE_FIELD:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = _resolve(target.get(key), value)
+
+
+class FakeSnapshot:
+    def __init__(
+        self, reference: "FakeDocument", data: Optional[dict[str, Any]]
+    ) -> None:
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> Optional[dict[str, Any]]:
+        return _clone(self._data)
+
+    def get(self, field_path: str) -> Any:
+        return _clone(_get_field(self._data or {}, field_path))
+
+
+class FakeChangeType(enum.Enum):
+    ADDED = 0
+    MODIFIED = 1
+    REMOVED = 2
+
+
+class FakeDocumentChange:
+    def __init__(self, change_type: FakeChangeType, document: FakeSnapshot) -> None:
+        self.type = change_type
+        self.document = document
+
+
+class FakeWatch:
+    def __init__(self, client: "FakeFirestore", listener: tuple) -> None:
+        self._client = client
+        self._listener = listener
+
+    def unsubscribe(self) -> None:
+        with self._client._lock:
+            if self._listener in self._client._listeners:
+                self._client._listeners.remove(self._listener)
+
+
+class FakeDocument:
+    def __init__(self, client: "FakeFirestore", path: str) -> None:
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self) -> "FakeCollection":
+        return FakeCollection(self._client, self.path.rsplit("/", 1)[0])
+
+    def collection(self, name: str) -> "FakeCollection":
+        return FakeCollection(self._client, f"{self.path}/{name}")
+
+    def get(self, transaction: Any = None) -> FakeSnapshot:
+        return self._client._read(self)
+
+    def set(self, data: dict[str, Any], merge: bool = False) -> None:
+        self._client._commit([("set", self, data, merge)])
+
+    def create(self, data: dict[str, Any]) -> None:
+        self._client._commit([("create", self, data, False)])
+
+    def update(self, data: dict[str, Any]) -> None:
+        self._client._commit([("update", self, data, False)])
+
+    def delete(self) -> None:
+        self._client._commit([("delete", self, None, False)])
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, FakeDocument) and other.path == self.path
+
+    def __hash__(self) -> int:
+        return hash(self.path)
+
+
+class FakeQuery:
+    def __init__(
+        self,
+        client: "FakeFirestore",
+        parent: str,
+        *,
+        group: bool = False,
+        filters: tuple = (),
+        orders: tuple = (),
+        limit: Optional[int] = None,
+        cursor: Optional[tuple[str, Any]] = None,
+    ) -> None:
+        self._client = client
+        self._parent = parent
+        self._group = group
+        self._filters = filters
+        self._orders = orders
+        self._limit = limit
+        self._cursor = cursor
+
+    def _copy(self, **changes: Any) -> "FakeQuery":
+        state = {
+            "group": self._group,
+            "filters": self._filters,
+            "orders": self._orders,
+            "limit": self._limit,
+            "cursor": self._cursor,
+        }
+        state.update(changes)
+        return FakeQuery(self._client, self._parent, **state)
+
+    def where(self, field_path: str, op_string: str, value: Any) -> "FakeQuery":
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path: str, direction: str = "ASCENDING") -> "FakeQuery":
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int) -> "FakeQuery":
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields: Any) -> "FakeQuery":
+        return self._copy(cursor=("after", document_fields))
+
+    def start_at(self, document_fields: Any) -> "FakeQuery":
+        return self._copy(cursor=("at", document_fields))
+
+    def _matches(self, data: dict[str, Any]) -> bool:
+        for field_path, op, expected in self._filters:
+            actual = _get_field(data, field_path)
+            if op == "==":
+                ok = actual == expected
+            elif op == "!=":
+                ok = actual is not None and actual != expected
+            elif op == "in":
+                ok = actual in expected
+            elif op == "array-contains":
+                ok = isinstance(actual, list) and expected in actual
+            elif actual is None:
+                ok = False
+            elif op == "<":
+                ok = actual < expected
+            elif op == "<=":
+                ok = actual <= expected
+            elif op == ">":
+                ok = actual > expected
+            elif op == ">=":
+                ok = actual >= expected
+            else:
+                raise ValueError(f"unsupported operator {op!r}")
+            if not ok:
+                return False
+        return True
+
+    def _sort_key(self, item: tuple[str, dict[str, Any]]) -> tuple:
+        path, data = item
+        doc_id = path.rsplit("/", 1)[-1]
+        return tuple(
+            doc_id if f == "__name__" else _get_field(data, f) for f, _ in self._orders
+        ) + (path,)
+
+    def _cursor_values(self) -> tuple:
+        kind, value = self._cursor
+        if isinstance(value, FakeSnapshot):
+            return self._sort_key((value.reference.path, value._data or {}))
+        if isinstance(value, dict):
+            return tuple(_get_field(value, f) for f, _ in self._orders)
+        return tuple(value)
+
+    def stream(self, transaction: Any = None) -> Iterator[FakeSnapshot]:
+        for snapshot in self._client._query(self):
+            yield snapshot
+
+    def get(self, transaction: Any = None) -> list[FakeSnapshot]:
+        return list(self.stream())
+
+    def on_snapshot(self, callback: Callable[..., None]) -> FakeWatch:
+        """Calls `callback(docs, changes, read_time)` now and after each commit.
+
+        Unlike Firestore, `docs` holds only the changed documents, ordering
+        and limits are ignored, and callbacks run on the committing thread
+        once the commit has applied.
+        """
+        return self._client._listen(self, callback)
+
+    def _watches(self, path: str) -> bool:
+        parent = path.rsplit("/", 1)[0]
+        if self._group:
+            return parent.rsplit("/", 1)[-1] == self._parent
+        return parent == self._parent
+
+    def _cache_key(self) -> tuple:
+        return (self._parent, self._group, self._orders, repr(self._filters))
+
+    def _sorted(self, collections: dict[str, dict[str, dict]]) -> list[tuple]:
+        """Matching `(sort_key, path, data)` rows in ascending order."""
+        if self._group:
+            candidates = [
+                item
+                for parent, docs in collections.items()
+                if parent.rsplit("/", 1)[-1] == self._parent
+                for item in docs.items()
+            ]
+        else:
+            candidates = list(collections.get(self._parent, {}).items())
+        rows = []
+        for path, data in candidates:
+            if any(
+                f != "__name__" and _get_field(data, f) is None for f, _ in self._orders
+            ):
+                continue
+            if self._matches(data):
+                rows.append((self._sort_key((path, data)), path, data))
+        rows.sort(key=lambda row: row[0])
+        return rows
+
+    def _window(self, rows: list[tuple]) -> list[tuple[str, dict]]:
+        """Applies direction, cursor and limit to the output of `_sorted`."""
+        descending = bool(self._orders) and self._orders[0][1] == "DESCENDING"
+        low, high = 0, len(rows)
+        if self._cursor is not None:
+            kind, _ = self._cursor
+            bound = self._cursor_values()
+            width = len(bound)
+
+            def prefix(row: tuple) -> tuple:
+                return row[0][:width]
+
+            inclusive = kind == "at"
+            if descending:
+                search = bisect.bisect_right if inclusive else bisect.bisect_left
+                high = search(rows, bound, key=prefix)
+            else:
+                search = bisect.bisect_left if inclusive else bisect.bisect_right
+                low = search(rows, bound, key=prefix)
+        count = high - low if self._limit is None else min(self._limit, high - low)
+        if descending:
+            selected = rows[high - count : high][::-1]
+        else:
+            selected = rows[low : low + count]
+        return [(path, data) for _, path, data in selected]
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, client: "FakeFirestore", path: str) -> None:
+        super().__init__(client, path)
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self) -> Optional[FakeDocument]:
+        if "/" not in self.path:
+            return None
+        return FakeDocument(self._client, self.path.rsplit("/", 1)[0])
+
+    def document(self, document_id: Optional[str] = None) -> FakeDocument:
+        return FakeDocument(self._client, f"{self.path}/{document_id or uuid.uuid4().hex}")
+
+    def add(self, data: dict[str, Any]) -> tuple[datetime, FakeDocument]:
+        ref = self.document()
+        ref.set(data)
+        return _now(), ref
+
+    def list_documents(self, page_size: Optional[int] = None) -> list[FakeDocument]:
+        return self._client._list_documents(self.path)
+
+
+class FakeWriteBatch:
+    def __init__(self, client: "FakeFirestore") -> None:
+        self._client = client
+        self._writes: list[tuple[str, FakeDocument, Any, bool]] = []
+
+    def __len__(self) -> int:
+        return len(self._writes)
+
+    def set(self, reference: FakeDocument, data: dict[str, Any], merge: bool = False):
+        self._writes.append(("set", reference, data, merge))
+        return self
+
+    def create(self, reference: FakeDocument, data: dict[str, Any]):
+        self._writes.append(("create", reference, data, False))
+        return self
+
+    def update(self, reference: FakeDocument, data: dict[str, Any]):
+        self._writes.append(("update", reference, data, False))
+        return self
+
+    def delete(self, reference: FakeDocument):
+        self._writes.append(("delete", reference, None, False))
+        return self
+
+    def commit(self) -> list[Any]:
+        if len(self._writes) > 500:
+            raise ValueError("a batch may contain at most 500 writes")
+        writes, self._writes = self._writes, []
+        self._client._commit(writes)
+        return [_now() for _ in writes]
+
+
+class FakeTransaction(FakeWriteBatch):
+    """Enough of `Transaction` for `firestore.transactional` to drive.
+
+    Transactions on one client run one at a time, which is stricter than
+    Firestore's optimistic locking but gives the same outcomes.
+    """
+
+    _read_only = False
+    _max_attempts = 1
+
+    def __init__(self, client: "FakeFirestore") -> None:
+        super().__init__(client)
+        self._id: Optional[bytes] = None
+
+    def _clean_up(self) -> None:
+        self._writes = []
+
+    def _begin(self, retry_id: Optional[bytes] = None) -> None:
+        self._client._transaction_lock.acquire()
+        self._id = uuid.uuid4().bytes
+
+    def _commit(self) -> list[Any]:
+        try:
+            return self.commit()
+        finally:
+            self._finish()
+
+    def _rollback(self) -> None:
+        self._writes = []
+        self._finish()
+
+    def _finish(self) -> None:
+        if self._id is not None:
+            self._id = None
+            self._client._transaction_lock.release()
+
+
+class FakeFirestore:
+    """Thread-safe in-memory Firestore with read/write accounting."""
+
+    def __init__(self, commit_latency: float = 0.0) -> None:
+        self.commit_latency = commit_latency
+        self.reads = 0
+        self.writes = 0
+        self.commits = 0
+        self._docs: dict[str, dict[str, Any]] = {}
+        # Same documents grouped by parent collection path, for queries.
+        self._collections: dict[str, dict[str, dict[str, Any]]] = {}
+        # Sorted query results, reused until their collection is written.
+        self._sorted_cache: dict[tuple, tuple[int, list[tuple]]] = {}
+        self._versions: dict[str, int] = {}
+        self._write_version = 0
+        self._listeners: list[tuple[FakeQuery, Callable[..., None]]] = []
+        self._lock = threading.RLock()
+        self._transaction_lock = threading.Lock()
+
+    def collection(self, name: str) -> FakeCollection:
+        return FakeCollection(self, name)
+
+    def collection_group(self, collection_id: str) -> FakeQuery:
+        return FakeQuery(self, collection_id, group=True)
+
+    def document(self, path: str) -> FakeDocument:
+        return FakeDocument(self, path)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def transaction(self) -> FakeTransaction:
+        return FakeTransaction(self)
+
+    def get_all(self, references: Iterable[FakeDocument]) -> Iterator[FakeSnapshot]:
+        for reference in references:
+            yield self._read(reference)
+
+    def data(self) -> dict[str, dict[str, Any]]:
+        """Returns a deep copy of every stored document keyed by path."""
+        with self._lock:
+            return _clone(self._docs)
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self.reads = self.writes = self.commits = 0
+
+    def _read(self, ref: FakeDocument) -> FakeSnapshot:
+        with self._lock:
+            self.reads += 1
+            data = self._docs.get(ref.path)
+            return FakeSnapshot(ref, _clone(data) if data is not None else None)
+
+    def _query(self, query: FakeQuery) -> list[FakeSnapshot]:
+        with self._lock:
+            key = query._cache_key()
+            version = self._write_version if query._group else self._versions.get(query._parent, 0)
+            cached = self._sorted_cache.get(key)
+            if cached is None or cached[0] != version:
+                if len(self._sorted_cache) > 64:
+                    self._sorted_cache.clear()
+                cached = self._sorted_cache[key] = (version, query._sorted(self._collections))
+            rows = query._window(cached[1])
+            # Firestore bills an empty result as one read.
+            self.reads += max(1, len(rows))
+            return [
+                FakeSnapshot(FakeDocument(self, path), _clone(data))
+                for path, data in rows
+            ]
+
+    def _listen(self, query: FakeQuery, callback: Callable[..., None]) -> FakeWatch:
+        listener = (query, callback)
+        with self._lock:
+            self._listeners.append(listener)
+            docs = [
+                FakeSnapshot(FakeDocument(self, path), _clone(data))
+                for path, data in query._window(query._sorted(self._collections))
+            ]
+            self.reads += max(1, len(docs))
+        changes = [FakeDocumentChange(FakeChangeType.ADDED, doc) for doc in docs]
+        callback(docs, changes, _now())
+        return FakeWatch(self, listener)
+
+    def _notify(self, before: dict[str, bool], after: dict[str, Any]) -> None:
+        """Delivers the changes of one commit to the matching listeners."""
+        with self._lock:
+            listeners = list(self._listeners)
+        for query, callback in listeners:
+            changes = []
+            for path, data in after.items():
+                if not query._watches(path):
+                    continue
+                if data is None:
+                    if before[path]:
+                        change_type = FakeChangeType.REMOVED
+                    else:
+                        continue
+                elif not query._matches(data):
+                    continue
+                else:
+                    change_type = FakeChangeType.MODIFIED if before[path] else FakeChangeType.ADDED
+                snapshot = FakeSnapshot(FakeDocument(self, path), _clone(data))
+                changes.append(FakeDocumentChange(change_type, snapshot))
+            if changes:
+                callback([c.document for c in changes], changes, _now())
+
+    def _list_documents(self, parent: str) -> list[FakeDocument]:
+        prefix = parent + "/"
+        depth = parent.count("/") + 1
+        with self._lock:
+            ids = {
+                "/".join(path.split("/")[: depth + 1])
+                for path in self._docs
+                if path.startswith(prefix)
+            }
+        return [FakeDocument(self, path) for path in sorted(ids)]
+
+    def _commit(self, writes: list[tuple[str, FakeDocument, Any, bool]]) -> None:
+        if self.commit_latency:
+            time.sleep(self.commit_latency)
+        with self._lock:
+            staged = {ref.path: _clone(self._docs.get(ref.path)) for _, ref, _, _ in writes}
+            existed = {path: data is not None for path, data in staged.items()}
+            for op, ref, data, merge in writes:
+                current = staged[ref.path]
+                if op == "create":
+                    if current is not None:
+                        raise AlreadyExists(f"Document already exists: {ref.path}")
+                    current = {}
+                    _merge(current, data)
+                elif op == "set":
+                    if current is None or not merge:
+                        current = {}
+                    _merge(current, data)
+                elif op == "update":
+                    if current is None:
+                        raise NotFound(f"No document to update: {ref.path}")
+                    for field_path, value in data.items():
+                        _set_field(current, field_path, value)
+                else:
+                    current = None
+                staged[ref.path] = current
+            for path, data in staged.items():
+                parent = path.rsplit("/", 1)[0]
+                self._versions[parent] = self._versions.get(parent, 0) + 1
+                if data is None:
+                    self._docs.pop(path, None)
+                    self._collections.get(parent, {}).pop(path, None)
+                else:
+                    self._docs[path] = data
+                    self._collections.setdefault(parent, {})[path] = data
+            self._write_version += 1
+            self.writes += len(writes)
+            self.commits += 1
+            notify = bool(self._listeners)
+        if notify:
+            self._notify(existed, staged)
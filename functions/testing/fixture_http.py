@@ -0,0 +1,70 @@
+"""Local HTTP server that serves canned pages for link preview tests.
+
+Each page can delay its response to mimic a slow site. The server counts
+requests per path so tests can check that fetches were shared or cached.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+@dataclass
+class FixturePage:
+    body: bytes
+    content_type: str = "text/html; charset=utf-8"
+    status: int = 200
+    delay: float = 0.0
+    headers: dict[str, str] = field(default_factory=dict)
+
+
+class FixtureServer:
+    def __init__(self) -> None:
+        self.pages: dict[str, FixturePage] = {}
+        self.hits: Counter = Counter()
+        self._lock = threading.Lock()
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                with fixture._lock:
+                    fixture.hits[self.path] += 1
+                page = fixture.pages.get(self.path)
+                if page is None:
+                    self.send_error(404)
+                    return
+                time.sleep(page.delay)
+                self.send_response(page.status)
+                self.send_header("Content-Type", page.content_type)
+                self.send_header("Content-Length", str(len(page.body)))
+                for name, value in page.headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                try:
+                    for start in range(0, len(page.body), 16 * 1024):
+                        self.wfile.write(page.body[start : start + 16 * 1024])
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def url(self, path: str) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}{path}"
+
+    def __enter__(self) -> "FixtureServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from testing.fake_firestore import FakeFirestore  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    return FakeFirestore()
@@ -0,0 +1,117 @@
+import itertools
+from datetime import date, datetime, timezone
+
+import analytics_rollup
+import hll
+
+
+def _event(name, user=None, day=1):
+    return {
+        "eventName": name,
+        "parameters": {"userId": user} if user else {},
+        "timestamp": datetime(2025, 3, day, 12, tzinfo=timezone.utc),
+    }
+
+
+def test_hll_estimate_is_close():
+    sketch = hll.HyperLogLog()
+    sketch.update(f"user-{i}" for i in range(20_000))
+    assert abs(sketch.count() - 20_000) / 20_000 < 0.05
+    small = hll.HyperLogLog()
+    small.update(["a", "b", "c", "a"])
+    assert small.count() == 3
+
+
+def test_hll_merge_matches_union():
+    left, right, union = hll.HyperLogLog(), hll.HyperLogLog(), hll.HyperLogLog()
+    left.update(f"u{i}" for i in range(3_000))
+    right.update(f"u{i}" for i in range(2_000, 5_000))
+    union.update(f"u{i}" for i in range(5_000))
+    left.merge(right)
+    assert left.registers == union.registers
+    restored = hll.HyperLogLog()
+    restored.merge_map(union.to_map())
+    assert restored.count() == union.count()
+
+
+def test_apply_event_updates_rollups_once(db):
+    assert analytics_rollup.apply_event(db, "e1", _event("onboarding_step", "u1"))
+    assert not analytics_rollup.apply_event(db, "e1", _event("onboarding_step", "u1"))
+    analytics_rollup.apply_event(db, "e2", _event("onboarding_step", "u2"))
+    analytics_rollup.apply_event(db, "e3", _event("screen_view"))
+
+    prefix = "analytics_rollups/2025-03-01/shards/"
+    shards = [doc for path, doc in db.data().items() if path.startswith(prefix)]
+    assert sum(shard["total"] for shard in shards) == 3
+    day = analytics_rollup.RollupReader(db).event_counts(date(2025, 3, 1), date(2025, 3, 1))
+    assert day["event_counts"] == {"onboarding_step": 2, "screen_view": 1}
+    user = db.data()["analytics_user_rollups/u1"]
+    assert user["total"] == 1 and user["events"] == {"onboarding_step": 1}
+    assert user["firstSeen"] == user["lastSeen"]
+
+
+def test_reader_matches_full_scan(db, monkeypatch):
+    shards = itertools.cycle(range(analytics_rollup.ROLLUP_SHARDS))
+    monkeypatch.setattr(analytics_rollup.random, "randrange", lambda _: next(shards))
+    events = [
+        _event("onboarding_step", "u1", 1),
+        _event("intake_progress", "u1", 1),
+        _event("intake_completed", "u1", 2),
+        _event("onboarding_step", "u2", 2),
+        _event("quit_date_set", "u3", 5),
+        _event("screen_view", None, 5),
+    ]
+    for i, event in enumerate(events):
+        db.collection("analytics_events").document(f"e{i}").set(event)
+    analytics_rollup.apply_event(db, "e0", events[0])
+    assert analytics_rollup.backfill(db, page_size=4) == {"scanned": 6, "applied": 5}
+
+    reader = analytics_rollup.RollupReader(db)
+    assert reader.event_counts(date(2025, 3, 1), date(2025, 3, 2)) == {
+        "total_events": 4,
+        "event_counts": {"onboarding_step": 2, "intake_progress": 1, "intake_completed": 1},
+        "unique_users": 2,
+    }
+    metrics = reader.study_metrics()
+    assert metrics["total_participants"] == 3
+    assert metrics["average_engagement"] == 5 / 3
+    assert metrics["completion_rate"] == 1 / 3
+    funnel = reader.conversion_funnel()
+    assert funnel["onboarding_started"] == 2
+    assert funnel["quit_date_set"] == 1
+    assert funnel["quit_successful"] == 0
+    assert reader.user_summary("u1")["total"] == 3
+
+
+def test_invalid_names_and_user_ids_roll_up_as_unknown(db):
+    for i, name in enumerate([".", "..", "__x__", "é" * 751, "a/b", None]):
+        assert analytics_rollup.apply_event(db, f"e{i}", _event(name, ".."))
+    names = {doc["name"] for path, doc in db.data().items() if "/eventShards/" in path}
+    assert names == {"unknown", "a_b"}
+    assert not any(path.startswith("analytics_user_rollups/") for path in db.data())
+    marker = db.data()["analytics_rollups_applied/e0"]
+    assert marker["expireAt"] - marker["appliedAt"] == analytics_rollup.APPLIED_MARKER_TTL
+
+
+def test_backfill_keeps_field_transforms_under_the_limit(db, monkeypatch):
+    from google.cloud.firestore_v1 import transforms
+
+    events = db.collection("analytics_events")
+    for i in range(450):
+        events.document(f"e{i:03d}").set(_event("screen_view", f"u{i}"))
+    commit = db._commit
+    most = []
+
+    def count_transforms(writes):
+        def count(value):
+            if isinstance(value, dict):
+                return sum(count(v) for v in value.values())
+            return isinstance(value, transforms._NumericValue)
+
+        most.append(max(count(data or {}) for _, _, data, _ in writes))
+        commit(writes)
+
+    monkeypatch.setattr(db, "_commit", count_transforms)
+    assert analytics_rollup.backfill(db, page_size=450)["applied"] == 450
+    assert max(most) <= 500
+    assert analytics_rollup.RollupReader(db).study_metrics()["average_engagement"] > 0
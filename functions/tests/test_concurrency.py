@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+
+import concurrency
+
+
+def test_pages_are_read_lazily(db):
+    chat = db.collection("messages").document("u-1").collection("chat")
+    for i in range(50):
+        chat.document(f"m-{i:03d}").set({"messageBody": str(i)})
+    db.reset_counters()
+    query = chat.order_by("__name__")
+    pages = concurrency.iter_pages(query, page_size=10)
+    first = next(pages)
+    assert [s.id for s in first] == [f"m-{i:03d}" for i in range(10)]
+    pages.close()
+    # The first page and the one read ahead, not all five.
+    assert db.reads <= 20
+    assert sum(len(p) for p in concurrency.iter_pages(query, page_size=10)) == 50
+    resumed = concurrency.iter_pages(query, 10, start_after={"__name__": "m-044"})
+    assert [s.id for page in resumed for s in page] == [f"m-{i:03d}" for i in range(45, 50)]
+
+
+def test_submit_blocks_while_the_backlog_is_full():
+    running = 0
+    most = 0
+    lock = threading.Lock()
+
+    def work():
+        nonlocal running, most
+        with lock:
+            running += 1
+            most = max(most, running)
+        time.sleep(0.01)
+        with lock:
+            running -= 1
+
+    with concurrency.BoundedExecutor(2, max_pending=3) as pool:
+        futures = []
+        for _ in range(12):
+            futures.append(pool.submit(work))
+            assert sum(not f.done() for f in futures) <= 3
+    assert most <= 2 and all(f.done() for f in futures)
+
+
+def test_retry_stops_at_non_retryable_errors(monkeypatch):
+    monkeypatch.setattr(concurrency.time, "sleep", lambda seconds: None)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise RuntimeError("unavailable")
+        return "ok"
+
+    assert concurrency.retry(flaky, attempts=3, base=0.1) == "ok"
+    with pytest.raises(KeyError):
+        concurrency.retry(
+            lambda: calls.append(1) or {}["missing"],
+            attempts=5,
+            base=0.1,
+            retryable=lambda exc: not isinstance(exc, KeyError),
+        )
+    assert len(calls) == 4
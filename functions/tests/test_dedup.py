@@ -0,0 +1,56 @@
+import pytest
+
+import dedup
+import store
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_recent_ids_expire_after_ttl():
+    clock = Clock()
+    recent = dedup.RecentIds(ttl=10, clock=clock)
+    assert recent.add("a")
+    assert not recent.add("a")
+    clock.now = 11
+    assert "a" not in recent
+    assert recent.add("a")
+
+
+def test_recent_ids_are_bounded():
+    recent = dedup.RecentIds(max_entries=100)
+    for i in range(10_000):
+        recent.add(f"id-{i}")
+    assert len(recent) == 100
+    assert "id-9999" in recent
+    assert "id-0" not in recent
+
+
+def test_marker_catches_duplicates_from_other_instances(db):
+    first = dedup.MessageDeduper()
+    second = dedup.MessageDeduper()
+    batch = db.batch()
+    first.stage(db, batch, [("m-1", "u"), ("m-2", "u")])
+    batch.commit()
+    assert db.data()["processedMessages/m-1"]["userId"] == "u"
+
+    batch = db.batch()
+    second.stage(db, batch, [("m-2", "u"), ("m-3", "u")])
+    with pytest.raises(Exception) as raised:
+        batch.commit()
+    assert store.is_already_exists(raised.value)
+    assert "processedMessages/m-3" not in db.data()
+    assert second.claimed(db, ["m-2", "m-3"]) == {"m-2"}
+
+
+def test_release_allows_retry():
+    deduper = dedup.MessageDeduper()
+    assert not deduper.seen_locally("m-1")
+    assert deduper.seen_locally("m-1")
+    deduper.release(["m-1"])
+    assert not deduper.seen_locally("m-1")
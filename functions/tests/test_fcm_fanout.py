@@ -0,0 +1,100 @@
+import fcm_fanout
+import ingest
+from testing.fake_fcm import FakeFcm
+
+
+def _register(db, count):
+    for i in range(count):
+        db.collection("fcmTokens").document(f"u{i:04d}").set({"token": f"t{i}"})
+
+
+def test_campaign_uses_full_multicasts_and_prunes(db):
+    _register(db, 1_203)
+    fcm = FakeFcm(latency=0.01, unregistered={"t5", "t700"})
+    service = fcm_fanout.FanoutService(lambda: db, fcm, max_in_flight=2)
+    stats = service.push_campaign(fcm_fanout.Notification.create("Hi", "Daily tip"))
+
+    assert [len(call.tokens) for call in fcm.calls] == [500, 500, 203]
+    assert fcm.max_in_flight <= 2
+    assert (stats.sent, stats.pruned, stats.multicasts) == (1_201, 2, 3)
+    remaining = db.data()
+    assert "fcmTokens/u0005" not in remaining and "fcmTokens/u0700" not in remaining
+    assert "fcmTokens/u0006" in remaining
+
+
+def test_campaign_reports_stats_when_batches_fail(db, monkeypatch):
+    _register(db, 1_203)
+    fcm = FakeFcm(unregistered={"t5"})
+    service = fcm_fanout.FanoutService(lambda: db, fcm, max_in_flight=2)
+    send_batch = service._send_batch
+
+    def fail_second(notification, recipients, stats):
+        if recipients[0][0] == "u0500":
+            raise RuntimeError("boom")
+        send_batch(notification, recipients, stats)
+
+    def unavailable():
+        raise RuntimeError("Firestore is unavailable")
+
+    monkeypatch.setattr(service, "_send_batch", fail_second)
+    monkeypatch.setattr(db, "batch", unavailable)
+    stats = service.push_campaign(fcm_fanout.Notification.create("Hi", "Daily tip"))
+
+    assert (stats.sent, stats.failed, stats.pruned, stats.errors) == (702, 1, 0, 1)
+    assert "fcmTokens/u0005" in db.data()
+
+
+def test_notify_groups_users_by_payload(db):
+    _register(db, 4)
+    fcm = FakeFcm()
+    service = fcm_fanout.FanoutService(lambda: db, fcm)
+    tip = fcm_fanout.Notification.create("Tip", "Drink water", {"kind": "tip"})
+    poll = fcm_fanout.Notification.create("Poll", "How are you?")
+    stats = service.notify({"u0000": tip, "u0001": poll, "u0002": tip, "missing": tip})
+
+    assert stats.sent == 3
+    assert sorted(sorted(call.tokens) for call in fcm.calls) == [["t0", "t2"], ["t1"]]
+    tip_call = next(call for call in fcm.calls if len(call.tokens) == 2)
+    assert tip_call.data == {"kind": "tip"}
+
+
+def test_prune_keeps_refreshed_token(db):
+    _register(db, 1)
+    fcm = FakeFcm(unregistered={"t0"})
+    service = fcm_fanout.FanoutService(lambda: db, fcm)
+    db.collection("fcmTokens").document("u0000").set({"token": "fresh"})
+    service._prune([("u0000", "t0")])
+    assert db.data()["fcmTokens/u0000"]["token"] == "fresh"
+
+
+def _post(pipeline, index, user_id, token, uid=None):
+    payload = {"messageId": f"m{index}", "userId": user_id, "messageText": "hi", "fcmToken": token}
+    result = ingest.handle_ingest(payload, pipeline, uid=uid)
+    pipeline.flush(5)
+    return result
+
+
+def test_ingest_registers_changed_tokens_only(db):
+    registry = fcm_fanout.TokenRegistry()
+    pipeline = ingest.IngestPipeline(lambda: db, token_registry=registry)
+    for i, token in enumerate(["a", "a", "b"]):
+        _post(pipeline, i, "u1", token, uid="u1")
+    pipeline.stop()
+    assert db.data()["fcmTokens/u1"]["token"] == "b"
+    assert registry.changed([("u1", "b")]) == {}
+
+
+def test_unverified_tokens_never_replace_a_registration(db):
+    db.collection("fcmTokens").document("victim").set({"token": "theirs"})
+    registry = fcm_fanout.TokenRegistry()
+    pipeline = ingest.IngestPipeline(lambda: db, token_registry=registry)
+    _post(pipeline, 0, "victim", "attacker")
+    _post(pipeline, 1, "new-user", "fresh")
+    _, status = _post(pipeline, 2, "victim", "attacker", uid="someone-else")
+    pipeline.stop()
+
+    assert status == 403
+    tokens = {path: doc["token"] for path, doc in db.data().items() if path.startswith("fcm")}
+    assert tokens == {"fcmTokens/victim": "theirs", "fcmTokens/new-user": "fresh"}
+    assert "messages/victim/chat/m0" in db.data()
+    assert "messages/victim/chat/m2" not in db.data()
@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+
+import health
+
+FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ("grpc", "google.cloud.firestore_v1", "aiohttp")
+
+
+def _import_main(target):
+    env = {k: v for k, v in os.environ.items() if k != "FUNCTION_TARGET"}
+    if target:
+        env["FUNCTION_TARGET"] = target
+    script = (
+        "import sys, main\n"
+        f"print(','.join(m for m in {HEAVY!r} if m in sys.modules))\n"
+        "print(','.join(sorted(n for n, v in vars(main).items()"
+        " if hasattr(v, '__firebase_endpoint__'))))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=FUNCTIONS_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    heavy, functions = result.stdout.splitlines()
+    return heavy, functions.split(",")
+
+
+def test_http_instances_skip_the_grpc_stack():
+    heavy, functions = _import_main("mobile")
+    assert heavy == ""
+    assert "rollup_analytics_event" not in functions and "mobile" in functions
+
+
+def test_discovery_sees_every_function():
+    heavy, functions = _import_main(None)
+    assert {"mobile", "rollup_analytics_event", "deliver_scheduled_messages"} <= set(functions)
+
+
+def test_health_reports_cold_start_without_firestore(monkeypatch):
+    monkeypatch.setattr(health, "_requests", 0)
+    first, status = health.handle_health({})
+    second, _ = health.handle_health({})
+    assert status == 200 and first["coldStart"] and not second["coldStart"]
+    assert first["instance"] == second["instance"]
+    assert health._warming is None
+
+
+def test_keep_warm_probes_each_function(monkeypatch):
+    probed = []
+    monkeypatch.setattr(health, "_probe", lambda url, timeout: probed.append(url) or 200)
+    statuses = health.keep_warm("https://example.test", ["mobile", "history_page"])
+    assert statuses == {"mobile": 200, "history_page": 200}
+    assert sorted(probed) == [
+        "https://example.test/history_page?warm=1",
+        "https://example.test/mobile?warm=1",
+    ]
@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import history
+
+BASE = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def _seed(db, count, user="u-1"):
+    chat = db.collection("messages").document(user).collection("chat")
+    for i in range(count):
+        chat.document(f"m-{i:03d}").set(
+            {
+                "messageBody": f"message {i}",
+                "source": "client" if i % 2 else "server",
+                "serverMessageId": f"m-{i:03d}",
+                "createdAt": BASE + timedelta(seconds=i),
+            }
+        )
+
+
+@pytest.fixture
+def service(db):
+    return history.HistoryService(lambda: db)
+
+
+def test_pages_walk_backwards_in_chronological_order(db, service):
+    _seed(db, 25)
+    first = service.page("u-1", limit=10)
+    assert [m["id"] for m in first["messages"]] == [f"m-{i:03d}" for i in range(15, 25)]
+    assert first["messages"][0]["isMe"] is True
+    assert first["messages"][1]["timestamp"] == "2025-01-01T00:00:16.000Z"
+
+    seen = [m["id"] for m in first["messages"]]
+    cursor = first["nextCursor"]
+    while cursor:
+        page = service.page("u-1", cursor, limit=10)
+        seen = [m["id"] for m in page["messages"]] + seen
+        cursor = page["nextCursor"]
+    assert seen == [f"m-{i:03d}" for i in range(25)]
+
+
+def test_cached_pages_save_reads(db, service):
+    _seed(db, 40)
+    first = service.page("u-1", limit=20)
+    assert (first["reads"], first["readsSaved"]) == (20, 0)
+    older = service.page("u-1", first["nextCursor"], limit=20)
+
+    db.reset_counters()
+    again = service.page("u-1", limit=20)
+    assert (again["reads"], again["readsSaved"]) == (1, 19)
+    older_again = service.page("u-1", first["nextCursor"], limit=20)
+    assert (older_again["reads"], older_again["readsSaved"]) == (0, 20)
+    assert older_again["messages"] == older["messages"]
+    assert db.reads == 1
+
+
+def test_new_write_refreshes_head_page(db, service):
+    _seed(db, 5)
+    service.page("u-1")
+    _seed(db, 6)
+    page = service.page("u-1")
+    assert page["messages"][-1]["id"] == "m-005"
+    assert page["readsSaved"] == 0
+
+
+def test_quick_replies_are_merged_into_one_list():
+    data = {
+        "messageBody": "How are you?",
+        "isPoll": "y",
+        "questionsAnswers": {"Good": "1", "Bad": 2},
+        "buttons": [{"title": "ignored"}],
+    }
+    message = history.normalize_message("d", data, "u-1")
+    assert message["type"] == "MessageType.quickReply"
+    assert message["suggestedReplies"] == [
+        {"text": "Good", "value": "1"},
+        {"text": "Bad", "value": "2"},
+    ]
+    assert history.extract_quick_replies({"answers": "a, b,,c,d,e"}) == [
+        {"text": t, "value": t} for t in "abcd"
+    ]
+    assert history.extract_quick_replies(
+        {"suggestedReplies": [{"text": "Yes", "value": "y"}, "No"]}
+    ) == [{"text": "Yes", "value": "y"}, {"text": "No", "value": "No"}]
+
+
+def test_handle_history_validates_input(service):
+    assert history.handle_history({}, "", service)[1] == 400
+    assert history.handle_history({"cursor": "nope"}, "u", service)[1] == 400
+    body, status = history.handle_history({}, "u", service)
+    assert status == 200
+    assert body["messages"] == [] and body["nextCursor"] is None
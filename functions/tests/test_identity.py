@@ -0,0 +1,73 @@
+import pytest
+from flask import Request
+from werkzeug.test import EnvironBuilder
+
+import identity
+import main
+
+
+def _verify(token):
+    if token != "good":
+        raise identity.Unauthorized("invalid Firebase ID token")
+    return {"uid": "u-1"}
+
+
+def _request(query, token=None, method="GET", json=None):
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    builder = EnvironBuilder(method=method, query_string=query, headers=headers, json=json)
+    return Request(builder.get_environ())
+
+
+@pytest.mark.parametrize("header", [None, "", "Bearer ", "Basic abc", "Bearer bad"])
+def test_rejects_missing_or_invalid_tokens(header):
+    with pytest.raises(identity.Unauthorized):
+        identity.verified_uid(header, _verify)
+
+
+def test_uid_comes_from_the_token():
+    assert identity.verified_uid("Bearer good", _verify) == "u-1"
+    with pytest.raises(identity.Unauthorized):
+        identity.verified_uid("Bearer good", lambda token: {})
+
+
+def test_history_and_metrics_require_a_token(db, monkeypatch):
+    import history
+
+    monkeypatch.setattr(identity, "_verify", _verify)
+    monkeypatch.setattr(history, "_service", history.HistoryService(lambda: db))
+    db.document("messages/u-1/chat/m-1").set({"messageBody": "mine", "createdAt": 1})
+    db.document("messages/u-2/chat/m-2").set({"messageBody": "theirs", "createdAt": 1})
+
+    for query in ("userId=u-2", "metrics=1"):
+        for token in (None, "bad"):
+            response = main.history_page(_request(query, token))
+            assert response.status_code == 401
+            assert response.headers["WWW-Authenticate"] == "Bearer"
+
+    response = main.history_page(_request("userId=u-2", "good"))
+    assert [m["content"] for m in response.get_json()["messages"]] == ["mine"]
+    assert main.mobile(_request("metrics=1", "good")).status_code == 200
+
+
+def test_mobile_binds_the_message_to_the_token(db, monkeypatch):
+    import ingest
+
+    monkeypatch.setattr(identity, "_verify", _verify)
+    pipeline = ingest.IngestPipeline(lambda: db, workers=1)
+    monkeypatch.setattr(ingest, "_pipeline", pipeline)
+
+    def post(user_id, token):
+        body = {"messageId": f"m-{user_id}", "userId": user_id, "messageText": "hi"}
+        return main.mobile(_request("", token, method="POST", json=body)).status_code
+
+    try:
+        assert post("u-1", "bad") == 401
+        assert post("u-2", "good") == 403
+        assert post("u-1", "good") == 200
+        monkeypatch.setattr(ingest, "REQUIRE_ID_TOKEN", True)
+        assert post("u-3", None) == 401
+    finally:
+        pipeline.stop()
+    assert [path for path in db.data() if path.startswith("messages/")] == [
+        "messages/u-1/chat/m-u-1"
+    ]
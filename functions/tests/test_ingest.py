@@ -0,0 +1,154 @@
+import signal
+
+import pytest
+
+import dedup
+import ingest
+import tracing
+
+
+def _payload(**overrides):
+    payload = {
+        "messageId": "m-1",
+        "userId": "u-1",
+        "messageText": "hello",
+        "fcmToken": "tok",
+        "messageTime": 1_700_000_000,
+        "eventTypeCode": 1,
+    }
+    payload.update(overrides)
+    return payload
+
+
+@pytest.fixture
+def pipeline(db):
+    pipeline = ingest.IngestPipeline(lambda: db, workers=2, batch_size=50)
+    pipeline.start()
+    yield pipeline
+    pipeline.stop()
+
+
+def test_ack_then_batched_write(db, pipeline):
+    for i in range(120):
+        body, status = ingest.handle_ingest(
+            _payload(messageId=f"m-{i}", userId=f"u-{i % 3}"), pipeline
+        )
+        assert status == 200
+        assert body == {
+            "status": "accepted",
+            "messageId": f"m-{i}",
+            "traceId": tracing.trace_id(f"m-{i}"),
+        }
+    pipeline.flush(5)
+
+    docs = db.data()
+    assert len(docs) == 120
+    doc = docs["messages/u-1/chat/m-1"]
+    assert doc["messageBody"] == "hello"
+    assert doc["source"] == "client"
+    assert "clientTimestamp" not in doc
+    assert pipeline.stats.written == 120
+    assert db.commits == pipeline.stats.batches < 120
+
+
+def test_merge_keeps_client_timestamps(db, pipeline):
+    ref = db.document("messages/u-1/chat/m-1")
+    ref.set({"createdAt": 1, "clientTimestamp": 1_700_000_000_123, "messageBody": "hello"})
+    ingest.handle_ingest(_payload(), pipeline)
+    pipeline.flush(5)
+    assert ref.get().get("createdAt") == 1
+    assert ref.get().get("clientTimestamp") == 1_700_000_000_123
+    assert ref.get().get("eventTypeCode") == 1
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        None,
+        [],
+        _payload(userId=None),
+        _payload(messageText=""),
+        _payload(messageTime="x"),
+        _payload(userId="u/1"),
+        _payload(messageId=".."),
+        _payload(messageId="__m__"),
+        _payload(messageId="é" * 751),
+    ],
+)
+def test_rejects_invalid_payload(pipeline, payload):
+    body, status = ingest.handle_ingest(payload, pipeline)
+    assert status == 400
+    assert body["status"] == "error"
+
+
+def test_saturated_queue_returns_busy(db):
+    pipeline = ingest.IngestPipeline(lambda: db, max_pending=0)
+    try:
+        _, status = ingest.handle_ingest(_payload(), pipeline)
+    finally:
+        pipeline.stop()
+    assert status == 503
+    assert pipeline.stats.rejected == 1
+
+
+def test_failed_commit_is_retried(db):
+    calls = {"n": 0}
+    original = db._commit
+
+    def flaky(writes):
+        calls["n"] += 1
+        if calls["n"] == 1:
+            raise RuntimeError("unavailable")
+        original(writes)
+
+    db._commit = flaky
+    pipeline = ingest.IngestPipeline(lambda: db, workers=1)
+    ingest.handle_ingest(_payload(), pipeline)
+    pipeline.stop()
+    assert pipeline.stats.written == 1
+    assert "messages/u-1/chat/m-1" in db.data()
+
+
+def test_sigterm_writes_acked_messages(db, monkeypatch):
+    import main
+
+    forwarded = []
+    monkeypatch.setattr(main, "_previous_sigterm", lambda *args: forwarded.append(args))
+    pipeline = ingest.IngestPipeline(lambda: db, workers=1, linger=0.05)
+    monkeypatch.setattr(ingest, "_pipeline", pipeline)
+    body, _ = ingest.handle_ingest(_payload())
+    assert body["status"] == "accepted"
+
+    main._drain_ingest(signal.SIGTERM, None)
+    assert "messages/u-1/chat/m-1" in db.data()
+    assert ingest._pipeline is None
+    assert forwarded == [(signal.SIGTERM, None)]
+
+
+def test_duplicate_message_ids_are_dropped(db):
+    deduper = dedup.MessageDeduper()
+    pipeline = ingest.IngestPipeline(lambda: db, deduper=deduper)
+    first, _ = ingest.handle_ingest(_payload(), pipeline)
+    retry, status = ingest.handle_ingest(_payload(), pipeline)
+    pipeline.stop()
+    assert first["status"] == "accepted"
+    assert (retry["status"], status) == ("duplicate", 200)
+    assert pipeline.stats.written == 1
+    assert pipeline.stats.duplicates == 1
+
+
+def test_duplicates_from_another_instance_are_split_out_of_the_batch(db):
+    first = ingest.IngestPipeline(lambda: db, deduper=dedup.MessageDeduper())
+    ingest.handle_ingest(_payload(messageId="m-2", messageText="first"), first)
+    first.stop()
+
+    second = ingest.IngestPipeline(
+        lambda: db, workers=1, linger=0.05, deduper=dedup.MessageDeduper()
+    )
+    for message_id in ("m-1", "m-2", "m-3"):
+        ingest.handle_ingest(_payload(messageId=message_id, messageText="second"), second)
+    second.stop()
+    assert (second.stats.written, second.stats.duplicates, second.stats.batches) == (2, 1, 1)
+    data = db.data()
+    assert data["messages/u-1/chat/m-2"]["messageBody"] == "first"
+    assert all(f"processedMessages/m-{i}" in data for i in (1, 2, 3))
@@ -0,0 +1,169 @@
+import threading
+import time
+
+import pytest
+
+import link_preview
+from testing.fixture_http import FixturePage, FixtureServer
+
+HEAD = (
+    b"<html><head><title>Quit Tips</title>"
+    b'<meta property="og:title" content="Five ways to quit">'
+    b'<meta property="og:description" content="Practical steps &amp; support">'
+    b'<meta property="og:image" content="/img/cover.png">'
+    b'<meta name="twitter:site" content="@quitxt">'
+)
+# A megabyte of markup after the head that a full download would pay for.
+ARTICLE = HEAD + b"</head><body>" + b"<p>" + b"x" * (1 << 20) + b"</p></body></html>"
+
+
+@pytest.fixture
+def server():
+    with FixtureServer() as fixture:
+        yield fixture
+
+
+@pytest.fixture
+def service(db):
+    service = link_preview.PreviewService(lambda: db, allow_private=True)
+    yield service
+    service.stop()
+
+
+def test_stops_reading_once_og_tags_are_seen(server, service):
+    server.pages["/article"] = FixturePage(ARTICLE)
+    result = service.preview(server.url("/article"))
+
+    assert result["cache"] == "miss"
+    assert result["preview"] == {
+        "url": server.url("/article"),
+        "title": "Five ways to quit",
+        "description": "Practical steps & support",
+        "imageUrl": server.url("/img/cover.png"),
+        "siteName": "quitxt",
+    }
+    assert service.stats.bytes_fetched < 64 * 1024 < len(ARTICLE)
+
+
+def test_falls_back_to_title_and_twitter_tags(server, service):
+    server.pages["/plain"] = FixturePage(
+        b'<html><head><title> Plain page </title><meta name="description" content="About">'
+        b'<meta name="twitter:site" content="@coach"></head><body><p>Body</p></body></html>'
+    )
+    preview = service.preview(server.url("/plain"))["preview"]
+
+    assert (preview["title"], preview["description"]) == ("Plain page", "About")
+    assert (preview["imageUrl"], preview["siteName"]) == (None, "coach")
+
+
+def test_cache_hits_skip_the_network(server, service, db):
+    server.pages["/slow"] = FixturePage(ARTICLE, delay=0.2)
+    url = server.url("/slow")
+    started = time.perf_counter()
+    assert service.preview(url)["cache"] == "miss"
+    miss_latency = time.perf_counter() - started
+
+    started = time.perf_counter()
+    assert service.preview(url)["cache"] == "memory"
+    hit_latency = time.perf_counter() - started
+    assert hit_latency < miss_latency / 10
+
+    service._executor.submit(lambda: None).result()  # wait for the store write
+    other_instance = link_preview.PreviewService(lambda: db, allow_private=True)
+    try:
+        assert other_instance.preview(url)["cache"] == "store"
+    finally:
+        other_instance.stop()
+    assert server.hits["/slow"] == 1
+
+
+def test_concurrent_requests_share_one_fetch(server, service):
+    server.pages["/shared"] = FixturePage(ARTICLE, delay=0.2)
+    url = server.url("/shared")
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(service.preview(url)))
+        for _ in range(10)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert server.hits["/shared"] == 1
+    assert len({r["preview"]["title"] for r in results}) == 1
+    assert service.stats.coalesced + service.stats.memory_hits == 9
+
+
+def test_unfetchable_pages_get_a_short_lived_basic_preview(server, db):
+    server.pages["/pdf"] = FixturePage(b"%PDF-1.4", content_type="application/pdf")
+    service = link_preview.PreviewService(lambda: db, allow_private=True, failure_ttl=0.05)
+    try:
+        url = server.url("/pdf")
+        assert service.preview(url)["preview"]["description"] == "Tap to open link"
+        assert service.preview(url)["cache"] == "memory"
+        time.sleep(0.1)
+        assert service.preview(url)["cache"] == "miss"
+    finally:
+        service.stop()
+    assert server.hits["/pdf"] == 2
+
+
+def test_store_errors_fall_through_to_the_fetch(server):
+    def unavailable():
+        raise RuntimeError("Firestore is unavailable")
+
+    server.pages["/article"] = FixturePage(ARTICLE)
+    service = link_preview.PreviewService(unavailable, allow_private=True)
+    try:
+        result = service.preview(server.url("/article"))
+    finally:
+        service.stop()
+    assert result["cache"] == "miss"
+    assert result["preview"]["title"] == "Five ways to quit"
+    assert service.stats.store_errors == 2
+
+
+def test_slow_lookups_return_the_basic_preview_and_keep_going(server, service):
+    server.pages["/slow"] = FixturePage(ARTICLE, delay=0.3)
+    url = server.url("/slow")
+    result = service.preview(url, timeout=0.05)
+    assert result == {"preview": link_preview.basic_preview(url), "cache": "timeout"}
+    time.sleep(0.5)
+    assert service.preview(url)["cache"] == "memory"
+    assert server.hits["/slow"] == 1
+
+
+def test_private_addresses_are_refused(server, db):
+    server.pages["/internal"] = FixturePage(ARTICLE)
+    service = link_preview.PreviewService(lambda: db)
+    try:
+        preview = service.preview(server.url("/internal"))["preview"]
+    finally:
+        service.stop()
+    assert preview["description"] == "Tap to open link"
+    assert server.hits["/internal"] == 0
+
+
+def test_cache_evicts_least_recently_used():
+    cache = link_preview.PreviewCache(max_entries=2)
+    cache.put("a", {"url": "a"}, 60)
+    cache.put("b", {"url": "b"}, 60)
+    cache.get("a")
+    cache.put("c", {"url": "c"}, 60)
+    assert cache.get("b") is None and cache.get("a") and cache.get("c")
+
+
+def test_handle_preview_rejects_bad_urls(service):
+    for params in ({}, {"url": "ftp://example.com"}, {"url": "not a url"}):
+        body, status = link_preview.handle_preview(params, service)
+        assert status == 400 and body["status"] == "error"
+
+
+def test_redirects_are_followed(server, service):
+    server.pages["/short"] = FixturePage(b"", status=302, headers={"Location": "/a/b"})
+    server.pages["/a/b"] = FixturePage(HEAD.replace(b"/img/cover.png", b"cover.png"))
+    preview = service.preview(server.url("/short"))["preview"]
+
+    assert (preview["url"], preview["title"]) == (server.url("/short"), "Five ways to quit")
+    assert preview["imageUrl"] == server.url("/a/cover.png")
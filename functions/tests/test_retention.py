@@ -0,0 +1,116 @@
+import gzip
+import json
+import time
+from datetime import datetime, timedelta, timezone
+
+import history
+import retention
+
+NOW = datetime(2025, 6, 1, tzinfo=timezone.utc)
+OLD = NOW - timedelta(days=200)
+
+
+def _seed(db, user, old, recent=0):
+    chat = db.collection("messages").document(user).collection("chat")
+    for i in range(old + recent):
+        if i < old:
+            created = OLD + timedelta(minutes=i)
+        else:
+            created = NOW - timedelta(minutes=old + recent - i)
+        chat.document(f"m-{i:03d}").set(
+            {"messageBody": f"message {i}", "source": "client", "createdAt": created}
+        )
+
+
+def _live(db, user):
+    prefix = f"messages/{user}/chat/"
+    return sorted(path[len(prefix):] for path in db.data() if path.startswith(prefix))
+
+
+def _archives(db, user):
+    prefix = f"messages/{user}/chatArchive/"
+    return [doc for path, doc in sorted(db.data().items()) if path.startswith(prefix)]
+
+
+def test_compaction_moves_only_old_messages_into_chunks(db):
+    _seed(db, "u-1", old=25, recent=5)
+    _seed(db, "u-2", old=0, recent=3)
+
+    stats = retention.compact(db, now=NOW, max_messages=10, page_size=7)
+    assert (stats.users, stats.archived, stats.chunks, stats.completed) == (2, 25, 3, True)
+    assert _live(db, "u-1") == [f"m-{i:03d}" for i in range(25, 30)]
+    assert len(_live(db, "u-2")) == 3
+    chunks = _archives(db, "u-1")
+    assert [c["count"] for c in chunks] == [10, 10, 5]
+    assert [m["id"] for c in chunks for m in c["messages"]] == [f"m-{i:03d}" for i in range(25)]
+    assert chunks[0]["firstCreatedAt"] == OLD and chunks[0]["lastId"] == "m-009"
+
+    db.reset_counters()
+    again = retention.compact(db, now=NOW, max_messages=10)
+    assert (again.archived, db.writes) == (0, 0)
+
+
+def test_history_pages_continue_into_the_archive(db):
+    _seed(db, "u-1", old=25, recent=5)
+    service = history.HistoryService(lambda: db, cache=history.PageCache(max_pages=0))
+
+    def walk(limit):
+        seen, cursor = [], None
+        while True:
+            page = service.page("u-1", cursor, limit=limit)
+            seen = page["messages"] + seen
+            cursor = page["nextCursor"]
+            if not cursor:
+                return seen
+
+    before = walk(7)
+    retention.compact(db, now=NOW, max_messages=10)
+    assert walk(7) == before
+    assert walk(30) == before
+    assert len(before) == 30
+
+
+def test_clearing_a_user_deletes_live_and_archived_chat(db):
+    _seed(db, "u-1", old=25, recent=5)
+    _seed(db, "u-2", old=0, recent=3)
+    retention.compact(db, now=NOW, max_messages=10)
+
+    assert retention.clear_user(db, "u-1", page_size=4) == 5 + 3
+    assert _live(db, "u-1") == [] and _archives(db, "u-1") == []
+    assert len(_live(db, "u-2")) == 3
+
+
+def test_export_streams_everything_into_gzip_shards(db, tmp_path):
+    _seed(db, "u-1", old=12, recent=3)
+    _seed(db, "u-2", old=0, recent=4)
+    retention.compact(db, now=NOW)
+    for i in range(5):
+        db.collection("analytics_events").document(f"e-{i}").set(
+            {"eventName": "app_open", "parameters": {"userId": "u-1"}, "timestamp": NOW}
+        )
+
+    stats = retention.export(db, str(tmp_path), page_size=4, shard_records=6)
+    assert (stats.chat, stats.archived, stats.events, stats.shards) == (19, 12, 5, 5)
+
+    manifest = json.loads((tmp_path / "manifest.json").read_text())
+    records = {}
+    for shard in manifest["files"]:
+        with gzip.open(tmp_path / shard["name"], "rt") as lines:
+            rows = [json.loads(line) for line in lines]
+        assert len(rows) == shard["records"] <= 6
+        records.setdefault(shard["name"].split("-")[0], []).extend(rows)
+    chat = records["chat"]
+    assert sorted((r["userId"], r["id"]) for r in chat) == sorted(
+        [("u-1", f"m-{i:03d}") for i in range(15)] + [("u-2", f"m-{i:03d}") for i in range(4)]
+    )
+    assert sum(r["archived"] for r in chat) == 12
+    assert chat[-1]["data"]["createdAt"].endswith("Z")
+    assert [r["id"] for r in records["events"]] == [f"e-{i}" for i in range(5)]
+    assert {r["userId"] for r in records["events"]} == {"u-1"}
+
+
+def test_deadline_stops_before_the_next_user(db):
+    for user in ("u-1", "u-2"):
+        _seed(db, user, old=3)
+    stats = retention.compact(db, now=NOW, deadline=time.monotonic())
+    assert (stats.users, stats.completed) == (0, False)
@@ -0,0 +1,214 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import history
+import scheduled_delivery
+
+SEND_AT = datetime(2024, 5, 1, 8, 0, tzinfo=timezone.utc)
+AFTER = SEND_AT + timedelta(minutes=20)
+BEFORE = SEND_AT - timedelta(hours=1)
+
+
+def _templates(db):
+    templates = db.collection("messageTemplates")
+    templates.document("tip").set(
+        {
+            "eventTypeCode": 1,
+            "content": {"en": {"messageBody": "Drink water"}, "es": {"messageBody": "Bebe agua"}},
+        }
+    )
+    templates.document("poll").set(
+        {
+            "isPoll": True,
+            "content": {
+                "en": {
+                    "messageBody": "How are you?",
+                    "questionsAnswers": {"Good": "1", "Bad": "2"},
+                },
+            },
+        }
+    )
+
+
+def _scheduler(db, **options):
+    options.setdefault("initial_rate", None)
+    return scheduled_delivery.DeliveryScheduler(lambda: db, **options)
+
+
+def _chat(db, user_id):
+    prefix = f"messages/{user_id}/chat/"
+    return {path[len(prefix):]: doc for path, doc in db.data().items() if path.startswith(prefix)}
+
+
+def test_bucket_names_align_to_window():
+    late = datetime(2024, 5, 1, 8, 29, 59, tzinfo=timezone.utc)
+    assert scheduled_delivery.bucket_for(late) == "20240501T0815"
+    assert scheduled_delivery.bucket_for(datetime(2024, 5, 1, 8, 30)) == "20240501T0830"
+
+
+def test_renders_each_language_into_chat(db):
+    _templates(db)
+    scheduler = _scheduler(db)
+    scheduler.schedule(
+        [
+            scheduled_delivery.Delivery("u1", "tip", SEND_AT, "es"),
+            scheduled_delivery.Delivery("u2", "tip", SEND_AT, "fr"),
+            scheduled_delivery.Delivery("u2", "poll", SEND_AT + timedelta(minutes=5)),
+        ],
+        now=BEFORE,
+    )
+    stats = scheduler.run(now=AFTER)
+
+    assert (stats.written, stats.completed) == (3, True)
+    assert _chat(db, "u1")["sched-20240501T0800-tip"]["messageBody"] == "Bebe agua"
+    chat = _chat(db, "u2")
+    assert chat["sched-20240501T0800-tip"]["messageBody"] == "Drink water"
+    poll_id = "sched-20240501T0800-poll"
+    poll = history.normalize_message(poll_id, chat[poll_id], "u2")
+    assert poll["isMe"] is False and poll["type"] == "MessageType.quickReply"
+    assert [r["text"] for r in poll["suggestedReplies"]] == ["Good", "Bad"]
+
+
+def test_only_ended_buckets_are_sent_and_only_once(db):
+    _templates(db)
+    scheduler = _scheduler(db)
+    scheduler.schedule([scheduled_delivery.Delivery("u1", "tip", SEND_AT)], now=BEFORE)
+
+    assert scheduler.run(now=SEND_AT + timedelta(minutes=10)).written == 0
+    assert scheduler.run(now=AFTER).written == 1
+    db.reset_counters()
+    assert scheduler.run(now=AFTER).written == 0
+    assert db.writes == 0
+
+
+def test_late_deliveries_go_to_the_open_bucket(db):
+    _templates(db)
+    scheduler = _scheduler(db)
+    assert scheduler.run(now=AFTER).written == 0
+    assert db.data()["deliveryRuns/20240501T0800"]["status"] == "done"
+
+    scheduler.schedule(
+        [scheduled_delivery.Delivery("u1", "tip", SEND_AT + timedelta(minutes=1))], now=AFTER
+    )
+    assert scheduler.run(now=SEND_AT + timedelta(minutes=40)).written == 1
+    assert list(_chat(db, "u1")) == ["sched-20240501T0815-tip"]
+
+
+def test_lease_is_claimed_once(db):
+    scheduler = _scheduler(db, lease=timedelta(minutes=10))
+    run_ref = db.collection("deliveryRuns").document("20240501T0800")
+    assert scheduler._claim(db, run_ref) == {}
+    assert scheduler._claim(db, run_ref) is None
+    run_ref.set({"status": "paused", "cursor": "tip~u1", "leaseUntil": SEND_AT})
+    assert scheduler._claim(db, run_ref)["cursor"] == "tip~u1"
+
+
+def test_missing_templates_are_skipped(db):
+    _templates(db)
+    scheduler = _scheduler(db)
+    scheduler.schedule(
+        [
+            scheduled_delivery.Delivery("u1", "gone", SEND_AT),
+            scheduled_delivery.Delivery("u2", "tip", SEND_AT),
+        ],
+        now=BEFORE,
+    )
+    stats = scheduler.run(now=AFTER)
+    assert (stats.written, stats.skipped) == (1, 1)
+
+
+def test_deadline_pauses_and_next_run_resumes(db):
+    _templates(db)
+    scheduler = _scheduler(db, page_size=100, batch_size=50)
+    scheduler.schedule(
+        (scheduled_delivery.Delivery(f"u{i:04d}", "tip", SEND_AT) for i in range(350)),
+        now=BEFORE,
+    )
+
+    first = scheduler.run(now=AFTER, deadline=time.monotonic())
+    assert (first.written, first.completed) == (100, False)
+    checkpoint = db.data()["deliveryRuns/20240501T0800"]
+    assert checkpoint["status"] == "paused" and checkpoint["written"] == 100
+
+    second = scheduler.run(now=AFTER)
+    assert (second.written, second.completed) == (250, True)
+    assert db.data()["deliveryRuns/20240501T0800"]["written"] == 350
+    assert sum(1 for path in db.data() if "/chat/" in path) == 350
+
+
+def test_crashed_run_resumes_after_lease(db, monkeypatch):
+    _templates(db)
+    scheduler = _scheduler(
+        db, page_size=100, batch_size=100, max_attempts=1, lease=timedelta(0)
+    )
+    scheduler.schedule(
+        (scheduled_delivery.Delivery(f"u{i:04d}", "tip", SEND_AT) for i in range(300)),
+        now=BEFORE,
+    )
+
+    batch = db.batch
+    commits = []
+
+    def failing_batch():
+        real = batch()
+        commit = real.commit
+
+        def crash_on_third():
+            commits.append(1)
+            if len(commits) == 3:
+                raise RuntimeError("instance shut down")
+            return commit()
+
+        real.commit = crash_on_third
+        return real
+
+    monkeypatch.setattr(db, "batch", failing_batch)
+    with pytest.raises(RuntimeError):
+        scheduler.run(now=AFTER)
+    assert db.data()["deliveryRuns/20240501T0800"]["written"] == 200
+
+    stats = scheduler.run(now=AFTER)
+    assert stats.written == 100
+    assert sum(1 for path in db.data() if "/chat/" in path) == 300
+
+
+def test_resumed_page_keeps_delivered_messages_in_place(db, monkeypatch):
+    _templates(db)
+    scheduler = _scheduler(
+        db, page_size=100, batch_size=50, max_in_flight=1, max_attempts=1, lease=timedelta(0)
+    )
+    scheduler.schedule(
+        (scheduled_delivery.Delivery(f"u{i:04d}", "tip", SEND_AT) for i in range(150)),
+        now=BEFORE,
+    )
+    commit = db._commit
+    commits = []
+
+    def crash_on_second_chat_batch(writes):
+        if any("/chat/" in ref.path for _, ref, _, _ in writes):
+            commits.append(1)
+            if len(commits) == 2:
+                raise RuntimeError("instance shut down")
+        commit(writes)
+
+    monkeypatch.setattr(db, "_commit", crash_on_second_chat_batch)
+    with pytest.raises(RuntimeError):
+        scheduler.run(now=AFTER)
+    delivered = {path: doc["createdAt"] for path, doc in db.data().items() if "/chat/" in path}
+    assert len(delivered) == 50
+
+    stats = scheduler.run(now=AFTER)
+    assert (stats.written, stats.skipped) == (100, 50)
+    chat = {path: doc for path, doc in db.data().items() if "/chat/" in path}
+    assert len(chat) == 150
+    assert all(chat[path]["createdAt"] == created_at for path, created_at in delivered.items())
+
+
+def test_throttle_paces_writes():
+    throttle = scheduled_delivery.RampingThrottle(initial_rate=1_000)
+    started = time.monotonic()
+    for _ in range(3):
+        throttle.acquire(100)
+    assert 0.25 <= time.monotonic() - started < 1.0
@@ -0,0 +1,103 @@
+import json
+import random
+
+import pytest
+
+import ingest
+import tracing
+
+
+@pytest.fixture(autouse=True)
+def clean_registry():
+    tracing.REGISTRY.clear()
+    yield
+    tracing.REGISTRY.clear()
+
+
+def test_quantiles_stay_within_a_bucket():
+    histogram = tracing.Histogram()
+    rng = random.Random(1)
+    values = sorted(rng.uniform(0.001, 0.5) for _ in range(10_000))
+    histogram.observe_many(values[:5_000])
+    for value in values[5_000:]:
+        histogram.observe(value)
+    assert histogram.count == 10_000
+    for q in (0.5, 0.95, 0.99):
+        exact = values[int(q * len(values)) - 1]
+        assert abs(histogram.quantile(q) - exact) / exact < 0.41
+    assert histogram.quantile(1.0) <= values[-1]
+    assert tracing.Histogram().quantile(0.5) == 0.0
+
+
+def test_timed_records_calls_that_raise():
+    @tracing.timed("test.work")
+    def work(fail):
+        if fail:
+            raise RuntimeError("boom")
+        return "done"
+
+    assert work(False) == "done"
+    with pytest.raises(RuntimeError):
+        work(True)
+    with tracing.stage("test.block"):
+        pass
+    stages = tracing.REGISTRY.stages()
+    assert stages["test.work"].count == 2 and stages["test.block"].count == 1
+
+    tracing.REGISTRY.clear()
+    work(False)
+    assert tracing.REGISTRY.stages()["test.work"].count == 1
+
+
+def test_prometheus_text_is_cumulative():
+    tracing.observe("ingest.commit", 0.002)
+    tracing.observe("ingest.commit", 0.030)
+    tracing.observe("ingest.commit", 120.0)
+    lines = tracing.render().splitlines()
+    assert lines[1] == "# TYPE quitxt_stage_seconds histogram"
+    buckets = [int(line.rsplit(" ", 1)[1]) for line in lines if "_bucket{" in line]
+    assert buckets == sorted(buckets) and buckets[-2:] == [2, 3]
+    assert 'quitxt_stage_seconds_bucket{stage="ingest.commit",le="+Inf"} 3' in lines
+    assert 'quitxt_stage_seconds_count{stage="ingest.commit"} 3' in lines
+    assert not any("history.page" in line for line in lines)
+
+
+def test_trace_ids_are_stable_and_sampled_consistently():
+    trace = tracing.trace_id("m-1")
+    assert trace == tracing.trace_id("m-1") != tracing.trace_id("m-2")
+    assert len(trace) == 32 and int(trace, 16) >= 0
+    assert tracing.sampled(trace, 1.0) and not tracing.sampled(trace, 0.0)
+
+
+def test_ingest_records_stages_and_logs_sampled_traces(db, monkeypatch, capsys):
+    monkeypatch.setattr(tracing, "SAMPLE_RATE", 1.0)
+    monkeypatch.setenv("GCLOUD_PROJECT", "demo-quitxt")
+    pipeline = ingest.IngestPipeline(lambda: db, workers=1)
+    try:
+        body, _ = ingest.handle_ingest(
+            {"messageId": "m-1", "userId": "u-1", "messageText": "hi"}, pipeline
+        )
+        pipeline.flush(5)
+    finally:
+        pipeline.stop()
+
+    assert body["traceId"] == tracing.trace_id("m-1")
+    stages = tracing.REGISTRY.stages()
+    for name in ("handler", "queue_wait", "firestore_write", "end_to_end"):
+        assert stages[f"ingest.{name}"].count == 1
+    entry = json.loads(capsys.readouterr().out.strip())
+    assert entry["messageId"] == "m-1" and entry["traceId"] == body["traceId"]
+    assert entry["logging.googleapis.com/trace"] == f"projects/demo-quitxt/traces/{body['traceId']}"
+    assert set(entry["stagesMs"]) == {"queue", "commit", "total"}
+
+
+def test_traces_go_to_the_configured_sink(monkeypatch, capsys):
+    monkeypatch.setattr(tracing, "SAMPLE_RATE", 1.0)
+    lines = []
+    previous = tracing.set_sink(lines.append)
+    try:
+        tracing.log_trace(tracing.trace_id("m-1"), "m-1", {"total": 2.0})
+    finally:
+        assert tracing.set_sink(previous) == lines.append
+    assert json.loads(lines[0])["stagesMs"] == {"total": 2.0}
+    assert capsys.readouterr().out == ""
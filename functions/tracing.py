@@ -0,0 +1,235 @@
+"""Per-stage latency histograms and message traces for the hot paths.
+
+A message's latency budget runs from the client's POST through the
+`/api/mobile` handler, the ingest queue and the Firestore commit, to the
+listener that delivers `serverMessageId` back to the app. Each server-side
+stage is timed into a `Histogram` with fixed, log-spaced buckets. Observing
+a value costs one bisect and one uncontended lock, and memory does not grow
+with traffic.
+
+Every message gets a trace id derived from its `messageId`, so the client,
+the ack and the logs agree without passing anything extra. The id is
+returned in the ack. A deterministic sample of messages (`TRACE_SAMPLE_RATE`,
+default 1%), plus any message slower than `TRACE_SLOW_MS`, is passed as a
+JSON line to the trace sink. The default sink writes to stdout, which Cloud
+Logging files as structured entries under the trace, and log-based metrics
+aggregate them across instances. `set_sink` redirects them, e.g. to keep a
+benchmark's report clean.
+`render()` gives the same histograms in the Prometheus text format for the
+instance that serves the request (`GET ...?metrics=1`).
+"""
+
+from __future__ import annotations
+
+import bisect
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Iterator, Mapping, Optional, TypeVar
+
+METRIC_NAME = "quitxt_stage_seconds"
+# 50µs to about 60s in steps of sqrt(2): each bucket is at most 41% wide.
+BUCKET_BOUNDS = tuple(0.00005 * 2 ** (i / 2) for i in range(41))
+
+SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.01"))
+SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", "1000"))
+
+_TRACE_NAMESPACE = uuid.UUID("4f1c2a4e-8a53-4d0e-9a0c-6b7e0f3d2c11")
+
+F = TypeVar("F", bound=Callable[..., Any])
+Sink = Callable[[str], None]
+
+
+class Histogram:
+    """Counts observations (in seconds) into `BUCKET_BOUNDS`."""
+
+    def __init__(self, bounds: tuple[float, ...] = BUCKET_BOUNDS) -> None:
+        self.bounds = bounds
+        # The last slot counts values above the highest bound.
+        self._counts = [0] * (len(bounds) + 1)
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            if value > self._max:
+                self._max = value
+
+    def observe_many(self, values: Iterable[float]) -> None:
+        indexed = [(bisect.bisect_left(self.bounds, v), v) for v in values]
+        with self._lock:
+            for index, value in indexed:
+                self._counts[index] += 1
+                self._sum += value
+                if value > self._max:
+                    self._max = value
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counts = [0] * (len(self.bounds) + 1)
+            self._sum = self._max = 0.0
+
+    def snapshot(self) -> tuple[list[int], float, float]:
+        """Per-bucket counts, the sum and the largest value seen."""
+        with self._lock:
+            return list(self._counts), self._sum, self._max
+
+    @property
+    def count(self) -> int:
+        with self._lock:
+            return sum(self._counts)
+
+    def quantile(self, q: float) -> float:
+        """Estimates the `q` quantile by interpolating inside its bucket."""
+        counts, _, largest = self.snapshot()
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[index - 1] if index else 0.0
+                upper = self.bounds[index] if index < len(self.bounds) else largest
+                estimate = lower + (upper - lower) * (rank - seen) / count
+                return min(estimate, largest)
+            seen += count
+        return largest
+
+
+class Registry:
+    """Named stage histograms for one process."""
+
+    def __init__(self) -> None:
+        self._histograms: dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, stage: str) -> Histogram:
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(stage, Histogram())
+        return histogram
+
+    def stages(self) -> dict[str, Histogram]:
+        with self._lock:
+            return dict(sorted(self._histograms.items()))
+
+    def clear(self) -> None:
+        """Zeroes every histogram; decorated functions keep theirs."""
+        for histogram in self.stages().values():
+            histogram.reset()
+
+    def render(self) -> str:
+        """The histograms in the Prometheus text exposition format."""
+        lines = [
+            f"# HELP {METRIC_NAME} Time spent in each backend stage.",
+            f"# TYPE {METRIC_NAME} histogram",
+        ]
+        for stage, histogram in self.stages().items():
+            counts, total, _ = histogram.snapshot()
+            if not sum(counts):
+                continue
+            label = f'stage="{stage}"'
+            cumulative = 0
+            for bound, count in zip(histogram.bounds, counts):
+                cumulative += count
+                lines.append(f'{METRIC_NAME}_bucket{{{label},le="{bound:.6g}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{METRIC_NAME}_bucket{{{label},le="+Inf"}} {cumulative}')
+            lines.append(f"{METRIC_NAME}_sum{{{label}}} {total:.6f}")
+            lines.append(f"{METRIC_NAME}_count{{{label}}} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def observe(stage: str, seconds: float) -> None:
+    REGISTRY.histogram(stage).observe(seconds)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Times the body of a `with` block into the `name` histogram."""
+    histogram = REGISTRY.histogram(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started)
+
+
+def timed(name: str) -> Callable[[F], F]:
+    """Decorator that times every call, including ones that raise."""
+
+    def decorate(function: F) -> F:
+        histogram = REGISTRY.histogram(name)
+
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorate
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+def trace_id(message_id: str) -> str:
+    """The 32-hex-digit trace id of a message, the same on every instance."""
+    return uuid.uuid5(_TRACE_NAMESPACE, message_id).hex
+
+
+def sampled(trace: str, rate: Optional[float] = None) -> bool:
+    """Deterministic sampling, so every stage of a trace makes the same call."""
+    rate = SAMPLE_RATE if rate is None else rate
+    return int(trace[:8], 16) < rate * 0x1_0000_0000
+
+
+def _stdout(line: str) -> None:
+    sys.stdout.write(line + "\n")
+
+
+_sink: Sink = _stdout
+
+
+def set_sink(sink: Optional[Sink]) -> Sink:
+    """Sends trace lines to `sink` (stdout when None); returns the previous sink."""
+    global _sink
+    previous, _sink = _sink, sink or _stdout
+    return previous
+
+
+def log_trace(trace: str, message_id: str, stages_ms: Mapping[str, float]) -> None:
+    """Writes one trace as a structured log line if it is sampled or slow."""
+    total = max(stages_ms.values(), default=0.0)
+    if not sampled(trace) and total < SLOW_MS:
+        return
+    entry: dict[str, Any] = {
+        "severity": "WARNING" if total >= SLOW_MS else "INFO",
+        "message": f"trace {message_id} {total:.1f}ms",
+        "traceId": trace,
+        "messageId": message_id,
+        "stagesMs": {name: round(ms, 3) for name, ms in stages_ms.items()},
+    }
+    project = os.environ.get("GCLOUD_PROJECT") or os.environ.get("GOOGLE_CLOUD_PROJECT")
+    if project:
+        entry["logging.googleapis.com/trace"] = f"projects/{project}/traces/{trace}"
+    _sink(json.dumps(entry))
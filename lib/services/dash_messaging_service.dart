@@ -10,6 +10,7 @@ import '../models/quick_reply.dart';
 import '../utils/debug_config.dart';
 import '../utils/platform_utils.dart';
 import 'package:cloud_firestore/cloud_firestore.dart';
+import 'package:firebase_auth/firebase_auth.dart';
 import 'package:firebase_messaging/firebase_messaging.dart';
 import 'service_manager.dart';
 
@@ -725,6 +726,9 @@ class DashMessagingService implements MessagingService {
           const JsonEncoder.withIndent('  ').convert(jsonDecode(requestBody));
 
 
+      // Lets the server bind userId and fcmToken to the signed-in user
+      final idToken = await FirebaseAuth.instance.currentUser?.getIdToken();
+
       // Send to server with optimized timeout
       final response = await http
           .post(
@@ -733,6 +737,7 @@ class DashMessagingService implements MessagingService {
           'Content-Type': 'application/json',
           'Accept': 'application/json',
           'User-Agent': 'Quitxt-Mobile/1.0',
+          if (idToken != null) 'Authorization': 'Bearer $idToken',
         },
         body: requestBody,
       )
@@ -2351,43 +2356,44 @@ class DashMessagingService implements MessagingService {
         'Clearing all messages in Firebase for user: $_userId');
 
     try {
-      // Reference to the user's chat collection
-      final chatRef = FirebaseFirestore.instance
-          .collection('messages')
-          .doc(_userId)
-          .collection('chat');
-
-      // Get all messages
-      final snapshot = await chatRef.get();
-
-      if (snapshot.docs.isEmpty) {
-        return;
-      }
-
-          'Deleting ${snapshot.docs.length} messages from Firebase');
+      // The live chat and the archive chunks the backend compacts old
+      // messages into (see functions/retention.py)
+      for (final collection in const ['chat', 'chatArchive']) {
+        final chatRef = FirebaseFirestore.instance
+            .collection('messages')
+            .doc(_userId)
+            .collection(collection);
+
+        // Get all documents
+        final snapshot = await chatRef.get();
+
+        if (snapshot.docs.isEmpty) {
+          continue;
+        }
 
-      // Use batched writes for efficiency (max 500 operations per batch)
-      const int batchSize = 500;
-      int count = 0;
-      WriteBatch batch = FirebaseFirestore.instance.batch();
+        // Use batched writes for efficiency (max 500 operations per batch)
+        const int batchSize = 500;
+        int count = 0;
+        WriteBatch batch = FirebaseFirestore.instance.batch();
 
-      for (var doc in snapshot.docs) {
-        batch.delete(doc.reference);
-        count++;
+        for (var doc in snapshot.docs) {
+          batch.delete(doc.reference);
+          count++;
+
+          // Commit batch when it reaches the limit and create a new batch
+          if (count >= batchSize) {
+            await batch.commit();
+            count = 0;
+            batch = FirebaseFirestore.instance.batch();
+          }
+        }
 
-        // Commit batch when it reaches the limit and create a new batch
-        if (count >= batchSize) {
+        // Commit any remaining operations
+        if (count > 0) {
           await batch.commit();
-          count = 0;
-          batch = FirebaseFirestore.instance.batch();
         }
       }
 
-      // Commit any remaining operations
-      if (count > 0) {
-        await batch.commit();
-      }
-
     } catch (e) {
       DebugConfig.errorPrint('Error clearing messages in Firebase: $e');
       rethrow;